@@ -1,29 +1,99 @@
-import concurrent.futures
-import itertools
 import os
+import threading
 import time
+from collections.abc import Iterable, Iterator
 
 import clickhouse_connect
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from dotenv import load_dotenv
 
-import data_generation  # type: ignore
+import config  # type: ignore
+import ingest  # type: ignore
 import utils  # type: ignore
-from config import config  # type: ignore
 
 
-def create_table(client, table_name: str) -> None:
+# Stand-ins for NULL when value columns aren't Nullable
+SENTINELS = {
+    "value_int": -(2**31),
+    "value_float": float("nan"),
+    "value_str": "",
+    "value_bool": 255,
+}
+SENTINEL_LITERALS = {
+    "value_int": str(SENTINELS["value_int"]),
+    "value_float": "nan",
+    "value_str": "''",
+    "value_bool": str(SENTINELS["value_bool"]),
+}
+
+
+# Arrow types of the table's columns
+COLUMN_TYPES = {
+    "time": pa.timestamp("ms"),
+    "tag_id": pa.uint32(),
+    "value_int": pa.int32(),
+    "value_float": pa.float32(),
+    "value_str": pa.string(),
+    "value_bool": pa.uint8(),
+}
+
+
+def get_client():
+    return clickhouse_connect.get_client(
+        host=os.getenv("CLICKHOUSE_HOST"),
+        port=int(os.getenv("CLICKHOUSE_PORT", 8443)),
+        username="default",
+        password=os.getenv("CLICKHOUSE_PASSWORD"),
+    )
+
+
+def get_columns(
+    *,
+    nullable: bool = True,
+    low_cardinality: bool = False,
+    time_codec: str | None = None,
+) -> str:
+    def value_type(name: str, type_: str) -> str:
+        type_ = f"Nullable({type_})" if nullable else type_
+        if low_cardinality and name == "value_str":
+            type_ = f"LowCardinality({type_})"
+        # Columns left out of an insert get the sentinel too
+        default = "" if nullable else f" DEFAULT {SENTINEL_LITERALS[name]}"
+        return f"`{name}` {type_}{default}"
+
+    return ",\n".join(
+        [
+            f"`time` DateTime64{f' CODEC({time_codec})' if time_codec else ''}",
+            "`tag_id` UInt32",
+            value_type("value_int", "Int32"),
+            value_type("value_float", "Float32"),
+            value_type("value_str", "String"),
+            value_type("value_bool", "UInt8"),
+        ]
+    )
+
+
+def create_table(
+    client,
+    table_name: str,
+    *,
+    engine: str = "SharedMergeTree",
+    nullable: bool = True,
+    low_cardinality: bool = False,
+    partition_by: str | None = None,
+    time_codec: str | None = None,
+) -> None:
+    # NOTE: SharedMergeTree is only available in ClickHouse Cloud, use MergeTree locally.
+    # NOTE: Without Nullable columns, NULL is stored as the value in SENTINELS.
     client.command(
         f"""
         CREATE TABLE IF NOT EXISTS {table_name} (
-            `time` DateTime64,
-            `tag_id` UInt32,
-            `value_int` Nullable(Int32),
-            `value_float` Nullable(Float32),
-            `value_str` Nullable(String),
-            `value_bool` Nullable(UInt8)
+            {get_columns(nullable=nullable, low_cardinality=low_cardinality, time_codec=time_codec)}
         )
-        ENGINE = SharedMergeTree
+        ENGINE = {engine}
+        {f"PARTITION BY {partition_by}" if partition_by else ""}
         PRIMARY KEY (tag_id, time);
         """
     )
@@ -39,7 +109,7 @@ def create_table(client, table_name: str) -> None:
                 `value_str` Nullable(String),
                 `value_bool` Nullable(UInt8)
             )
-            ENGINE = SharedMergeTree
+            ENGINE = {engine}
             PRIMARY KEY (tag_id, time);
             """
         )
@@ -61,6 +131,32 @@ def create_table(client, table_name: str) -> None:
         )
 
 
+def create_latest_table(client, table_name: str) -> None:
+    """
+    Keep the latest row of every tag in `{table_name}_latest`, updated on insert.
+    """
+    # The view (the raw latest query) reduces every inserted block to one row
+    # per tag and ReplacingMergeTree keeps the one with the greatest time as
+    # parts merge (FINAL does the same on read for the parts that haven't yet)
+    engine = get_default_engine().replace("MergeTree", "ReplacingMergeTree")
+    client.command(
+        f"""
+        CREATE TABLE IF NOT EXISTS {table_name}_latest (
+            {get_columns()}
+        )
+        ENGINE = {engine}(time)
+        ORDER BY tag_id;
+        """
+    )
+
+    client.command(
+        f"""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS {table_name}_latest_mv TO {table_name}_latest AS
+        {build_latest_query(table_name, snapshot=False)};
+        """
+    )
+
+
 def delete_table(client, table_name: str) -> None:
     """
     Drop a table if it exists.
@@ -68,6 +164,8 @@ def delete_table(client, table_name: str) -> None:
     client.command(f"DROP TABLE IF EXISTS {table_name}")
     client.command(f"DROP TABLE IF EXISTS {table_name}_1min")
     client.command(f"DROP TABLE IF EXISTS {table_name}_mv")
+    client.command(f"DROP TABLE IF EXISTS {table_name}_latest")
+    client.command(f"DROP TABLE IF EXISTS {table_name}_latest_mv")
 
 
 def get_table_size(client, table_name: str) -> int:
@@ -89,95 +187,368 @@ def get_table_size(client, table_name: str) -> int:
     return result.result_rows[0][0]
 
 
-def insert_dataframe(
-    client, table_name: str, df: pd.DataFrame, chunksize: int, workers: int
-) -> float:
+def get_parts_stats(client, table_name: str) -> dict:
     """
-    Insert a pandas DataFrame into ClickHouse.
+    Get active part count, bytes on disk and running merges for the table.
     """
-    t_start = time.time()
+    result = client.query(
+        f"""
+        SELECT
+            count() AS active_parts,
+            sum(bytes_on_disk) AS bytes_on_disk,
+            (
+                SELECT count()
+                FROM system.merges
+                WHERE database = currentDatabase() AND table = '{table_name}'
+            ) AS merges_in_progress
+        FROM system.parts
+        WHERE database = currentDatabase() AND table = '{table_name}' AND active
+        """
+    )
+    return dict(zip(result.column_names, result.result_rows[0]))
 
-    # Convert value_bool to 0/1 for ClickHouse's UInt8
-    df["value_bool"] = df["value_bool"].astype("Int32")
 
-    df = df.replace({pd.NA: None})
+def get_merged_parts(client, table_name: str, since: float) -> int | None:
+    """
+    Count merges of the table's parts since a unix timestamp (needs part_log).
+    """
+    if not client.command("EXISTS TABLE system.part_log"):
+        return None
+    client.command("SYSTEM FLUSH LOGS")
+    result = client.query(
+        f"""
+        SELECT count()
+        FROM system.part_log
+        WHERE database = currentDatabase()
+            AND table = '{table_name}'
+            AND event_type = 'MergeParts'
+            AND event_time >= toDateTime({int(since)})
+        """
+    )
+    return result.result_rows[0][0]
 
-    chunks = []
-    for i in range(0, len(df), chunksize):
-        chunks.append(df.iloc[i : i + chunksize])
 
-    def insert_chunk(chunk):
-        rows = chunk.values.tolist()
-        client.insert(table_name, rows, column_names=df.columns.tolist())
+def wait_for_rows(client, table_name: str, n: int, timeout_s: float = 600) -> None:
+    """
+    Block until `n` rows are visible, e.g. after async inserts without waiting.
+    """
+    t_end = time.time() + timeout_s
+    while client.command(f"SELECT count() FROM {table_name}") < n:
+        if time.time() > t_end:
+            raise TimeoutError(
+                f"{table_name} has fewer than {n} rows after {timeout_s} s"
+            )
+        time.sleep(0.1)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        executor.map(insert_chunk, chunks)
 
-    t_end = time.time()
-    return round(t_end - t_start, 3)
+def build_query(
+    kind: str, *, table_name: str, tag_ids: list[int], start: str, end: str
+) -> str:
+    tags = ", ".join(map(str, tag_ids))
+    time_range = f"""
+        time >= parseDateTime64BestEffort('{start}')
+        AND time < parseDateTime64BestEffort('{end}')
+    """
 
+    if kind == "point":
+        return f"""
+        SELECT time, value_int, value_float, value_str, value_bool
+        FROM {table_name}
+        WHERE tag_id = {tag_ids[0]} AND {time_range}
+        ORDER BY time
+        """
 
-def main():
-    load_dotenv(override=True)
+    if kind == "downsample":
+        # Aliasing the bucket as time would make argMin(..., time) pick by the
+        # bucket instead of the row's time, so it's renamed outside
+        return f"""
+        SELECT bucket AS time, tag_id, value_float
+        FROM (
+            SELECT
+                toStartOfMinute(time) AS bucket,
+                tag_id,
+                argMin(value_float, time) AS value_float
+            FROM {table_name}
+            WHERE tag_id IN ({tags}) AND {time_range}
+            GROUP BY bucket, tag_id
+        )
+        ORDER BY time, tag_id
+        """
 
-    client = clickhouse_connect.get_client(
-        host=os.getenv("CLICKHOUSE_HOST"),
-        port=8443,
-        username="default",
-        password=os.getenv("CLICKHOUSE_PASSWORD"),
+    if kind == "last_value":
+        # Aliasing max(time) as time would make argMax(..., time) an aggregate
+        # of an aggregate, so it's renamed outside
+        return f"""
+        SELECT tag_id, last_time AS time, value_int, value_float, value_str, value_bool
+        FROM (
+            SELECT
+                tag_id,
+                max(time) AS last_time,
+                argMax(value_int, time) AS value_int,
+                argMax(value_float, time) AS value_float,
+                argMax(value_str, time) AS value_str,
+                argMax(value_bool, time) AS value_bool
+            FROM {table_name}
+            WHERE tag_id IN ({tags})
+            GROUP BY tag_id
+        )
+        """
+
+    raise ValueError(f"Unknown query kind {kind}")
+
+
+def build_latest_query(table_name: str, *, snapshot: bool) -> str:
+    """
+    Latest row of every tag, from the snapshot or aggregated from the raw table.
+    """
+    if snapshot:
+        return f"""
+        SELECT tag_id, time, value_int, value_float, value_str, value_bool
+        FROM {table_name}_latest FINAL
+        """
+
+    # Aliasing max(time) as time would make argMax(..., time) an aggregate of
+    # an aggregate, so it's renamed outside
+    return f"""
+    SELECT last_time AS time, tag_id, value_int, value_float, value_str, value_bool
+    FROM (
+        SELECT
+            tag_id,
+            max(time) AS last_time,
+            argMax(value_int, time) AS value_int,
+            argMax(value_float, time) AS value_float,
+            argMax(value_str, time) AS value_str,
+            argMax(value_bool, time) AS value_bool
+        FROM {table_name}
+        GROUP BY tag_id
+    )
+    """
+
+
+# WITH FILL ... INTERPOLATE repeats the previous value, there's no linear fill
+RESAMPLE_FILLS = {"locf": "locf"}
+
+
+def build_resample_query(
+    *,
+    table_name: str,
+    tag_ids: list[int],
+    start: str,
+    end: str,
+    step_s: int,
+    fill: str | None = None,
+) -> str:
+    """
+    First value of every `step_s` bucket, gap-filled on the server with `fill`.
+    """
+    tags = ", ".join(map(str, tag_ids))
+    # Rows differing in tag_id (the sorting prefix) are filled independently
+    with_fill = f"""
+        WITH FILL
+            FROM parseDateTime64BestEffort('{start}')
+            TO parseDateTime64BestEffort('{end}')
+            STEP INTERVAL {step_s} SECOND
+        INTERPOLATE (value AS value)
+    """
+
+    # The bucket isn't aliased as time, or argMin(..., time) would order by it
+    return f"""
+    SELECT tag_id, bucket AS time, value
+    FROM (
+        SELECT
+            tag_id,
+            toDateTime64(toStartOfInterval(time, INTERVAL {step_s} SECOND), 3) AS bucket,
+            argMin(coalesce(value_float, value_int), time) AS value
+        FROM {table_name}
+        WHERE tag_id IN ({tags})
+            AND time >= parseDateTime64BestEffort('{start}')
+            AND time < parseDateTime64BestEffort('{end}')
+        GROUP BY tag_id, bucket
+        ORDER BY tag_id, bucket {with_fill if fill else ""}
     )
+    """
 
-    data = []
 
-    cases = list(
-        itertools.product(
-            config["minutes"],
-            config["workers"],
-            config["tags"],
-            config["seconds_interval"],
+def run_query(client, sql: str) -> pa.Table:
+    return client.query_arrow(sql)
+
+
+def query_downsample(
+    client,
+    table_name: str,
+    *,
+    tag_ids: list[int],
+    start: str,
+    end: str,
+) -> list:
+    result = client.query(
+        build_query(
+            "downsample", table_name=table_name, tag_ids=tag_ids, start=start, end=end
         )
     )
+    return result.result_rows
+
 
-    for minutes, workers, n_tags, seconds_interval in cases:
-        case_name = data_generation.generate_case_name(
-            minutes=minutes,
-            n_tags=n_tags,
-            seconds_interval=seconds_interval,
+def export_slice(table_name: str, *, start: str, end: str) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the rows in [start, end) in the ArrowStream format.
+    """
+    # A session only runs one query at a time, so every slice gets its own client
+    client = get_client()
+    with client.query_arrow_stream(
+        f"""
+        SELECT *
+        FROM {table_name}
+        WHERE time >= parseDateTime64BestEffort('{start}')
+            AND time < parseDateTime64BestEffort('{end}')
+        """
+    ) as stream:
+        yield from stream
+
+
+def prepare_batch(batch: pa.RecordBatch, *, nullable: bool = True) -> pa.Table:
+    """
+    Cast a record batch to the table's column types (value_bool as 0/1 UInt8).
+    """
+    # Narrow batches (see ingest.route_by_type) only carry some value columns,
+    # the others are filled with the column defaults
+    columns = {
+        name: pc.cast(batch.column(name), COLUMN_TYPES[name], safe=False)
+        for name in batch.schema.names
+    }
+
+    if not nullable:
+        for name, sentinel in SENTINELS.items():
+            if name in columns:
+                columns[name] = pc.fill_null(columns[name], sentinel)
+
+    return pa.table(columns)
+
+
+def insert_batches(
+    client,
+    table_name: str,
+    batches: Iterable[pa.RecordBatch],
+    workers: int,
+    *,
+    nullable: bool = True,
+    settings: dict | None = None,
+) -> float:
+    """
+    Insert Arrow record batches into ClickHouse (sent in the Arrow format).
+    """
+    t_start = time.time()
+
+    # A client holds one HTTP session, which can't be used by several threads
+    # at once, so the first worker takes `client` and the others connect
+    local = threading.local()
+    clients = [client]
+    new_clients = []
+    lock = threading.Lock()
+
+    def get_worker_client():
+        if not hasattr(local, "client"):
+            with lock:
+                local.client = clients.pop() if clients else None
+            if local.client is None:
+                local.client = get_client()
+                new_clients.append(local.client)
+        return local.client
+
+    def insert_batch(batch: pa.RecordBatch) -> None:
+        get_worker_client().insert_arrow(
+            table_name, prepare_batch(batch, nullable=nullable), settings=settings
         )
 
-        print(case_name)
+    try:
+        ingest.map_bounded(insert_batch, batches, workers=workers)
+    finally:
+        for worker_client in new_clients:
+            worker_client.close()
+
+    t_end = time.time()
+    return round(t_end - t_start, 3)
+
+
+def get_default_engine() -> str:
+    # SharedMergeTree only exists in ClickHouse Cloud
+    return "SharedMergeTree" if utils.get_remote() else "MergeTree"
+
+
+def reset_table(client, table_name: str) -> None:
+    delete_table(client, table_name)
+    create_table(client, table_name, engine=get_default_engine())
+
+
+def write_batches(
+    client, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    return insert_batches(client, table_name, batches, workers=workers)
+
+
+def write_latest(
+    client, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    # The view runs as part of the insert
+    return insert_batches(client, table_name, batches, workers=workers)
+
+
+def main():
+    load_dotenv(override=True)
+
+    client = get_client()
+
+    data: dict[int, list[dict]] = {}
+
+    for case in config.get_cases("clickhouse"):
+        case_name, workers = case.name, case.workers
+        print(f"{case_name} ({workers} workers)")
 
         table_name = f"_{case_name}"
+        # peak_rss_B is the peak of this run only
+        utils.reset_peak_rss()
 
-        df = pd.read_parquet(f"data/{case_name}.parquet")
+        parquet_file = ingest.open_case(case_name)
+        n_rows = parquet_file.metadata.num_rows
 
         # Start from scratch in each loop
         delete_table(client, table_name)
         create_table(client, table_name)
 
-        insert_time = insert_dataframe(
-            client, table_name, df, chunksize=1_500_000, workers=workers
+        load_stats: dict = {}
+        insert_time = insert_batches(
+            client,
+            table_name,
+            ingest.iter_batches(
+                parquet_file, batch_size=case.batch_size, stats=load_stats
+            ),
+            workers=workers,
+        )
+        print(
+            f"\t{round(insert_time, 3)} s ({round(load_stats['load_time_s'], 3)} s loading)"
         )
-        print(f"\t{round(insert_time, 3)} s")
-        print(f"\t{int(len(df) / insert_time)} rows/s")
+        print(f"\t{int(n_rows / insert_time)} rows/s")
         table_size = get_table_size(client, table_name)
 
-        data.append(
+        data.setdefault(workers, []).append(
             {
-                "n_tags": n_tags,
-                "seconds_interval": seconds_interval,
-                "data_points": len(df),
+                "n_tags": case.n_tags,
+                "seconds_interval": case.seconds_interval,
+                "data_points": n_rows,
                 "table_size_B": table_size,
                 "insert_time_s": insert_time,
+                "load_time_s": round(load_stats["load_time_s"], 3),
+                "peak_rss_B": utils.get_peak_rss(),
             }
         )
 
         # If you want to drop after:
         # delete_table(client, table_name)
 
-    df_stats = pd.DataFrame(data)
-    file_name = f"data_stats/clickhouse_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
-    df_stats.to_csv(file_name, index=False)
+    for workers, rows in data.items():
+        df_stats = pd.DataFrame(rows)
+        file_name = f"data_stats/clickhouse_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+        df_stats.to_csv(file_name, index=False)
 
 
 if __name__ == "__main__":
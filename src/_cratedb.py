@@ -45,22 +45,37 @@
 # 5000
 # CircuitBreakingException[Allocating 1mb for 'distWindowAgg: 1' failed, breaker would use 1gb in total. Limit is 1gb. Either increase memory and limit, change the query or reduce concurrent query load]
 
-import concurrent.futures
-import itertools
+import json
 import os
+import threading
 import time
+from collections.abc import Iterable, Iterator
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import requests
 import sqlalchemy as sa
 from crate import client  # type: ignore
 from dotenv import load_dotenv
 from sqlalchemy_cratedb.support import insert_bulk  # type: ignore
 
-import data_generation
+import config
+import ingest
+import queries
 import utils
-from config import config
 
-load_dotenv(override=True)
+# Table settings applied for the duration of a load, then reset. Disabling the
+# periodic refresh and replication trades read-your-writes for ingest speed.
+INSERT_METHODS = {
+    "to_sql": {"load_settings": {}},
+    "bulk_args": {"load_settings": {}},
+    "bulk_args_tuned": {
+        "load_settings": {"refresh_interval": 0, "number_of_replicas": 0},
+    },
+}
+# Rows per `_sql` response when exporting, so a slice is never held whole
+EXPORT_PAGE_ROWS = 100_000
 
 
 def get_conn():
@@ -72,7 +87,14 @@ def get_conn():
     )
 
 
-def create_table(*, conn, table_name: str) -> None:
+def create_table(
+    *,
+    conn,
+    table_name: str,
+    partition: str | None = "day",
+    shards: int | None = None,
+    replicas: int | str | None = None,
+) -> None:
     # See more about partitions at https://cratedb.com/docs/crate/reference/en/latest/general/ddl/partitioned-tables.html#partitioned-tables
     # See more about shards at https://cratedb.com/docs/crate/reference/en/latest/general/ddl/sharding.html#ddl-sharding
     # See more about replicas at https://cratedb.com/docs/crate/reference/en/latest/general/ddl/replication.html
@@ -80,9 +102,22 @@ def create_table(*, conn, table_name: str) -> None:
     # NOTE: It's recommended to have at least one replica for each shard, but two replicas would provide better fault tolerance.
     # NOTE: Shard size, which should be between approximately 3 and 70 GB.
     # NOTE: Each node should not have more than 1,000 shards.
+    # NOTE: Each partition gets its own set of shards, so the shard count multiplies with the number of partitions.
 
     # TODO: Test configurable storage engine
 
+    partition_column = (
+        f"""partition TIMESTAMP GENERATED ALWAYS AS DATE_TRUNC('{partition}', "time"),"""
+        if partition
+        else ""
+    )
+    primary_key = "time, tag_id, partition" if partition else "time, tag_id"
+    settings = (
+        f"""WITH ("number_of_replicas" = '{replicas}')"""
+        if replicas is not None
+        else ""
+    )
+
     with conn:
         cursor = conn.cursor()
         cursor.execute(
@@ -93,15 +128,13 @@ def create_table(*, conn, table_name: str) -> None:
                 value_float FLOAT,
                 value_str TEXT,
                 value_bool BOOLEAN,
-                partition TIMESTAMP GENERATED ALWAYS AS DATE_TRUNC('day', "time"),
-                PRIMARY KEY (time, tag_id, partition)
+                {partition_column}
+                PRIMARY KEY ({primary_key})
             )
-            -- CLUSTERED INTO 1 SHARDS
-            PARTITIONED BY (partition)
-            -- WITH (
-                -- "number_of_replicas" = 0
-                -- "routing.allocation.require.storage" = 'cold'
-            -- );
+            {f"CLUSTERED INTO {shards} SHARDS" if shards else ""}
+            {"PARTITIONED BY (partition)" if partition else ""}
+            {settings}
+            -- "routing.allocation.require.storage" = 'cold'
             """
         )
 
@@ -112,8 +145,8 @@ def delete_table(*, conn, table_name: str) -> None:
         cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
 
 
-def get_table_size(*, conn, table_name: str) -> int:
-    # Get table size in bytes
+def get_table_size(*, conn, table_name: str, primary_only: bool = False) -> int:
+    # Get table size in bytes (including replicas unless primary_only)
     with conn:
         cursor = conn.cursor()
         cursor.execute(
@@ -124,13 +157,270 @@ def get_table_size(*, conn, table_name: str) -> int:
                 sys.shards
             WHERE
                 table_name = '{table_name}'
+                {"AND primary = true" if primary_only else ""}
             """
         )
         return cursor.fetchone()[0]  # type: ignore
 
 
+def query_downsample(
+    *,
+    conn,
+    table_name: str,
+    tag_ids: list[int],
+    start: str,
+    end: str,
+    interval: str = "1 minute",
+) -> list:
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT
+                DATE_BIN('{interval}'::INTERVAL, "time", 0) AS time,
+                tag_id,
+                AVG(COALESCE(value_float, value_int)) AS value
+            FROM
+                {table_name}
+            WHERE
+                tag_id IN ({", ".join(map(str, tag_ids))})
+                AND "time" >= ?
+                AND "time" < ?
+            GROUP BY
+                1, 2
+            ORDER BY
+                1, 2
+            """,
+            (start, end),
+        )
+        return cursor.fetchall()
+
+
+def build_query(
+    kind: str, *, table_name: str, tag_ids: list[int], start: str, end: str
+) -> str:
+    tags = ", ".join(map(str, tag_ids))
+    time_range = f""""time" >= '{start}' AND "time" < '{end}'"""
+
+    if kind == "point":
+        return f"""
+        SELECT "time", value_int, value_float, value_str, value_bool
+        FROM {table_name}
+        WHERE tag_id = {tag_ids[0]} AND {time_range}
+        ORDER BY "time"
+        """
+
+    if kind == "downsample":
+        return f"""
+        SELECT
+            DATE_BIN('1 minute'::INTERVAL, "time", 0) AS time,
+            tag_id,
+            AVG(COALESCE(value_float, value_int)) AS value
+        FROM {table_name}
+        WHERE tag_id IN ({tags}) AND {time_range}
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        """
+
+    if kind == "last_value":
+        return f"""
+        SELECT tag_id, "time", value_int, value_float, value_str, value_bool
+        FROM (
+            SELECT
+                *,
+                ROW_NUMBER() OVER (PARTITION BY tag_id ORDER BY "time" DESC) AS row_number
+            FROM {table_name}
+            WHERE tag_id IN ({tags})
+        ) x
+        WHERE row_number = 1
+        """
+
+    raise ValueError(f"Unknown query kind {kind}")
+
+
+# No gap-filling functions, the fill is done on the client
+RESAMPLE_FILLS: dict[str, str] = {}
+
+
+def build_resample_query(
+    *,
+    table_name: str,
+    tag_ids: list[int],
+    start: str,
+    end: str,
+    step_s: int,
+    fill: str | None = None,
+) -> str:
+    """
+    First value of every `step_s` bucket, without gap-filling (`fill` is never
+    set, see RESAMPLE_FILLS).
+    """
+    tags = ", ".join(map(str, tag_ids))
+    bucket = f"""DATE_BIN('{step_s} seconds'::INTERVAL, "time", 0)"""
+    return f"""
+    SELECT bucket AS "time", tag_id, value
+    FROM (
+        SELECT
+            {bucket} AS bucket,
+            tag_id,
+            COALESCE(value_float, value_int) AS value,
+            ROW_NUMBER() OVER (PARTITION BY tag_id, {bucket} ORDER BY "time") AS row_number
+        FROM {table_name}
+        WHERE tag_id IN ({tags}) AND "time" >= '{start}' AND "time" < '{end}'
+    ) x
+    WHERE row_number = 1
+    ORDER BY tag_id, bucket
+    """
+
+
+def run_query(conn, sql: str) -> pa.Table:
+    # NOTE: Leaving `with conn` closes the connection, so it's not used here.
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    names = [column[0] for column in cursor.description]
+    table = queries.rows_to_table(names, cursor.fetchall())
+
+    # Timestamps come back as epoch milliseconds
+    if "time" in names and pa.types.is_integer(table.column("time").type):
+        table = table.set_column(
+            names.index("time"),
+            "time",
+            pc.cast(table.column("time"), pa.timestamp("ms")),
+        )
+    return table
+
+
+def export_slice(table_name: str, *, start: str, end: str) -> Iterator[pa.RecordBatch]:
+    """
+    Read the rows in [start, end) through the HTTP `_sql` endpoint, one page
+    of EXPORT_PAGE_ROWS at a time.
+    """
+    host = os.getenv("CRATEDB_HOST")
+    if host is None:
+        raise ValueError("CRATEDB_HOST is not set")
+
+    with requests.Session() as session:
+        session.auth = ("admin", os.getenv("CRATEDB_PASSWORD", ""))
+
+        # Keyset pagination on (time, tag_id), unique in the generated cases, so
+        # every page is an index range instead of an ever larger OFFSET
+        after: list = []
+        while True:
+            response = session.post(
+                f"{host.rstrip('/')}/_sql",
+                json={
+                    "stmt": f"""SELECT "time", tag_id, value_int, value_float, value_str, value_bool
+                        FROM {table_name}
+                        WHERE "time" >= ? AND "time" < ?
+                        {'AND ("time" > ? OR ("time" = ? AND tag_id > ?))' if after else ""}
+                        ORDER BY "time", tag_id
+                        LIMIT {EXPORT_PAGE_ROWS}""",
+                    "args": [start, end, *after],
+                },
+            )
+            response.raise_for_status()
+            result = response.json()
+            if not result["rows"]:
+                break
+
+            # Timestamps come back as epoch milliseconds
+            table = queries.rows_to_table(result["cols"], result["rows"])
+            table = table.set_column(
+                0,
+                "time",
+                pc.cast(pc.cast(table.column("time"), pa.int64()), pa.timestamp("ms")),
+            )
+            yield from table.to_batches()
+
+            if len(result["rows"]) < EXPORT_PAGE_ROWS:
+                break
+            last_time, last_tag_id = result["rows"][-1][:2]
+            after = [last_time, last_time, last_tag_id]
+
+
+def set_table_settings(*, conn, table_name: str, settings: dict) -> None:
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""ALTER TABLE {table_name} SET ({
+                ", ".join(f'"{k}" = {v!r}' for k, v in settings.items())
+            })"""
+        )
+
+
+def reset_table_settings(*, conn, table_name: str, settings: list[str]) -> None:
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""ALTER TABLE {table_name} RESET ({", ".join(f'"{k}"' for k in settings)})"""
+        )
+        cursor.execute(f"REFRESH TABLE {table_name}")
+
+
+def refresh_table(*, conn, table_name: str) -> None:
+    # Make all written rows visible to queries
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(f"REFRESH TABLE {table_name}")
+
+
+def insert_bulk_args(
+    *, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    """
+    Insert Arrow record batches through the HTTP `_sql` endpoint's `bulk_args`.
+
+    Rows are built straight from the Arrow columns, and every worker thread keeps
+    its own keep-alive connection.
+    """
+    host = os.getenv("CRATEDB_HOST")
+    if host is None:
+        raise ValueError("CRATEDB_HOST is not set")
+
+    t_start = time.time()
+
+    local = threading.local()
+
+    def get_session() -> requests.Session:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.auth = ("admin", os.getenv("CRATEDB_PASSWORD", ""))
+        return local.session
+
+    def insert_batch(batch: pa.RecordBatch) -> None:
+        # CrateDB takes timestamps as epoch milliseconds
+        batch = batch.set_column(
+            batch.schema.get_field_index("time"),
+            "time",
+            pc.cast(
+                pc.cast(batch.column("time"), pa.timestamp("ms"), safe=False),
+                pa.int64(),
+            ),
+        )
+        stmt = f"""INSERT INTO {table_name} ({", ".join(batch.schema.names)})
+            VALUES ({", ".join(["?"] * batch.num_columns)})"""
+        bulk_args = list(zip(*[column.to_pylist() for column in batch.columns]))
+
+        response = get_session().post(
+            f"{host.rstrip('/')}/_sql",
+            data=json.dumps({"stmt": stmt, "bulk_args": bulk_args}),
+            headers={"Content-Type": "application/json"},
+        )
+        response.raise_for_status()
+
+        # Failed rows are reported per bulk argument with a rowcount of -2
+        failed = sum(r["rowcount"] == -2 for r in response.json()["results"])
+        if failed:
+            raise RuntimeError(f"{failed} rows failed to insert into {table_name}")
+
+    ingest.map_bounded(insert_batch, batches, workers=workers)
+
+    t_end = time.time()
+    return t_end - t_start
+
+
 def insert_dataframe(
-    *, table_name: str, df: pd.DataFrame, chunksize: int, workers: int
+    *, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
 ) -> float:
     dburi = os.getenv("CRATEDB_CONNECTION_STRING")
     if dburi is None:
@@ -141,79 +431,114 @@ def insert_dataframe(
     engine = sa.create_engine(
         dburi,
         echo=False,  # Change to True to see detailed logging
+        pool_size=workers,
     )
 
-    chunks = []
-    for i in range(0, len(df), chunksize):
-        chunks.append(df.iloc[i : i + chunksize])
-
-    def insert_chunk(chunk):
-        chunk.to_sql(
+    def insert_batch(batch: pa.RecordBatch) -> None:
+        ingest.to_pandas(batch).to_sql(
             name=table_name,
             con=engine,
             if_exists="append",
             index=False,  # Prevent SQLAlchemy from sending CREATE INDEX statements that aren’t needed with CrateDB
-            chunksize=chunksize,
+            chunksize=batch.num_rows,
             method=insert_bulk,
         )
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        executor.map(insert_chunk, chunks)
+    ingest.map_bounded(insert_batch, batches, workers=workers)
 
     t_end = time.time()
     return t_end - t_start
 
 
-def main():
-    load_dotenv(override=True)
+def get_client():
+    return get_conn()
 
-    data = []
 
-    cases = list(
-        itertools.product(
-            config["minutes"],
-            config["workers"],
-            config["tags"],
-            config["seconds_interval"],
-        )
+def reset_table(conn, table_name: str) -> None:
+    # The helpers close the connection they're given
+    delete_table(conn=get_conn(), table_name=table_name)
+    create_table(conn=get_conn(), table_name=table_name)
+
+
+def write_batches(
+    conn, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    insert_time = insert_bulk_args(
+        table_name=table_name, batches=batches, workers=workers
     )
+    # Make the rows visible to the readers right away
+    refresh_table(conn=get_conn(), table_name=table_name)
+    return insert_time
 
-    for minutes, workers, n_tags, seconds_interval in cases:
-        case_name = data_generation.generate_case_name(
-            minutes=minutes,
-            n_tags=n_tags,
-            seconds_interval=seconds_interval,
-        )
 
-        print(case_name)
+def main():
+    load_dotenv(override=True)
+
+    data: dict[tuple[str, int], list[dict]] = {}
 
-        table_name = f"_{case_name}"
+    for case in config.get_cases("cratedb"):
+        case_name, workers = case.name, case.workers
+        print(f"{case_name} ({workers} workers)")
 
-        delete_table(conn=get_conn(), table_name=table_name)
-        create_table(conn=get_conn(), table_name=table_name)
+        table_name = f"_{case_name}"
 
-        df = pd.read_parquet(f"data/{case_name}.parquet")
+        n_rows = ingest.open_case(case_name).metadata.num_rows
+
+        for method, options in INSERT_METHODS.items():
+            print(f"\t{method}")
+            # peak_rss_B is the peak of this run only
+            utils.reset_peak_rss()
+
+            delete_table(conn=get_conn(), table_name=table_name)
+            create_table(conn=get_conn(), table_name=table_name)
+
+            load_settings = options["load_settings"]
+            if load_settings:
+                set_table_settings(
+                    conn=get_conn(), table_name=table_name, settings=load_settings
+                )
+
+            insert = insert_dataframe if method == "to_sql" else insert_bulk_args
+            load_stats: dict = {}
+            insert_time = insert(
+                table_name=table_name,
+                batches=ingest.iter_batches(
+                    ingest.open_case(case_name),
+                    batch_size=case.batch_size,
+                    stats=load_stats,
+                ),
+                workers=workers,
+            )
 
-        insert_time = insert_dataframe(
-            table_name=table_name, df=df, chunksize=250_000, workers=workers
-        )
-        print(f"\t{round(insert_time, 3)} s")
-        print(f"\t{int(len(df) / insert_time)} rows/s")
-        table_size = get_table_size(conn=get_conn(), table_name=table_name)
-
-        data.append(
-            {
-                "n_tags": n_tags,
-                "seconds_interval": seconds_interval,
-                "data_points": len(df),
-                "table_size_B": table_size,
-                "insert_time_s": insert_time,
-            }
-        )
+            t_start = time.time()
+            if load_settings:
+                reset_table_settings(
+                    conn=get_conn(), table_name=table_name, settings=list(load_settings)
+                )
+            refresh_time = time.time() - t_start
+
+            print(f"\t\t{round(insert_time, 3)} s")
+            print(f"\t\t{int(n_rows / insert_time)} rows/s")
+            table_size = get_table_size(conn=get_conn(), table_name=table_name)
+
+            data.setdefault((method, workers), []).append(
+                {
+                    "n_tags": case.n_tags,
+                    "seconds_interval": case.seconds_interval,
+                    "data_points": n_rows,
+                    "table_size_B": table_size,
+                    "insert_time_s": insert_time,
+                    "refresh_time_s": refresh_time,
+                    "load_time_s": round(load_stats["load_time_s"], 3),
+                    "peak_rss_B": utils.get_peak_rss(),
+                }
+            )
 
-    df_stats = pd.DataFrame(data)
-    file_name = f"data_stats/cratedb_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
-    df_stats.to_csv(file_name, index=False)
+    for (method, workers), rows in data.items():
+        df_stats = pd.DataFrame(rows)
+        prefix = "cratedb" if method == "to_sql" else f"cratedb_{method}"
+        file_name = f"data_stats/{prefix}_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+        df_stats.to_csv(file_name, index=False)
 
 
 if __name__ == "__main__":
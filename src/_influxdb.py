@@ -1,61 +1,200 @@
 import concurrent.futures
-import itertools
+import gzip
 import os
 import time
+from collections.abc import Iterable, Iterator
 
 import pandas as pd
+import pyarrow as pa
 import requests
 from dotenv import load_dotenv
 from influxdb_client_3 import InfluxDBClient3
+from pyarrow import flight
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-import data_generation
+import config
+import ingest
+import line_protocol
 import utils
-from config import config
 
+HOST = "https://us-east-1-1.aws.cloud2.influxdata.com"
+ORG = "Project Data"
+BUCKET = "data_timeseries"
 
-def get_bucket_id(*, bucket_name: str) -> str | None:
-    response = requests.get(
-        "https://us-east-1-1.aws.cloud2.influxdata.com/api/v2/buckets",
-        headers={
-            "Authorization": f"Token {os.getenv('INFLUXDB_TOKEN')}",
-            "Content-Type": "application/json",
-        },
-    )
-    response.raise_for_status()
+# Serverless has no delete API, so a measurement can't be emptied. reset_table
+# switches the table to a fresh measurement instead, named after the reset.
+_measurements: dict[str, str] = {}
 
-    data = response.json()
 
-    for b in data["buckets"]:
-        if b["name"] == bucket_name:
-            return b["id"]
+class InfluxDBAdmin:
+    """
+    Pooled HTTP client for the InfluxDB management API (buckets, orgs, InfluxQL).
 
-    return None
+    Bucket metadata is cached for `cache_ttl_s` seconds so per-case setup and
+    teardown don't pay a round trip (or several pages of them) every time.
+    """
 
+    def __init__(
+        self,
+        *,
+        host: str,
+        token: str,
+        pool_size: int = 4,
+        retries: int = 3,
+        cache_ttl_s: float = 60.0,
+        timeout_s: float = 30.0,
+        page_size: int = 100,
+    ) -> None:
+        self.host = host.rstrip("/")
+        self.cache_ttl_s = cache_ttl_s
+        self.timeout_s = timeout_s
+        self.page_size = page_size
+
+        # Keep-alive connections, retrying idempotent requests on throttling
+        # and transient server errors (POST is excluded by urllib3's defaults)
+        adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Token {token}"})
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._buckets: dict[str, dict] = {}
+        self._buckets_expire_at = 0.0
+        self._org_ids: dict[str, str] = {}
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        response = self.session.request(
+            method, f"{self.host}{path}", timeout=self.timeout_s, **kwargs
+        )
+        response.raise_for_status()
+        return response
+
+    def close(self) -> None:
+        self.session.close()
+
+    def get_org_id(self, *, org: str) -> str:
+        if org not in self._org_ids:
+            org_id = os.getenv("INFLUXDB_ORG_ID")
+            if org_id is None:
+                try:
+                    orgs = self.request(
+                        "GET", "/api/v2/orgs", params={"org": org}
+                    ).json()
+                except requests.HTTPError as e:
+                    # Unknown names are a 404 on some versions, an empty list on others
+                    if e.response is None or e.response.status_code != 404:
+                        raise
+                    orgs = {}
+                if not orgs.get("orgs"):
+                    raise ValueError(
+                        f"InfluxDB org {org!r} not found, check ORG or set INFLUXDB_ORG_ID"
+                    )
+                org_id = orgs["orgs"][0]["id"]
+            self._org_ids[org] = org_id
+        return self._org_ids[org]
+
+    def list_buckets(self, *, refresh: bool = False) -> dict[str, dict]:
+        """
+        Get all buckets keyed by name, following pagination.
+        """
+        if refresh or time.monotonic() >= self._buckets_expire_at:
+            buckets: dict[str, dict] = {}
+            offset = 0
+            while True:
+                page = self.request(
+                    "GET",
+                    "/api/v2/buckets",
+                    params={"limit": self.page_size, "offset": offset},
+                ).json()["buckets"]
+                for b in page:
+                    buckets[b["name"]] = b
+                if len(page) < self.page_size:
+                    break
+                offset += len(page)
+
+            self._buckets = buckets
+            self._buckets_expire_at = time.monotonic() + self.cache_ttl_s
+
+        return self._buckets
+
+    def get_bucket_id(self, *, bucket_name: str) -> str | None:
+        bucket = self.list_buckets().get(bucket_name)
+        return bucket["id"] if bucket else None
+
+    def create_bucket(
+        self, *, bucket_name: str, org_id: str, retention_s: int = 0
+    ) -> str:
+        bucket = self.request(
+            "POST",
+            "/api/v2/buckets",
+            json={
+                "orgID": org_id,
+                "name": bucket_name,
+                "retentionRules": [{"type": "expire", "everySeconds": retention_s}],
+            },
+        ).json()
+        self._buckets[bucket_name] = bucket
+        return bucket["id"]
+
+    def delete_bucket(self, *, bucket_id: str) -> None:
+        self.request("DELETE", f"/api/v2/buckets/{bucket_id}")
+        self._buckets = {
+            name: b for name, b in self._buckets.items() if b["id"] != bucket_id
+        }
+
+    def query_influxql(self, *, database: str, query: str) -> list[dict]:
+        """
+        Run an InfluxQL query through the v1 compatibility endpoint.
+        """
+        response = self.request(
+            "GET", "/query", params={"db": database, "q": query}
+        ).json()
+        return response["results"]
+
+    def get_measurement_row_count(self, *, bucket: str, measurement: str) -> int:
+        # COUNT(*) counts each field separately. Every row carries exactly one
+        # non-null value column, so the sum over fields is the row count.
+        results = self.query_influxql(
+            database=bucket, query=f'SELECT COUNT(*) FROM "{measurement}"'
+        )
+        series = results[0].get("series")
+        if not series:
+            return 0
+        return sum(v or 0 for v in series[0]["values"][0][1:])
 
-def create_bucket(*, bucket_name: str) -> None:
-    response = requests.post(
-        "https://us-east-1-1.aws.cloud2.influxdata.com/api/v2/buckets",
-        headers={
-            "Authorization": f"Token {os.getenv('INFLUXDB_TOKEN')}",
-            "Content-Type": "application/json",
-        },
-        json={
-            "orgID": "417ef56b0722c876",
-            "name": bucket_name,
-            "retentionRules": [{"type": "expire", "everySeconds": 0}],
-        },
-    )
-    response.raise_for_status()
 
-    return response.json()["id"]
+def get_measurement_size(client, measurement: str) -> int | None:
+    """
+    Get the stored size of a measurement (in bytes).
 
+    Only Cloud Dedicated/Clustered expose `system.partitions`; on Serverless the
+    query fails and None is returned.
+    """
+    try:
+        result = client.query(
+            query=f"""
+            SELECT SUM(total_size_mb) AS size_mb
+            FROM system.partitions
+            WHERE table_name = '{measurement}'
+            """,
+            language="sql",
+            headers=[(b"iox-debug", b"true")],
+        )
+    except flight.FlightError:
+        return None
 
-def delete_bucket(*, bucket_id: str) -> None:
-    response = requests.delete(
-        f"https://us-east-1-1.aws.cloud2.influxdata.com/api/v2/buckets/{bucket_id}",
-        headers={"Authorization": f"Token {os.getenv('INFLUXDB_TOKEN')}"},
-    )
-    response.raise_for_status()
+    size_mb = result.column("size_mb")[0].as_py()
+    return None if size_mb is None else int(size_mb * 1024 * 1024)
 
 
 def insert_dataframe(
@@ -94,94 +233,281 @@ def insert_dataframe(
     return round(t_end - t_start, 3)
 
 
+def insert_line_protocol(
+    *,
+    admin: InfluxDBAdmin,
+    bucket: str,
+    org: str,
+    measurement: str,
+    batches: Iterable[pa.RecordBatch],
+    workers: int,
+    compresslevel: int = 1,
+    checkpoint: ingest.Checkpoint | None = None,
+) -> float:
+    """
+    Insert Arrow record batches into InfluxDB Cloud as gzipped line protocol.
+
+    Batches are encoded and compressed in the worker threads (both release the
+    GIL) and posted over the admin client's pooled keep-alive connections.
+    Writing the same points again overwrites them, so failed chunks are retried.
+    """
+    t_start = time.time()
+
+    def insert_chunk(index: int, batch: pa.RecordBatch) -> None:
+        payload = line_protocol.encode_batch(
+            batch, measurement=measurement, tag_columns=["tag_id"]
+        )
+        admin.request(
+            "POST",
+            "/api/v2/write",
+            params={"bucket": bucket, "org": org, "precision": "ns"},
+            data=gzip.compress(payload, compresslevel=compresslevel),
+            headers={
+                "Content-Encoding": "gzip",
+                "Content-Type": "text/plain; charset=utf-8",
+            },
+        )
+
+    ingest.write_chunks(insert_chunk, batches, workers=workers, checkpoint=checkpoint)
+
+    t_end = time.time()
+    return round(t_end - t_start, 3)
+
+
+def build_query(
+    kind: str, *, table_name: str, tag_ids: list[int], start: str, end: str
+) -> str:
+    # Measurements are tables and tag_id is a tag, i.e. a string
+    tags = ", ".join(f"'{tag_id}'" for tag_id in tag_ids)
+    time_range = f"time >= '{start}' AND time < '{end}'"
+    table_name = get_measurement(table_name)
+
+    if kind == "point":
+        return f"""
+        SELECT time, value_int, value_float, value_str, value_bool
+        FROM "{table_name}"
+        WHERE tag_id = '{tag_ids[0]}' AND {time_range}
+        ORDER BY time
+        """
+
+    if kind == "downsample":
+        return f"""
+        SELECT
+            date_bin(INTERVAL '1 minute', time) AS time,
+            tag_id,
+            first_value(value_float ORDER BY time) AS value_float
+        FROM "{table_name}"
+        WHERE tag_id IN ({tags}) AND {time_range}
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+        """
+
+    if kind == "last_value":
+        return f"""
+        SELECT
+            tag_id,
+            max(time) AS time,
+            last_value(value_int ORDER BY time) AS value_int,
+            last_value(value_float ORDER BY time) AS value_float,
+            last_value(value_str ORDER BY time) AS value_str,
+            last_value(value_bool ORDER BY time) AS value_bool
+        FROM "{table_name}"
+        WHERE tag_id IN ({tags})
+        GROUP BY tag_id
+        """
+
+    raise ValueError(f"Unknown query kind {kind}")
+
+
+# date_bin_gapfill isn't used, the fill is done on the client
+RESAMPLE_FILLS: dict[str, str] = {}
+
+
+def build_resample_query(
+    *,
+    table_name: str,
+    tag_ids: list[int],
+    start: str,
+    end: str,
+    step_s: int,
+    fill: str | None = None,
+) -> str:
+    """
+    First value of every `step_s` bucket, without gap-filling (`fill` is never
+    set, see RESAMPLE_FILLS).
+    """
+    tags = ", ".join(f"'{tag_id}'" for tag_id in tag_ids)
+    return f"""
+    SELECT
+        date_bin(INTERVAL '{step_s} seconds', time) AS time,
+        tag_id,
+        first_value(
+            coalesce(value_float, CAST(value_int AS DOUBLE)) ORDER BY time
+        ) AS value
+    FROM "{get_measurement(table_name)}"
+    WHERE tag_id IN ({tags}) AND time >= '{start}' AND time < '{end}'
+    GROUP BY 1, 2
+    ORDER BY 2, 1
+    """
+
+
+def run_query(client, sql: str) -> pa.Table:
+    return client.query(query=sql, language="sql")
+
+
+def export_slice(table_name: str, *, start: str, end: str) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the rows in [start, end) over Flight SQL.
+    """
+    client = get_client()
+    try:
+        reader = client.query(
+            query=f"""
+            SELECT time, tag_id, value_int, value_float, value_str, value_bool
+            FROM "{get_measurement(table_name)}"
+            WHERE time >= '{start}' AND time < '{end}'
+            """,
+            language="sql",
+            mode="reader",
+        )
+        yield from reader
+    finally:
+        client.close()
+
+
+def get_client():
+    return InfluxDBClient3(
+        host=os.getenv("INFLUXDB_HOST", HOST),
+        token=os.getenv("INFLUXDB_TOKEN"),
+        org=ORG,
+        database=BUCKET,
+    )
+
+
+def get_measurement(table_name: str) -> str:
+    """
+    Get the measurement of the last reset_table(table_name) in this process, or
+    the table name itself.
+    """
+    return _measurements.get(table_name, table_name)
+
+
+def reset_table(client, table_name: str) -> None:
+    admin = InfluxDBAdmin(
+        host=os.getenv("INFLUXDB_HOST", HOST), token=os.getenv("INFLUXDB_TOKEN", "")
+    )
+    try:
+        if admin.get_bucket_id(bucket_name=BUCKET) is None:
+            admin.create_bucket(bucket_name=BUCKET, org_id=admin.get_org_id(org=ORG))
+    finally:
+        admin.close()
+    _measurements[table_name] = f"{table_name}_{time.time_ns()}"
+
+
+def write_batches(
+    client, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    admin = InfluxDBAdmin(
+        host=os.getenv("INFLUXDB_HOST", HOST),
+        token=os.getenv("INFLUXDB_TOKEN", ""),
+        pool_size=workers,
+    )
+    try:
+        return insert_line_protocol(
+            admin=admin,
+            bucket=BUCKET,
+            org=ORG,
+            measurement=get_measurement(table_name),
+            batches=batches,
+            workers=workers,
+        )
+    finally:
+        admin.close()
+
+
 def main():
     load_dotenv(override=True)
 
     token = os.getenv("INFLUXDB_TOKEN")
-    org = "Project Data"
-    host = "https://us-east-1-1.aws.cloud2.influxdata.com"
-    client = InfluxDBClient3(
-        host=host, token=token, org=org, database="data_timeseries"
+    org = ORG
+    host = os.getenv("INFLUXDB_HOST", HOST)
+    client = get_client()
+
+    cases = config.get_cases("influxdb")
+    admin = InfluxDBAdmin(
+        host=host,
+        token=token,
+        pool_size=max((case.workers for case in cases), default=1),
     )
 
-    bucket_name = "data_timeseries"
-    bucket_id = get_bucket_id(bucket_name=bucket_name)
+    bucket_name = BUCKET
+    bucket_id = admin.get_bucket_id(bucket_name=bucket_name)
     if bucket_id:
-        delete_bucket(bucket_id=bucket_id)
-    create_bucket(bucket_name=bucket_name)
-
-    data = []
+        admin.delete_bucket(bucket_id=bucket_id)
+    admin.create_bucket(bucket_name=bucket_name, org_id=admin.get_org_id(org=org))
+
+    data: dict[int, list[dict]] = {}
+
+    # Failed chunks are retried by the writer, anything else stops the run
+    for case in cases:
+        case_name, workers = case.name, case.workers
+        print(f"{case_name} ({workers} workers)")
+
+        table_name = case_name
+        # peak_rss_B is the peak of this run only
+        utils.reset_peak_rss()
+
+        parquet_file = ingest.open_case(case_name)
+        n_rows = parquet_file.metadata.num_rows
+
+        # Set month of all times to April (month 4)
+        t_min, _ = ingest.get_time_range(parquet_file)
+        offset = ingest.get_month_offset(t_min, month=4)
+
+        load_stats: dict = {}
+        insert_time = insert_line_protocol(
+            admin=admin,
+            bucket=bucket_name,
+            org=org,
+            measurement=table_name,
+            batches=(
+                ingest.shift_time(batch, offset)
+                for batch in ingest.iter_batches(
+                    parquet_file, batch_size=case.batch_size, stats=load_stats
+                )
+            ),
+            workers=workers,
+        )
+        print(
+            f"\t{round(insert_time, 3)} s ({round(load_stats['load_time_s'], 3)} s loading)"
+        )
+        print(f"\t{int(n_rows / insert_time)} rows/s")
 
-    cases = list(
-        itertools.product(
-            config["minutes"],
-            config["workers"],
-            config["tags"],
-            config["seconds_interval"],
+        row_count = admin.get_measurement_row_count(
+            bucket=bucket_name, measurement=table_name
+        )
+        table_size = get_measurement_size(client, table_name)
+
+        data.setdefault(workers, []).append(
+            {
+                "n_tags": case.n_tags,
+                "seconds_interval": case.seconds_interval,
+                "data_points": n_rows,
+                "row_count": row_count,
+                "table_size_B": table_size,
+                "insert_time_s": insert_time,
+                "load_time_s": round(load_stats["load_time_s"], 3),
+                "peak_rss_B": utils.get_peak_rss(),
+            }
         )
-    )
 
-    for minutes, workers, n_tags, seconds_interval in cases:
-        try:
-            case_name = data_generation.generate_case_name(
-                minutes=minutes,
-                n_tags=n_tags,
-                seconds_interval=seconds_interval,
-            )
-
-            print(case_name)
-
-            table_name = case_name
-
-            df = pd.read_parquet(f"data/{case_name}.parquet")
-            df["time"] = pd.to_datetime(df["time"])
-            # Set month of all times to April (month 4)
-            df["time"] = df["time"].apply(lambda x: x.replace(month=4))
-
-            insert_time = insert_dataframe(
-                client=client,
-                bucket=table_name,
-                org=org,
-                measurement=table_name,
-                df=df,
-                workers=workers,
-            )
-            print(f"\t{round(insert_time, 3)} s")
-            print(f"\t{int(len(df) / insert_time)} rows/s")
-
-            data.append(
-                {
-                    "n_tags": n_tags,
-                    "seconds_interval": seconds_interval,
-                    "data_points": len(df),
-                    # "table_size_B": table_size,
-                    "insert_time_s": insert_time,
-                }
-            )
-        except Exception as e:
-            print(f"Error: {e}")
-
-    df_stats = pd.DataFrame(data)
-    file_name = f"data_stats/influxdb_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
-    df_stats.to_csv(file_name, index=False)
+    admin.close()
+
+    for workers, rows in data.items():
+        df_stats = pd.DataFrame(rows)
+        file_name = f"data_stats/influxdb_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+        df_stats.to_csv(file_name, index=False)
 
 
 if __name__ == "__main__":
     main()
-
-
-# def delete_measurement(*, bucket: str, org: str, measurement: str) -> None:
-#     response = requests.post(
-#         "https://us-east-1-1.aws.cloud2.influxdata.com/api/v2/delete",
-#         headers={"Authorization": f"Token {os.getenv('INFLUXDB_TOKEN')}"},
-#         params={
-#             "bucket": bucket,
-#             # "org": "417ef56b0722c876",
-#         },
-#         json={
-#             "start": "2019-08-24T14:15:22Z",
-#             "stop": "2025-08-24T14:15:22Z",
-#             "predicate": '_measurement = "5_minutes_of_1000_tags_at_300_second_intervals"',
-#         },
-#     )
-#     response.raise_for_status()
@@ -1,16 +1,52 @@
+import concurrent.futures
+import itertools
 import os
+import queue
 import time
+from collections.abc import Iterable, Iterator
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 import psycopg2
+import requests
 from dotenv import load_dotenv
 from questdb.ingress import Sender  # type: ignore
 
-import data_generation  # type: ignore
-from config import config  # type: ignore
+import config  # type: ignore
+import ingest  # type: ignore
+import queries  # type: ignore
+import utils  # type: ignore
 
+# ILP transports and their default ports
+PROTOCOLS = {
+    "http": 9000,
+    "tcp": 9009,
+}
 
-def create_table(*, cursor: psycopg2.extensions.cursor, table_name: str) -> None:
+# DEDUP requires WAL, so the dedup cost is the difference between the first two
+# and the WAL cost the difference between the last two.
+# NOTE: Non-WAL tables only accept one writer at a time, so parallel senders
+# queue up behind each other there.
+TABLE_MODES = {
+    "wal_dedup": {"wal": True, "dedup": True},
+    "wal": {"wal": True, "dedup": False},
+    "bypass_wal": {"wal": False, "dedup": False},
+}
+
+AUTO_FLUSH_ROWS = 75_000
+AUTO_FLUSH_BYTES = 16 * 1024 * 1024
+
+
+def create_table(
+    *,
+    cursor: psycopg2.extensions.cursor,
+    table_name: str,
+    wal: bool = True,
+    dedup: bool = True,
+) -> None:
     # === tag_id SYMBOL ===
     # See more at https://questdb.com/docs/concept/indexes/
 
@@ -25,6 +61,9 @@ def create_table(*, cursor: psycopg2.extensions.cursor, table_name: str) -> None
     # In order to ensure there are not duplicate (time, tag_id) values, we use the WAL and DEDUP options.
     # This will potentially have a negative impact on the write performance.
     # See more at https://questdb.com/docs/concept/deduplication/
+    if dedup and not wal:
+        raise ValueError("DEDUP requires a WAL table")
+
     cursor.execute(
         f"""
         CREATE TABLE IF NOT EXISTS {table_name} (
@@ -34,8 +73,8 @@ def create_table(*, cursor: psycopg2.extensions.cursor, table_name: str) -> None
             value_float DOUBLE NULL,
             value_str STRING NULL,
             value_bool INT NULL
-        ) TIMESTAMP(time) PARTITION BY DAY WAL
-        DEDUP UPSERT KEYS(time, tag_id);
+        ) TIMESTAMP(time) PARTITION BY DAY {"WAL" if wal else "BYPASS WAL"}
+        {"DEDUP UPSERT KEYS(time, tag_id)" if dedup else ""};
         """
     )
 
@@ -52,55 +91,365 @@ def get_table_size(*, cursor: psycopg2.extensions.cursor, table_name: str) -> in
     return res[0]  # type: ignore
 
 
-def insert_dataframe(*, table_name: str, df: pd.DataFrame) -> float:
+def get_row_count(*, cursor: psycopg2.extensions.cursor, table_name: str) -> int:
+    cursor.execute(f"SELECT count() FROM {table_name};")
+    res = cursor.fetchone()  # type: ignore
+    return res[0]  # type: ignore
+
+
+def wait_for_wal(
+    *, cursor: psycopg2.extensions.cursor, table_name: str, timeout_s: float = 600
+) -> None:
+    """
+    Block until all committed WAL transactions are applied to the table.
+
+    Non-WAL tables have no row in `wal_tables()` and return immediately.
+    """
+    t_end = time.time() + timeout_s
+    while time.time() < t_end:
+        cursor.execute(
+            f"""
+            SELECT writerTxn, sequencerTxn, suspended
+            FROM wal_tables()
+            WHERE name = '{table_name}';
+            """
+        )
+        res = cursor.fetchone()
+        if res is None or res[0] >= res[1]:
+            return
+        if res[2]:
+            raise RuntimeError(f"WAL apply is suspended for {table_name}")
+        time.sleep(0.1)
+
+    raise TimeoutError(f"WAL for {table_name} not applied after {timeout_s} s")
+
+
+def split_by_time(
+    batch: pa.RecordBatch, n: int, time_range: tuple | None
+) -> list[pa.RecordBatch]:
+    """
+    Split a batch into `n` slices by time, slice i holding the rows of the i-th
+    of `n` equal parts of `time_range`. Without a range, rows are dealt out by
+    the minute, round robin.
+    """
+    times = pc.cast(pc.cast(batch.column("time"), pa.timestamp("ns")), pa.int64())
+    times = times.to_numpy(zero_copy_only=False)
+    if time_range is None:
+        slots = times // 60_000_000_000 % n
+    else:
+        t_min, t_max = (pd.Timestamp(t).value for t in time_range)
+        slots = np.clip((times - t_min) * n // (t_max - t_min + 1), 0, n - 1)
+    return [batch.filter(pa.array(slots == i)) for i in range(n)]
+
+
+def insert_batches(
+    *,
+    table_name: str,
+    batches: Iterable[pa.RecordBatch],
+    workers: int = 1,
+    protocol: str = "http",
+    auto_flush_rows: int = AUTO_FLUSH_ROWS,
+    auto_flush_bytes: int = AUTO_FLUSH_BYTES,
+    time_range: tuple | None = None,
+) -> float:
+    """
+    Insert Arrow record batches with one ILP sender per worker.
+
+    Every batch is split by time (see `split_by_time`) and each slice queued
+    for the sender that owns its time range, so the senders write time-disjoint
+    slices and no two of them commit into the same range. Pass the case's
+    `time_range` to give every sender one contiguous range; the cases are in
+    arrival order, so a batch alone doesn't tell where the data ends.
+    """
     t_start = time.time()
-    # Convert value_bool to Int32 before inserting
-    df["value_bool"] = df["value_bool"].astype("Int32")
-    conf = "http::addr=localhost:9000;"
-    with Sender.from_conf(conf) as sender:
-        sender.dataframe(df, table_name=table_name, at="time")
+    conf = (
+        f"{protocol}::addr={os.getenv('QUESTDB_HOST', 'localhost')}:{PROTOCOLS[protocol]};"
+        f"auto_flush_rows={auto_flush_rows};auto_flush_bytes={auto_flush_bytes};"
+    )
+
+    def run_sender(slices: queue.Queue) -> None:
+        sender = Sender.from_conf(conf)
+        sender.establish()
+        try:
+            while (batch := slices.get()) is not None:
+                df = ingest.to_pandas(batch)
+                # Convert value_bool to Int32 before inserting
+                if "value_bool" in df:
+                    df["value_bool"] = df["value_bool"].astype("Int32")
+                sender.dataframe(df, table_name=table_name, at="time")
+        finally:
+            # Closing flushes whatever is left below the auto-flush thresholds
+            sender.close()
+
+    # A couple of slices per sender in flight keeps memory bounded
+    queues = [queue.Queue(maxsize=2) for _ in range(workers)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_sender, slices) for slices in queues]
+
+        def put(i: int, item: pa.RecordBatch | None) -> bool:
+            # A sender only stops early when it failed, don't wait for it then
+            while not futures[i].done():
+                try:
+                    queues[i].put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for batch in batches:
+                slices = split_by_time(batch, workers, time_range)
+                if not all(put(i, s) for i, s in enumerate(slices) if s.num_rows):
+                    break
+        finally:
+            for i in range(workers):
+                put(i, None)
+        for future in futures:
+            future.result()
+
     t_end = time.time()
     return round(t_end - t_start, 3)
 
 
+def build_query(
+    kind: str, *, table_name: str, tag_ids: list[int], start: str, end: str
+) -> str:
+    # tag_id is a SYMBOL, so it is compared as a string
+    tags = ", ".join(f"'{tag_id}'" for tag_id in tag_ids)
+    time_range = f"time >= '{start}' AND time < '{end}'"
+
+    if kind == "point":
+        return f"""
+        SELECT time, value_int, value_float, value_str, value_bool
+        FROM {table_name}
+        WHERE tag_id = '{tag_ids[0]}' AND {time_range};
+        """
+
+    if kind == "downsample":
+        return f"""
+        SELECT time, tag_id, first(value_float) AS value_float
+        FROM {table_name}
+        WHERE tag_id IN ({tags}) AND {time_range}
+        SAMPLE BY 1m ALIGN TO CALENDAR;
+        """
+
+    if kind == "last_value":
+        return f"""
+        SELECT tag_id, time, value_int, value_float, value_str, value_bool
+        FROM {table_name}
+        WHERE tag_id IN ({tags})
+        LATEST ON time PARTITION BY tag_id;
+        """
+
+    raise ValueError(f"Unknown query kind {kind}")
+
+
+def build_latest_query(table_name: str, *, snapshot: bool) -> str:
+    """
+    Latest row of every tag, with LATEST ON or aggregated from the raw table.
+    """
+    if snapshot:
+        return f"""
+        SELECT tag_id, time, value_int, value_float, value_str, value_bool
+        FROM {table_name}
+        LATEST ON time PARTITION BY tag_id;
+        """
+
+    return f"""
+    SELECT
+        tag_id,
+        max(time) AS time,
+        last(value_int) AS value_int,
+        last(value_float) AS value_float,
+        last(value_str) AS value_str,
+        last(value_bool) AS value_bool
+    FROM {table_name};
+    """
+
+
+# Only FILL(PREV) is pushed down, linear is filled on the client so the edges
+# match the other backends
+RESAMPLE_FILLS = {"locf": "PREV"}
+
+
+def build_resample_query(
+    *,
+    table_name: str,
+    tag_ids: list[int],
+    start: str,
+    end: str,
+    step_s: int,
+    fill: str | None = None,
+) -> str:
+    """
+    First value of every `step_s` bucket, gap-filled on the server with `fill`.
+    """
+    # NOTE: Buckets without a row for any tag are left out even with FILL.
+    tags = ", ".join(f"'{tag_id}'" for tag_id in tag_ids)
+    return f"""
+    SELECT
+        time,
+        tag_id,
+        first(coalesce(value_float, cast(value_int AS DOUBLE))) AS value
+    FROM {table_name}
+    WHERE tag_id IN ({tags}) AND time >= '{start}' AND time < '{end}'
+    SAMPLE BY {step_s}s {f"FILL({RESAMPLE_FILLS[fill]})" if fill else ""} ALIGN TO CALENDAR;
+    """
+
+
+def run_query(conn, sql: str) -> pa.Table:
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+        names = [column.name for column in cursor.description]
+        return queries.rows_to_table(names, cursor.fetchall())
+
+
+def export_slice(table_name: str, *, start: str, end: str) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the rows in [start, end) as CSV from the HTTP `/exp` endpoint.
+    """
+    response = requests.get(
+        f"http://{os.getenv('QUESTDB_HOST', 'localhost')}:{PROTOCOLS['http']}/exp",
+        params={
+            "query": f"""
+            SELECT time, tag_id, value_int, value_float, value_str, value_bool
+            FROM {table_name}
+            WHERE time >= '{start}' AND time < '{end}'
+            """
+        },
+        stream=True,
+    )
+    response.raise_for_status()
+    response.raw.decode_content = True
+
+    with response:
+        yield from pa_csv.open_csv(
+            response.raw,
+            convert_options=pa_csv.ConvertOptions(
+                column_types={
+                    "time": pa.timestamp("us", tz="UTC"),
+                    "tag_id": pa.string(),
+                    "value_int": pa.int32(),
+                    "value_float": pa.float64(),
+                    "value_str": pa.string(),
+                    "value_bool": pa.int32(),
+                },
+                strings_can_be_null=True,
+            ),
+        )
+
+
+def get_client():
+    conn = psycopg2.connect(os.getenv("QUEST_CONNECTION_STRING"))
+    conn.autocommit = True
+    return conn
+
+
+def reset_table(conn, table_name: str) -> None:
+    with conn.cursor() as cursor:
+        delete_table(cursor=cursor, table_name=table_name)
+        create_table(cursor=cursor, table_name=table_name)
+
+
+def write_batches(
+    conn, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    # The ILP senders are separate from the PostgreSQL wire connection
+    insert_time = insert_batches(
+        table_name=table_name, batches=batches, workers=workers
+    )
+    # Make the rows visible to the readers right away
+    with conn.cursor() as cursor:
+        wait_for_wal(cursor=cursor, table_name=table_name)
+    return insert_time
+
+
+def create_latest_table(conn, table_name: str) -> None:
+    # LATEST ON finds the latest rows through the tag_id SYMBOL, there is no
+    # snapshot to maintain
+    pass
+
+
+def write_latest(
+    conn, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    # Unlike write_batches this doesn't wait for the WAL, LATEST ON sees the
+    # rows once they're applied, which is the lag latest.py measures
+    return insert_batches(table_name=table_name, batches=batches, workers=workers)
+
+
 def main():
     load_dotenv(override=True)
 
-    data = []
-
-    for minutes in config["minutes"]:
-        for n_tags in config["tags"]:
-            for seconds_interval in config["seconds_interval"]:
-                case_name = data_generation.generate_case_name(
-                    minutes=minutes, n_tags=n_tags, seconds_interval=seconds_interval
-                )
-                print(case_name)
-
-                table_name = f"_{case_name}"
-
-                df = pd.read_parquet(f"data/{case_name}.parquet")
-
-                # Connect to QuestDB via PostgreSQL wire protocol
-                with psycopg2.connect(os.getenv("QUEST_CONNECTION_STRING")) as conn:
-                    with conn.cursor() as cursor:
-                        delete_table(cursor=cursor, table_name=table_name)
-                        create_table(cursor=cursor, table_name=table_name)
-                        insert_time = insert_dataframe(table_name=table_name, df=df)
-                        table_size = get_table_size(
-                            cursor=cursor, table_name=table_name
-                        )
-                        data.append(
-                            {
-                                "n_tags": n_tags,
-                                "seconds_interval": seconds_interval,
-                                "data_points": len(df),
-                                "table_size_B": table_size,
-                                "insert_time_s": insert_time,
-                            }
-                        )
-
-    df_stats = pd.DataFrame(data)
-    df_stats.to_csv("data_stats/questdb.csv", index=False)
+    data: dict[tuple[str, str, int], list[dict]] = {}
+
+    for case in config.get_cases("questdb"):
+        case_name, workers = case.name, case.workers
+        print(f"{case_name} ({workers} workers)")
+
+        table_name = f"_{case_name}"
+
+        n_rows = ingest.open_case(case_name).metadata.num_rows
+
+        for protocol, mode in itertools.product(PROTOCOLS, TABLE_MODES):
+            print(f"\t{protocol} {mode}")
+            # peak_rss_B is the peak of this run only
+            utils.reset_peak_rss()
+
+            # Connect to QuestDB via PostgreSQL wire protocol
+            with psycopg2.connect(os.getenv("QUEST_CONNECTION_STRING")) as conn:
+                with conn.cursor() as cursor:
+                    delete_table(cursor=cursor, table_name=table_name)
+                    create_table(
+                        cursor=cursor, table_name=table_name, **TABLE_MODES[mode]
+                    )
+
+                    load_stats: dict = {}
+                    t_start = time.time()
+                    insert_time = insert_batches(
+                        table_name=table_name,
+                        batches=ingest.iter_batches(
+                            ingest.open_case(case_name),
+                            batch_size=case.batch_size,
+                            stats=load_stats,
+                        ),
+                        workers=workers,
+                        protocol=protocol,
+                        time_range=ingest.get_time_range(ingest.open_case(case_name)),
+                    )
+                    # With WAL the rows are only queryable once applied
+                    wait_for_wal(cursor=cursor, table_name=table_name)
+                    visible_time = round(time.time() - t_start, 3)
+
+                    print(f"\t\t{insert_time} s ({visible_time} s until visible)")
+                    print(f"\t\t{int(n_rows / visible_time)} rows/s")
+
+                    table_size = get_table_size(cursor=cursor, table_name=table_name)
+                    # The slices of parallel senders must neither be lost nor,
+                    # with DEDUP, kept twice
+                    row_count = get_row_count(cursor=cursor, table_name=table_name)
+                    if row_count != n_rows:
+                        print(f"\t\t{row_count} rows in the table, expected {n_rows}")
+                    data.setdefault((protocol, mode, workers), []).append(
+                        {
+                            "n_tags": case.n_tags,
+                            "seconds_interval": case.seconds_interval,
+                            "data_points": n_rows,
+                            "row_count": row_count,
+                            "table_size_B": table_size,
+                            "insert_time_s": insert_time,
+                            "visible_time_s": visible_time,
+                            "load_time_s": round(load_stats["load_time_s"], 3),
+                            "peak_rss_B": utils.get_peak_rss(),
+                            "auto_flush_rows": AUTO_FLUSH_ROWS,
+                            "auto_flush_bytes": AUTO_FLUSH_BYTES,
+                        }
+                    )
+
+    for (protocol, mode, workers), rows in data.items():
+        df_stats = pd.DataFrame(rows)
+        file_name = f"data_stats/questdb_{protocol}_{mode}_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+        df_stats.to_csv(file_name, index=False)
 
 
 if __name__ == "__main__":
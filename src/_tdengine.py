@@ -1,12 +1,24 @@
 import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
 
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import taosrest  # type: ignore
 from dotenv import load_dotenv
 
-import data_generation
-from config import config
+import config
+import ingest
+import queries
+import utils
 
-load_dotenv()
+
+# Statements are capped at 1 MB by default (maxSQLLength). Batches are in time
+# order, so nearly every row of a large case brings its own ~200 byte subtable
+# header, and the cap has to be on the encoded length rather than on rows
+MAX_SQL_BYTES = 1_000_000
 
 
 def get_conn():
@@ -35,25 +47,226 @@ def delete_table(*, conn, table_name: str) -> None:
     conn.execute(f"DROP STABLE IF EXISTS project_data.{table_name}")
 
 
+def format_values(batch: pa.RecordBatch) -> pa.Array:
+    """
+    Format every row of a record batch as a `(time, value_..., ...)` SQL tuple,
+    with the columns in `get_value_columns(batch)` order.
+    """
+    # NOTE: Timestamps are sent as epoch milliseconds, the database's default precision.
+    columns = {
+        "time": pc.cast(
+            pc.cast(batch.column("time"), pa.timestamp("ms"), safe=False), pa.int64()
+        )
+    }
+    for name in get_value_columns(batch):
+        columns[name] = batch.column(name)
+    if "value_str" in columns:
+        columns["value_str"] = pc.binary_join_element_wise(
+            "'", pc.replace_substring(columns["value_str"], "'", "\\'"), "'", ""
+        )
+
+    values = [pc.fill_null(pc.cast(c, pa.string()), "NULL") for c in columns.values()]
+    return pc.binary_join_element_wise(
+        "(", pc.binary_join_element_wise(*values, ", "), ")", ""
+    )
+
+
+def get_value_columns(batch: pa.RecordBatch) -> list[str]:
+    # Narrow batches (see ingest.route_by_type) only carry some value columns
+    return [name for name in ingest.VALUE_COLUMNS if name in batch.schema.names]
+
+
+def build_statements(table_name: str, batch: pa.RecordBatch) -> list[str]:
+    """
+    Build multi-table INSERTs of a batch, each at most MAX_SQL_BYTES long.
+    """
+    values = pd.Series(format_values(batch).to_numpy(zero_copy_only=False)).groupby(
+        batch.column("tag_id").to_numpy(zero_copy_only=False)
+    )
+    columns = ", ".join(["time", *get_value_columns(batch)])
+
+    statements = []
+    parts: list[str] = []
+    size = len("INSERT INTO")
+    for tag_id, rows in values:
+        header = (
+            f"project_data.{table_name}_{tag_id} USING project_data.{table_name} "
+            f"TAGS ({tag_id}) ({columns}) VALUES"
+        )
+        group: list[str] = []
+        for row in rows:
+            # The header is repeated whenever a tag continues in a new statement
+            added = len(row.encode()) + 1 + (0 if group else len(header) + 1)
+            if size + added > MAX_SQL_BYTES and (parts or group):
+                if group:
+                    parts.append(f"{header} {' '.join(group)}")
+                    group = []
+                statements.append(f"INSERT INTO {' '.join(parts)}")
+                parts = []
+                size = len("INSERT INTO")
+                added = len(row.encode()) + len(header) + 2
+            group.append(row)
+            size += added
+        if group:
+            parts.append(f"{header} {' '.join(group)}")
+    if parts:
+        statements.append(f"INSERT INTO {' '.join(parts)}")
+    return statements
+
+
+def insert_batches(
+    *, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    """
+    Insert Arrow record batches as multi-table INSERTs, as many per batch as
+    fit under maxSQLLength.
+
+    Every tag gets its own subtable of the super table, created on first write.
+    """
+    t_start = time.time()
+
+    local = threading.local()
+
+    def get_worker_conn():
+        if not hasattr(local, "conn"):
+            local.conn = get_conn()
+        return local.conn
+
+    def insert_batch(batch: pa.RecordBatch) -> None:
+        for stmt in build_statements(table_name, batch):
+            get_worker_conn().execute(stmt)
+
+    ingest.map_bounded(insert_batch, batches, workers=workers)
+
+    t_end = time.time()
+    return round(t_end - t_start, 3)
+
+
+def build_query(
+    kind: str, *, table_name: str, tag_ids: list[int], start: str, end: str
+) -> str:
+    tags = ", ".join(map(str, tag_ids))
+    time_range = f"time >= '{start}' AND time < '{end}'"
+
+    if kind == "point":
+        return f"""
+        SELECT time, value_int, value_float, value_str, value_bool
+        FROM project_data.{table_name}
+        WHERE tag_id = {tag_ids[0]} AND {time_range}
+        ORDER BY time
+        """
+
+    if kind == "downsample":
+        return f"""
+        SELECT _wstart AS time, tag_id, FIRST(value_float) AS value_float
+        FROM project_data.{table_name}
+        WHERE tag_id IN ({tags}) AND {time_range}
+        PARTITION BY tag_id
+        INTERVAL(1m)
+        """
+
+    if kind == "last_value":
+        return f"""
+        SELECT
+            tag_id,
+            LAST_ROW(time) AS time,
+            LAST_ROW(value_int) AS value_int,
+            LAST_ROW(value_float) AS value_float,
+            LAST_ROW(value_str) AS value_str,
+            LAST_ROW(value_bool) AS value_bool
+        FROM project_data.{table_name}
+        WHERE tag_id IN ({tags})
+        PARTITION BY tag_id
+        """
+
+    raise ValueError(f"Unknown query kind {kind}")
+
+
+def run_query(conn, sql: str) -> pa.Table:
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    names = [column[0] for column in cursor.description]
+    return queries.rows_to_table(names, cursor.fetchall())
+
+
+def export_slice(table_name: str, *, start: str, end: str) -> Iterator[pa.RecordBatch]:
+    """
+    Read the rows in [start, end) through the REST API.
+    """
+    table = run_query(
+        get_conn(),
+        f"""
+        SELECT time, tag_id, value_int, value_float, value_str, value_bool
+        FROM project_data.{table_name}
+        WHERE time >= '{start}' AND time < '{end}'
+        """,
+    )
+    yield from table.to_batches()
+
+
+def get_client():
+    return get_conn()
+
+
+def reset_table(conn, table_name: str) -> None:
+    delete_table(conn=conn, table_name=table_name)
+    create_table(conn=conn, table_name=table_name)
+
+
+def write_batches(
+    conn, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    return insert_batches(table_name=table_name, batches=batches, workers=workers)
+
+
 def main():
     load_dotenv(override=True)
 
-    # data = []
+    data: dict[int, list[dict]] = {}
+
+    for case in config.get_cases("tdengine"):
+        case_name, workers = case.name, case.workers
+        print(f"{case_name} ({workers} workers)")
+
+        table_name = f"_{case_name}"
+        # peak_rss_B is the peak of this run only
+        utils.reset_peak_rss()
+
+        parquet_file = ingest.open_case(case_name)
+        n_rows = parquet_file.metadata.num_rows
 
-    for minutes in config["minutes"]:
-        for n_tags in config["tags"]:
-            for seconds_interval in config["seconds_interval"]:
-                case_name = data_generation.generate_case_name(
-                    minutes=minutes, n_tags=n_tags, seconds_interval=seconds_interval
-                )
+        conn = get_conn()
+        delete_table(conn=conn, table_name=table_name)
+        create_table(conn=conn, table_name=table_name)
 
-                print(case_name)
+        load_stats: dict = {}
+        insert_time = insert_batches(
+            table_name=table_name,
+            batches=ingest.iter_batches(
+                parquet_file, batch_size=case.batch_size, stats=load_stats
+            ),
+            workers=workers,
+        )
+        print(
+            f"\t{round(insert_time, 3)} s ({round(load_stats['load_time_s'], 3)} s loading)"
+        )
+        print(f"\t{int(n_rows / insert_time)} rows/s")
 
-                table_name = f"_{case_name}"
+        data.setdefault(workers, []).append(
+            {
+                "n_tags": case.n_tags,
+                "seconds_interval": case.seconds_interval,
+                "data_points": n_rows,
+                "insert_time_s": insert_time,
+                "load_time_s": round(load_stats["load_time_s"], 3),
+                "peak_rss_B": utils.get_peak_rss(),
+            }
+        )
 
-                conn = get_conn()
-                delete_table(conn=conn, table_name=table_name)
-                create_table(conn=conn, table_name=table_name)
+    for workers, rows in data.items():
+        df_stats = pd.DataFrame(rows)
+        file_name = f"data_stats/tdengine_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+        df_stats.to_csv(file_name, index=False)
 
 
 if __name__ == "__main__":
@@ -1,20 +1,44 @@
-import concurrent.futures
-import itertools
 import os
+import threading
 import time
-from io import StringIO
+from collections.abc import Iterable, Iterator
+from datetime import timedelta
 from secrets import token_hex
 
 import pandas as pd
 import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 from dotenv import load_dotenv
 
-import data_generation  # type: ignore
+import config  # type: ignore
+import ingest  # type: ignore
+import queries  # type: ignore
 import utils  # type: ignore
-from config import config  # type: ignore
 
 
-def create_table(*, cursor: psycopg2.extensions.cursor, table_name: str) -> None:
+# Columns of the exported CSV, with time as epoch microseconds
+EXPORT_COLUMNS = {
+    "time": pa.int64(),
+    "tag_id": pa.int32(),
+    "value_int": pa.int32(),
+    "value_float": pa.float64(),
+    "value_str": pa.string(),
+    "value_bool": pa.bool_(),
+}
+
+
+def create_table(
+    *,
+    cursor: psycopg2.extensions.cursor,
+    table_name: str,
+    chunk_time_interval: str = "5 minutes",
+    space_partitions: int | None = None,
+) -> None:
+    # See more about chunk sizing at https://docs.timescale.com/use-timescale/latest/hypertables/about-hypertables/#best-practices-for-time-partitioning
+    # NOTE: Chunks (including their indexes) should fit in ~25% of main memory.
+    # NOTE: Space partitions hash tag_id into additional chunks per time interval.
     cursor.execute(
         f"""CREATE TABLE IF NOT EXISTS {table_name} (
             time TIMESTAMPTZ,
@@ -31,8 +55,32 @@ def create_table(*, cursor: psycopg2.extensions.cursor, table_name: str) -> None
         f"CREATE INDEX IF NOT EXISTS {table_name}_tag_id_time_idx ON {table_name} (tag_id, time DESC);"
     )
     cursor.execute(
-        f"SELECT create_hypertable('{table_name}', 'time', chunk_time_interval => INTERVAL '5 minutes')"
+        f"SELECT create_hypertable('{table_name}', 'time', chunk_time_interval => INTERVAL '{chunk_time_interval}')"
     )
+    if space_partitions:
+        cursor.execute(
+            f"SELECT add_dimension('{table_name}', 'tag_id', number_partitions => {space_partitions})"
+        )
+
+
+def create_latest_table(conn, table_name: str) -> None:
+    """
+    Create `{table_name}_latest` with the latest row of every tag, upserted by
+    insert_batches(latest=True).
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {table_name}_latest")
+        cursor.execute(
+            f"""CREATE TABLE {table_name}_latest (
+                time TIMESTAMPTZ,
+                tag_id INT PRIMARY KEY,
+                value_int INT,
+                value_float FLOAT,
+                value_str TEXT,
+                value_bool BOOLEAN
+            );
+            """
+        )
 
 
 def delete_table(*, cursor: psycopg2.extensions.cursor, table_name: str) -> None:
@@ -45,26 +93,152 @@ def get_table_size(*, cursor: psycopg2.extensions.cursor, table_name: str) -> in
     return cursor.fetchone()[0]  # type: ignore
 
 
-def insert_dataframe(
+def build_query(
+    kind: str, *, table_name: str, tag_ids: list[int], start: str, end: str
+) -> str:
+    tags = ", ".join(map(str, tag_ids))
+    time_range = f"time >= '{start}' AND time < '{end}'"
+
+    if kind == "point":
+        return f"""
+        SELECT time, value_int, value_float, value_str, value_bool
+        FROM {table_name}
+        WHERE tag_id = {tag_ids[0]} AND {time_range}
+        ORDER BY time;
+        """
+
+    if kind == "downsample":
+        return f"""
+        SELECT
+            time_bucket('1 minute', time) AS time,
+            tag_id,
+            first(COALESCE(value_float, value_int), time) AS value
+        FROM {table_name}
+        WHERE tag_id IN ({tags}) AND {time_range}
+        GROUP BY 1, 2
+        ORDER BY 1, 2;
+        """
+
+    if kind == "last_value":
+        return f"""
+        SELECT DISTINCT ON (tag_id)
+            tag_id, time, value_int, value_float, value_str, value_bool
+        FROM {table_name}
+        WHERE tag_id IN ({tags})
+        ORDER BY tag_id, time DESC;
+        """
+
+    raise ValueError(f"Unknown query kind {kind}")
+
+
+def build_latest_query(table_name: str, *, snapshot: bool) -> str:
+    """
+    Latest row of every tag, from the snapshot or from the raw table.
+    """
+    if snapshot:
+        return f"""
+        SELECT tag_id, time, value_int, value_float, value_str, value_bool
+        FROM {table_name}_latest;
+        """
+
+    return f"""
+    SELECT DISTINCT ON (tag_id)
+        tag_id, time, value_int, value_float, value_str, value_bool
+    FROM {table_name}
+    ORDER BY tag_id, time DESC;
+    """
+
+
+# Gap fills time_bucket_gapfill does on the server, see resample.py
+RESAMPLE_FILLS = {"locf": "locf", "linear": "interpolate"}
+
+
+def build_resample_query(
+    *,
+    table_name: str,
+    tag_ids: list[int],
+    start: str,
+    end: str,
+    step_s: int,
+    fill: str | None = None,
+) -> str:
+    """
+    First value of every `step_s` bucket, gap-filled on the server with `fill`.
+    """
+    tags = ", ".join(map(str, tag_ids))
+    value = "first(COALESCE(value_float, value_int), time)"
+    if fill:
+        bucket = f"time_bucket_gapfill(INTERVAL '{step_s} seconds', time, '{start}', '{end}')"
+        value = f"{RESAMPLE_FILLS[fill]}({value})"
+    else:
+        bucket = f"time_bucket(INTERVAL '{step_s} seconds', time)"
+
+    return f"""
+    SELECT {bucket} AS time, tag_id, {value} AS value
+    FROM {table_name}
+    WHERE tag_id IN ({tags}) AND time >= '{start}' AND time < '{end}'
+    GROUP BY 1, 2
+    ORDER BY 2, 1;
+    """
+
+
+def run_query(conn, sql: str) -> pa.Table:
+    with conn.cursor() as cursor:
+        cursor.execute(sql)
+        names = [column.name for column in cursor.description]
+        return queries.rows_to_table(names, cursor.fetchall())
+
+
+def query_downsample(
     *,
     cursor: psycopg2.extensions.cursor,
     table_name: str,
-    df: pd.DataFrame,
-    chunksize: int,
-    workers: int,
-) -> float:
+    tag_ids: list[int],
+    start: str,
+    end: str,
+) -> list:
+    cursor.execute(
+        build_query(
+            "downsample", table_name=table_name, tag_ids=tag_ids, start=start, end=end
+        )
+    )
+    return cursor.fetchall()
+
+
+def get_time_offset(t_min) -> timedelta:
     # Update index to be current data (as of the latest 5 minutes)
-    now = pd.Timestamp.utcnow().floor("5min").tz_localize(None)
-    delta = now - pd.to_datetime(df["time"].min())
-    df["time"] = df["time"] + delta
+    now = pd.Timestamp.now("UTC").floor("5min").tz_localize(None)
+    return (now - pd.Timestamp(t_min)).to_pytimedelta()
 
-    t_start = time.time()
 
-    chunks = []
-    for i in range(0, len(df), chunksize):
-        chunks.append(df.iloc[i : i + chunksize])
+def insert_batches(
+    *,
+    table_name: str,
+    batches: Iterable[pa.RecordBatch],
+    workers: int,
+    latest: bool = False,
+) -> float:
+    """
+    COPY every batch into a temporary table and insert it from there, with
+    `latest` also upserting the newest row per tag into `{table_name}_latest`.
+    """
+    t_start = time.time()
 
-    def insert_chunk(chunk):
+    # Cursors can't be shared between threads, so every worker gets its own
+    # connection (and temporary tables are per session anyway)
+    local = threading.local()
+    conns = []
+
+    def get_cursor() -> psycopg2.extensions.cursor:
+        if not hasattr(local, "cursor"):
+            conn = psycopg2.connect(os.getenv("TIMESCALE_CONNECTION_STRING"))
+            conn.autocommit = True
+            conns.append(conn)
+            local.cursor = conn.cursor()
+        return local.cursor
+
+    def insert_batch(batch: pa.RecordBatch) -> None:
+        cursor = get_cursor()
         random_id = token_hex(16)
         table_name_temp = f"{table_name}_temp_{random_id}"
 
@@ -78,16 +252,26 @@ def insert_dataframe(
             """
         )
 
-        sio = StringIO()
-        sio.write(df.to_csv(sep="\t", index=False, header=False))
-        sio.seek(0)
+        # Postgres stores microseconds
+        batch = batch.set_column(
+            batch.schema.get_field_index("time"),
+            "time",
+            pc.cast(batch.column("time"), pa.timestamp("us"), safe=False),
+        )
+
+        # Written by Arrow's vectorized CSV writer: NULLs are empty and unquoted,
+        # empty strings are quoted, which is what COPY's CSV format expects
+        sink = pa.BufferOutputStream()
+        pa_csv.write_csv(
+            batch, sink, write_options=pa_csv.WriteOptions(include_header=False)
+        )
 
-        cursor.copy_from(
-            sio,
-            table_name_temp,
-            sep="\t",
-            null="",
-            columns=df.columns,
+        cursor.copy_expert(
+            f"""
+            COPY {table_name_temp} ({", ".join(batch.schema.names)})
+            FROM STDIN WITH (FORMAT csv)
+            """,
+            pa.BufferReader(sink.getvalue()),
         )
 
         cursor.execute(
@@ -98,71 +282,178 @@ def insert_dataframe(
             """
         )
 
+        if latest:
+            # Rows are upserted in tag_id order, so concurrent writers lock
+            # them in the same order and don't deadlock
+            cursor.execute(
+                f"""
+                INSERT INTO {table_name}_latest
+                SELECT DISTINCT ON (tag_id)
+                    time, tag_id, value_int, value_float, value_str, value_bool
+                FROM {table_name_temp}
+                ORDER BY tag_id, time DESC
+                ON CONFLICT (tag_id) DO UPDATE SET
+                    time = EXCLUDED.time,
+                    value_int = EXCLUDED.value_int,
+                    value_float = EXCLUDED.value_float,
+                    value_str = EXCLUDED.value_str,
+                    value_bool = EXCLUDED.value_bool
+                WHERE {table_name}_latest.time < EXCLUDED.time;
+                """
+            )
+
         cursor.execute(f"DROP TABLE IF EXISTS {table_name_temp}")
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        executor.map(insert_chunk, chunks)
+    try:
+        ingest.map_bounded(insert_batch, batches, workers=workers)
+    finally:
+        for conn in conns:
+            conn.close()
 
     t_end = time.time()
     return round(t_end - t_start, 3)
 
 
-def main():
-    load_dotenv(override=True)
+def export_slice(table_name: str, *, start: str, end: str) -> Iterator[pa.RecordBatch]:
+    """
+    Stream the rows in [start, end) through COPY TO STDOUT.
+    """
+    # NOTE: COPY's binary format would need a decoder of its own, the CSV
+    # format is parsed by Arrow's multithreaded streaming CSV reader.
+    read_fd, write_fd = os.pipe()
+    conn = get_client()
+    errors = []
+
+    def copy() -> None:
+        try:
+            with os.fdopen(write_fd, "wb") as sink, conn.cursor() as cursor:
+                cursor.copy_expert(
+                    f"""
+                    COPY (
+                        SELECT
+                            (EXTRACT(EPOCH FROM time) * 1000000)::BIGINT AS time,
+                            tag_id, value_int, value_float, value_str, value_bool
+                        FROM {table_name}
+                        WHERE time >= '{start}' AND time < '{end}'
+                    ) TO STDOUT WITH (FORMAT csv)
+                    """,
+                    sink,
+                )
+        except Exception as e:
+            # Otherwise a failed COPY would look like a short slice
+            errors.append(e)
+
+    copier = threading.Thread(target=copy)
+    copier.start()
+    try:
+        with os.fdopen(read_fd, "rb") as source:
+            reader = pa_csv.open_csv(
+                source,
+                read_options=pa_csv.ReadOptions(column_names=list(EXPORT_COLUMNS)),
+                convert_options=pa_csv.ConvertOptions(
+                    column_types=EXPORT_COLUMNS,
+                    true_values=["t"],
+                    false_values=["f"],
+                    strings_can_be_null=True,
+                    quoted_strings_can_be_null=False,
+                ),
+            )
+            for batch in reader:
+                yield batch.set_column(
+                    0, "time", pc.cast(batch.column("time"), pa.timestamp("us"))
+                )
+    finally:
+        copier.join()
+        conn.close()
+    if errors:
+        raise errors[0]
 
-    data = []
 
-    cases = list(
-        itertools.product(
-            config["minutes"],
-            config["workers"],
-            config["tags"],
-            config["seconds_interval"],
-        )
+def get_client():
+    conn = psycopg2.connect(os.getenv("TIMESCALE_CONNECTION_STRING"))
+    conn.autocommit = True
+    return conn
+
+
+def reset_table(conn, table_name: str) -> None:
+    with conn.cursor() as cursor:
+        delete_table(cursor=cursor, table_name=table_name)
+        create_table(cursor=cursor, table_name=table_name)
+
+
+def write_batches(
+    conn, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    # The writers open their own connections
+    return insert_batches(table_name=table_name, batches=batches, workers=workers)
+
+
+def write_latest(
+    conn, table_name: str, batches: Iterable[pa.RecordBatch], workers: int
+) -> float:
+    return insert_batches(
+        table_name=table_name, batches=batches, workers=workers, latest=True
     )
 
-    for minutes, workers, n_tags, seconds_interval in cases:
-        case_name = data_generation.generate_case_name(
-            minutes=minutes, n_tags=n_tags, seconds_interval=seconds_interval
-        )
 
-        print(case_name)
+def main():
+    load_dotenv(override=True)
+
+    data: dict[int, list[dict]] = {}
+
+    for case in config.get_cases("timescale"):
+        case_name, workers = case.name, case.workers
+        print(f"{case_name} ({workers} workers)")
 
         table_name = f"_{case_name}"
+        # peak_rss_B is the peak of this run only
+        utils.reset_peak_rss()
 
-        df = pd.read_parquet(f"data/{case_name}.parquet")
+        parquet_file = ingest.open_case(case_name)
+        n_rows = parquet_file.metadata.num_rows
+        t_min, _ = ingest.get_time_range(parquet_file)
+        offset = get_time_offset(t_min)
 
         with psycopg2.connect(os.getenv("TIMESCALE_CONNECTION_STRING")) as conn:
             with conn.cursor() as cursor:
                 # delete_table(cursor=cursor, table_name=table_name)
                 # create_table(cursor=cursor, table_name=table_name)
-                insert_time = insert_dataframe(
-                    cursor=cursor,
+                load_stats: dict = {}
+                insert_time = insert_batches(
                     table_name=table_name,
-                    df=df,
-                    chunksize=100_000,
+                    batches=(
+                        ingest.shift_time(batch, offset)
+                        for batch in ingest.iter_batches(
+                            parquet_file, batch_size=case.batch_size, stats=load_stats
+                        )
+                    ),
                     workers=workers,
                 )
-                print(f"\t{round(insert_time, 3)} s")
-                print(f"\t{int(len(df) / insert_time)} rows/s")
+                print(
+                    f"\t{round(insert_time, 3)} s ({round(load_stats['load_time_s'], 3)} s loading)"
+                )
+                print(f"\t{int(n_rows / insert_time)} rows/s")
 
                 table_size = get_table_size(cursor=cursor, table_name=table_name)
 
-                data.append(
+                data.setdefault(workers, []).append(
                     {
-                        "n_tags": n_tags,
-                        "seconds_interval": seconds_interval,
-                        "data_points": len(df),
+                        "n_tags": case.n_tags,
+                        "seconds_interval": case.seconds_interval,
+                        "data_points": n_rows,
                         "table_size_B": table_size,
                         "insert_time_s": insert_time,
+                        "load_time_s": round(load_stats["load_time_s"], 3),
+                        "peak_rss_B": utils.get_peak_rss(),
                     }
                 )
 
                 # delete_table(cursor=cursor, table_name=table_name)
 
-    df_stats = pd.DataFrame(data)
-    file_name = f"data_stats/timescale_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
-    df_stats.to_csv(file_name, index=False)
+    for workers, rows in data.items():
+        df_stats = pd.DataFrame(rows)
+        file_name = f"data_stats/timescale_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+        df_stats.to_csv(file_name, index=False)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+# Single entry point for quick runs.
+#
+#   python cli.py cases                           list the configured cases
+#   python cli.py run clickhouse [--case NAME]    load cases into one backend
+#   python cli.py imports                         import time of every backend
+#
+# Only the selected backend module (and with it its client library) is
+# imported, after the arguments are parsed, and the time it takes is reported
+# apart from the load so it doesn't skew small cases.
+
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import config
+
+# Imported by every backend module, timed on their own
+SHARED_MODULES = ["ingest", "queries"]
+
+
+def time_import(modules: list[str]) -> float:
+    """
+    Time importing `modules` in a fresh interpreter, so nothing is cached.
+    """
+    code = (
+        "import time\n"
+        "t_start = time.perf_counter()\n"
+        f"import {', '.join(modules)}\n"
+        "print(time.perf_counter() - t_start)"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(result.stdout)
+
+
+def list_cases() -> None:
+    for case in config.get_cases():
+        generated = Path(f"data/{case.name}.parquet").exists()
+        print(
+            f"{case.name} ({case.workers} workers){'' if generated else ' [not generated]'}"
+        )
+
+
+def run(backend_name: str, case_names: list[str]) -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv(override=True)
+
+    t_start = time.perf_counter()
+    import queries
+
+    shared_import_time = time.perf_counter() - t_start
+
+    if backend_name not in queries.BACKENDS:
+        sys.exit(f"Unknown backend {backend_name}, expected one of {queries.BACKENDS}")
+
+    t_start = time.perf_counter()
+    backend = queries.get_backend(backend_name)
+    import_time = time.perf_counter() - t_start
+    print(
+        f"import: {round(shared_import_time, 3)} s shared, "
+        f"{round(import_time, 3)} s {backend_name}"
+    )
+
+    import ingest
+    import pandas as pd
+
+    client = backend.get_client()
+    for case in config.get_cases(backend_name):
+        case_name = case.name
+        if case_names and case_name not in case_names:
+            continue
+
+        parquet_file = ingest.open_case(case_name)
+        t_min, _ = ingest.get_time_range(parquet_file)
+        # Timescale and InfluxDB expect recent data
+        offset = pd.Timestamp.now("UTC").floor("min").tz_localize(None) - pd.Timestamp(
+            t_min
+        )
+
+        insert_time = queries.load_case(
+            backend,
+            client,
+            f"_{case_name}_cli",
+            parquet_file,
+            offset=offset.to_pytimedelta(),
+            workers=case.workers,
+            batch_size=case.batch_size,
+        )
+        n_rows = parquet_file.metadata.num_rows
+        print(
+            f"{case_name}: {n_rows} rows in {round(insert_time, 3)} s, "
+            f"{int(n_rows / insert_time)} rows/s"
+        )
+
+
+def report_imports() -> None:
+    import pandas as pd
+
+    import queries
+    import utils
+
+    Path("data_stats/cli").mkdir(exist_ok=True)
+
+    shared_import_time = time_import(SHARED_MODULES)
+    print(f"shared: {round(shared_import_time, 3)} s")
+
+    data = []
+    for name in queries.BACKENDS:
+        import_time = time_import([f"_{name}"])
+        print(f"{name}: {round(import_time, 3)} s")
+        data.append(
+            {
+                "backend": name,
+                "import_time_s": round(import_time, 3),
+                "shared_import_time_s": round(shared_import_time, 3),
+                "client_import_time_s": round(import_time - shared_import_time, 3),
+            }
+        )
+
+    df_stats = pd.DataFrame(data)
+    file_name = (
+        f"data_stats/cli/import_times_{'remote' if utils.get_remote() else 'local'}.csv"
+    )
+    df_stats.to_csv(file_name, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("cases", help="list the configured cases")
+
+    run_parser = subparsers.add_parser("run", help="load cases into one backend")
+    run_parser.add_argument("backend")
+    run_parser.add_argument(
+        "--case", action="append", default=[], help="only this case, repeatable"
+    )
+
+    subparsers.add_parser("imports", help="report the import time of every backend")
+
+    args = parser.parse_args()
+    if args.command == "cases":
+        list_cases()
+    elif args.command == "run":
+        run(args.backend, args.case)
+    else:
+        report_imports()
+
+
+if __name__ == "__main__":
+    main()
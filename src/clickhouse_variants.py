@@ -0,0 +1,156 @@
+# Table engine, schema and insert mode variants for ClickHouse.
+#
+# Each variant ingests the same case, then we record ingest throughput, part
+# counts and merge load right after ingest, bytes on disk and downsample query
+# latency, to pick a layout for 10,000,000 rows/min.
+#
+# See more at https://clickhouse.com/docs/optimize/asynchronous-inserts
+
+import statistics
+import time
+from pathlib import Path
+
+import pandas as pd
+from dotenv import load_dotenv
+
+import _clickhouse
+import config
+import ingest
+import utils
+
+# Overrides of the baseline table/insert options
+VARIANTS: dict[str, dict] = {
+    "baseline": {},
+    "async_insert_wait": {
+        "settings": {"async_insert": 1, "wait_for_async_insert": 1},
+        "chunksize": 50_000,
+    },
+    "async_insert_no_wait": {
+        "settings": {"async_insert": 1, "wait_for_async_insert": 0},
+        "chunksize": 50_000,
+    },
+    "low_cardinality": {"low_cardinality": True},
+    "sentinels": {"nullable": False},
+    "sentinels_low_cardinality": {"nullable": False, "low_cardinality": True},
+    "partition_by_month": {"partition_by": "toYYYYMM(time)"},
+    "time_delta_zstd": {"time_codec": "Delta, ZSTD(1)"},
+    "time_double_delta_zstd": {"time_codec": "DoubleDelta, ZSTD(1)"},
+    "replacing_merge_tree": {"engine": "ReplacingMergeTree"},
+}
+
+QUERY_TAGS = 100
+QUERY_REPEATS = 5
+
+
+def get_variant(name: str) -> dict:
+    return {
+        "engine": _clickhouse.get_default_engine(),
+        "nullable": True,
+        "low_cardinality": False,
+        "partition_by": None,
+        "time_codec": None,
+        "settings": {},
+        "chunksize": 1_500_000,
+        **VARIANTS[name],
+    }
+
+
+def main():
+    load_dotenv(override=True)
+
+    if not config.is_enabled("clickhouse"):
+        return
+
+    client = _clickhouse.get_client()
+
+    Path("data_stats/clickhouse_variants").mkdir(exist_ok=True)
+
+    data: dict[int, list[dict]] = {}
+
+    df_case = None
+    for case in config.get_cases("clickhouse"):
+        case_name, workers = case.name, case.workers
+        print(f"{case_name} ({workers} workers)")
+
+        table_name = f"_{case_name}_variant"
+
+        # Cases of a dataset run back to back, read it once
+        if case_name != df_case:
+            df = pd.read_parquet(f"data/{case_name}.parquet")
+            df_case = case_name
+        start = df["time"].min().isoformat()
+        end = (df["time"].max() + pd.Timedelta(seconds=1)).isoformat()
+
+        for name in VARIANTS:
+            variant = get_variant(name)
+            print(f"\t{name}")
+
+            _clickhouse.delete_table(client, table_name)
+            _clickhouse.create_table(
+                client,
+                table_name,
+                engine=variant["engine"],
+                nullable=variant["nullable"],
+                low_cardinality=variant["low_cardinality"],
+                partition_by=variant["partition_by"],
+                time_codec=variant["time_codec"],
+            )
+
+            t_start = time.time()
+            insert_time = _clickhouse.insert_batches(
+                client,
+                table_name,
+                ingest.from_dataframe(df, chunksize=variant["chunksize"]),
+                workers=workers,
+                nullable=variant["nullable"],
+                settings=variant["settings"],
+            )
+            # Without waiting, async inserts are acknowledged before they land
+            _clickhouse.wait_for_rows(client, table_name, len(df))
+            visible_time = round(time.time() - t_start, 3)
+
+            print(f"\t\t{insert_time} s ({visible_time} s until visible)")
+            print(f"\t\t{int(len(df) / visible_time)} rows/s")
+
+            parts_stats = _clickhouse.get_parts_stats(client, table_name)
+
+            latencies = []
+            for _ in range(QUERY_REPEATS):
+                t_query = time.time()
+                _clickhouse.query_downsample(
+                    client,
+                    table_name,
+                    tag_ids=list(range(QUERY_TAGS)),
+                    start=start,
+                    end=end,
+                )
+                latencies.append(time.time() - t_query)
+
+            data.setdefault(workers, []).append(
+                {
+                    "variant": name,
+                    "n_tags": case.n_tags,
+                    "seconds_interval": case.seconds_interval,
+                    "data_points": len(df),
+                    "insert_time_s": insert_time,
+                    "visible_time_s": visible_time,
+                    "rows_per_s": int(len(df) / visible_time),
+                    **parts_stats,
+                    "merged_parts": _clickhouse.get_merged_parts(
+                        client, table_name, since=t_start
+                    ),
+                    "table_size_B": _clickhouse.get_table_size(client, table_name),
+                    "query_time_s": round(statistics.median(latencies), 4),
+                }
+            )
+
+        _clickhouse.delete_table(client, table_name)
+
+    for workers, rows in data.items():
+        df_stats = pd.DataFrame(rows)
+        file_name = f"data_stats/clickhouse_variants/{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+        df_stats.to_csv(file_name, index=False)
+
+
+if __name__ == "__main__":
+    main()
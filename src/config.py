@@ -1,14 +1,199 @@
-config = {
-    "minutes": [5],
-    "workers": [4],
-    "tags": [
-        1_000,
-        10_000,
-        100_000,
-    ],
-    "seconds_interval": [
-        5 * 60,
-        1 * 60,
-        1,
-    ],
-}
+# Benchmark configuration, read from config.toml at the repository root.
+#
+# The [matrix] table is a set of sweeps, every case is one combination of
+# them. Backends override fields under [backends.<name>], named scenarios under
+# [scenarios.<name>] replace fields of the matrix (BENCHMARK_SCENARIO picks one)
+# and [filter] keeps or drops cases by name.
+#
+# Every main runs get_cases(), which applies the overrides and filters and
+# orders the cases so that the ones sharing a dataset run back to back. The
+# harnesses looping over backends skip those with `enabled = false`.
+
+import dataclasses
+import fnmatch
+import itertools
+import os
+import tomllib
+from dataclasses import dataclass, field
+from pathlib import Path
+
+CONFIG_FILE = Path(__file__).parent.parent / "config.toml"
+
+
+@dataclass(frozen=True)
+class Matrix:
+    minutes: list[int]
+    workers: list[int]
+    tags: list[int]
+    seconds_interval: list[int]
+    realism: list[str] = field(default_factory=lambda: ["ideal"])
+    batch_size: int = 100_000
+    description: str = ""
+
+
+FIELD_TYPES = {f.name: f.type for f in dataclasses.fields(Matrix)}
+
+
+@dataclass(frozen=True)
+class Case:
+    minutes: int
+    n_tags: int
+    seconds_interval: int
+    realism: str
+    workers: int
+    batch_size: int
+
+    @property
+    def name(self) -> str:
+        import data_generation
+
+        return data_generation.generate_case_name(
+            minutes=self.minutes,
+            n_tags=self.n_tags,
+            seconds_interval=self.seconds_interval,
+            realism=self.realism,
+        )
+
+    @property
+    def dataset(self) -> tuple[int, int, int, str]:
+        """
+        Cases with the same dataset share the generated file.
+        """
+        return (self.minutes, self.n_tags, self.seconds_interval, self.realism)
+
+
+@dataclass(frozen=True)
+class Settings:
+    matrix: Matrix
+    backends: dict[str, dict] = field(default_factory=dict)
+    scenarios: dict[str, dict] = field(default_factory=dict)
+    include: list[str] = field(default_factory=list)
+    exclude: list[str] = field(default_factory=list)
+
+
+def parse_matrix(values: dict, *, base: Matrix | None = None, where: str) -> Matrix:
+    fields = {f.name for f in dataclasses.fields(Matrix)}
+    unknown = set(values) - fields
+    if unknown:
+        raise ValueError(f"Unknown keys in {where}: {sorted(unknown)}")
+
+    for key, value in values.items():
+        expected = FIELD_TYPES[key]
+        # Exact types, TOML booleans are ints to isinstance
+        if expected in (int, str):
+            valid = type(value) is expected
+            expected_name = expected.__name__
+        else:
+            (item_type,) = expected.__args__
+            valid = isinstance(value, list) and all(type(v) is item_type for v in value)
+            expected_name = str(expected)
+        if not valid:
+            raise ValueError(
+                f"Invalid {where}: {key} must be {expected_name}, got {value!r}"
+            )
+
+    try:
+        return dataclasses.replace(base, **values) if base else Matrix(**values)
+    except TypeError as e:
+        raise ValueError(f"Invalid {where}: {e}") from None
+
+
+def load_settings(path: str | Path = CONFIG_FILE) -> Settings:
+    with open(path, "rb") as f:
+        raw = tomllib.load(f)
+
+    matrix = parse_matrix(raw.get("matrix", {}), where="[matrix]")
+    backends = raw.get("backends", {})
+    scenarios = raw.get("scenarios", {})
+    # Fail on typos now rather than halfway through a run
+    for name, values in backends.items():
+        if not isinstance(values.get("enabled", True), bool):
+            raise ValueError(f"Invalid [backends.{name}]: enabled must be a bool")
+        parse_matrix(
+            {k: v for k, v in values.items() if k != "enabled"},
+            base=matrix,
+            where=f"[backends.{name}]",
+        )
+    for name, values in scenarios.items():
+        parse_matrix(values, base=matrix, where=f"[scenarios.{name}]")
+
+    return Settings(
+        matrix=matrix,
+        backends=backends,
+        scenarios=scenarios,
+        include=raw.get("filter", {}).get("include", []),
+        exclude=raw.get("filter", {}).get("exclude", []),
+    )
+
+
+def get_matrix(backend: str | None = None, scenario: str | None = None) -> Matrix:
+    """
+    Get the matrix of a scenario (BENCHMARK_SCENARIO by default) with the
+    overrides of `backend` applied.
+    """
+    scenario = scenario or os.getenv("BENCHMARK_SCENARIO")
+    matrix = settings.matrix
+    if scenario:
+        if scenario not in settings.scenarios:
+            raise ValueError(
+                f"Unknown scenario {scenario}, expected one of {list(settings.scenarios)}"
+            )
+        matrix = dataclasses.replace(matrix, **settings.scenarios[scenario])
+    overrides = settings.backends.get(backend or "", {})
+    return dataclasses.replace(
+        matrix, **{k: v for k, v in overrides.items() if k != "enabled"}
+    )
+
+
+def is_enabled(backend: str) -> bool:
+    return settings.backends.get(backend, {}).get("enabled", True)
+
+
+def get_cases(backend: str | None = None, scenario: str | None = None) -> list[Case]:
+    """
+    Get the filtered cases, grouped by dataset so it's generated or opened
+    once, with the cheapest datasets first.
+    """
+    matrix = get_matrix(backend, scenario)
+    cases = [
+        Case(
+            minutes=minutes,
+            n_tags=n_tags,
+            seconds_interval=seconds_interval,
+            realism=realism,
+            workers=workers,
+            batch_size=matrix.batch_size,
+        )
+        for minutes, n_tags, seconds_interval, realism, workers in itertools.product(
+            matrix.minutes,
+            matrix.tags,
+            matrix.seconds_interval,
+            matrix.realism,
+            matrix.workers,
+        )
+    ]
+
+    def keep(case: Case) -> bool:
+        if settings.include and not any(
+            fnmatch.fnmatch(case.name, pattern) for pattern in settings.include
+        ):
+            return False
+        return not any(
+            fnmatch.fnmatch(case.name, pattern) for pattern in settings.exclude
+        )
+
+    # Rows per dataset, the order within a dataset keeps the sweep order
+    return sorted(
+        filter(keep, cases),
+        key=lambda case: case.minutes * case.n_tags * 60 // case.seconds_interval,
+    )
+
+
+def get_datasets(cases: list[Case]) -> list[Case]:
+    """
+    Get one case per distinct dataset.
+    """
+    return list({case.dataset: case for case in cases}.values())
+
+
+settings = load_settings(os.getenv("BENCHMARK_CONFIG", CONFIG_FILE))
@@ -0,0 +1,318 @@
+# Mixed read/write contention benchmark.
+#
+# Dashboards query the tables while data keeps landing, so every backend runs
+# three phases of the same length against one table:
+#   ingest_only: the case replayed as a sustained ingest stream
+#   query_only:  a pool of query clients (point, downsample, last_value)
+#   mixed:       both at the same time
+# Ingest throughput and query tail latency in the mixed phase are then
+# compared with each in isolation.
+
+import concurrent.futures
+import itertools
+import random
+import threading
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+import config
+import ingest
+import queries
+import utils
+
+DURATION_S = 60
+QUERY_CLIENTS = 4
+
+# Target ingest rate, None to ingest as fast as the backend accepts
+ROWS_PER_MINUTE: int | None = None
+
+PHASES = ["ingest_only", "query_only", "mixed"]
+
+
+def get_time_offset(t_min) -> pd.Timedelta:
+    # Move the first replay to now, so time partitioned tables see fresh data
+    return pd.Timestamp.now("UTC").floor("min").tz_localize(None) - pd.Timestamp(t_min)
+
+
+def stream_batches(
+    parquet_file: pq.ParquetFile,
+    *,
+    offset: pd.Timedelta,
+    span: pd.Timedelta,
+    first_replay: int,
+    batch_size: int,
+    stop: threading.Event,
+    stats: dict,
+) -> Iterator:
+    """
+    Replay the case until `stop` is set, each replay moved `span` further ahead.
+
+    The rows written are counted in `stats["rows"]` and the current replay is
+    kept in `stats["replay"]`, so a later stream can continue after it.
+    """
+    stats.setdefault("rows", 0)
+    t_start = time.time()
+
+    for replay in itertools.count(first_replay):
+        stats["replay"] = replay
+        for batch in ingest.iter_batches(
+            parquet_file, batch_size=batch_size, stats=stats
+        ):
+            if stop.is_set():
+                return
+            yield ingest.shift_time(batch, (offset + replay * span).to_pytimedelta())
+            stats["rows"] += batch.num_rows
+
+            if ROWS_PER_MINUTE:
+                # Sleep while ahead of the target rate
+                ahead_s = stats["rows"] / ROWS_PER_MINUTE * 60 - (time.time() - t_start)
+                if ahead_s > 0:
+                    time.sleep(ahead_s)
+
+
+def run_ingest(
+    backend,
+    *,
+    table_name: str,
+    parquet_file: pq.ParquetFile,
+    offset: pd.Timedelta,
+    span: pd.Timedelta,
+    first_replay: int,
+    workers: int,
+    batch_size: int,
+    stop: threading.Event,
+) -> dict:
+    stats: dict = {}
+    t_start = time.time()
+    backend.write_batches(
+        backend.get_client(),
+        table_name,
+        stream_batches(
+            parquet_file,
+            offset=offset,
+            span=span,
+            first_replay=first_replay,
+            batch_size=batch_size,
+            stop=stop,
+            stats=stats,
+        ),
+        workers,
+    )
+    elapsed = time.time() - t_start
+
+    return {
+        "ingest_rows": stats["rows"],
+        "ingest_rows_per_s": int(stats["rows"] / elapsed),
+        "next_replay": stats["replay"] + 1,
+    }
+
+
+def run_queries(
+    backend,
+    *,
+    table_name: str,
+    n_tags: int,
+    start: str,
+    end: str,
+    stop: threading.Event,
+) -> dict[str, list[float]]:
+    """
+    Run random queries on a client of its own until `stop` is set.
+    """
+    client = backend.get_client()
+    latencies: dict[str, list[float]] = {kind: [] for kind in queries.QUERY_KINDS}
+
+    while not stop.is_set():
+        kind = random.choice(list(queries.QUERY_KINDS))
+        tag_ids = random.sample(range(n_tags), min(queries.QUERY_KINDS[kind], n_tags))
+        sql = backend.build_query(
+            kind, table_name=table_name, tag_ids=tag_ids, start=start, end=end
+        )
+
+        t_start = time.time()
+        backend.run_query(client, sql)
+        latencies[kind].append(time.time() - t_start)
+
+    return latencies
+
+
+def run_phase(
+    backend,
+    phase: str,
+    *,
+    table_name: str,
+    parquet_file: pq.ParquetFile,
+    offset: pd.Timedelta,
+    span: pd.Timedelta,
+    first_replay: int,
+    workers: int,
+    batch_size: int,
+    n_tags: int,
+) -> dict:
+    stop = threading.Event()
+    t_min, t_max = ingest.get_time_range(parquet_file)
+    start = (pd.Timestamp(t_min) + offset).isoformat()
+    end = (pd.Timestamp(t_max) + offset + pd.Timedelta(seconds=1)).isoformat()
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=1 + QUERY_CLIENTS
+    ) as executor:
+        ingest_future = None
+        if phase != "query_only":
+            ingest_future = executor.submit(
+                run_ingest,
+                backend,
+                table_name=table_name,
+                parquet_file=parquet_file,
+                offset=offset,
+                span=span,
+                first_replay=first_replay,
+                workers=workers,
+                batch_size=batch_size,
+                stop=stop,
+            )
+
+        query_futures = []
+        if phase != "ingest_only":
+            query_futures = [
+                executor.submit(
+                    run_queries,
+                    backend,
+                    table_name=table_name,
+                    n_tags=n_tags,
+                    start=start,
+                    end=end,
+                    stop=stop,
+                )
+                for _ in range(QUERY_CLIENTS)
+            ]
+
+        time.sleep(DURATION_S)
+        stop.set()
+
+        result: dict = {"next_replay": first_replay}
+        if ingest_future:
+            result.update(ingest_future.result())
+
+        for kind in queries.QUERY_KINDS:
+            latencies = [t for f in query_futures for t in f.result()[kind]]
+            if query_futures:
+                result.update(
+                    {
+                        f"{kind}_{k}": v
+                        for k, v in queries.summarize_latencies(latencies).items()
+                    }
+                )
+
+    return result
+
+
+def compare(rows: dict[str, dict]) -> dict:
+    """
+    Mixed phase relative to each in isolation.
+    """
+    mixed = rows["mixed"]
+    comparison = {
+        "ingest_degradation": round(
+            1 - mixed["ingest_rows_per_s"] / rows["ingest_only"]["ingest_rows_per_s"], 3
+        )
+    }
+    for kind in queries.QUERY_KINDS:
+        for q in ["p50", "p95", "p99"]:
+            comparison[f"{kind}_{q}_ratio"] = round(
+                mixed[f"{kind}_{q}_ms"] / rows["query_only"][f"{kind}_{q}_ms"], 2
+            )
+    return comparison
+
+
+def main():
+    load_dotenv(override=True)
+
+    Path("data_stats/contention").mkdir(exist_ok=True)
+
+    for name in queries.BACKENDS:
+        if not config.is_enabled(name):
+            continue
+        backend = queries.get_backend(name)
+        client = backend.get_client()
+        data: dict[int, list[dict]] = {}
+
+        for case in config.get_cases(name):
+            case_name, workers = case.name, case.workers
+            print(f"{name} {case_name} ({workers} workers)")
+
+            table_name = f"_{case_name}_contention"
+
+            parquet_file = ingest.open_case(case_name)
+            t_min, t_max = ingest.get_time_range(parquet_file)
+            offset = get_time_offset(t_min)
+            span = (
+                pd.Timestamp(t_max)
+                - pd.Timestamp(t_min)
+                + pd.Timedelta(seconds=case.seconds_interval)
+            )
+
+            # Queries read the first replay, which is loaded up front
+            queries.load_case(
+                backend,
+                client,
+                table_name,
+                parquet_file,
+                offset=offset.to_pytimedelta(),
+                workers=workers,
+                batch_size=case.batch_size,
+            )
+
+            rows: dict[str, dict] = {}
+            next_replay = 1
+            for phase in PHASES:
+                print(f"\t{phase}")
+                rows[phase] = run_phase(
+                    backend,
+                    phase,
+                    table_name=table_name,
+                    parquet_file=parquet_file,
+                    offset=offset,
+                    span=span,
+                    first_replay=next_replay,
+                    workers=workers,
+                    batch_size=case.batch_size,
+                    n_tags=case.n_tags,
+                )
+                next_replay = rows[phase].pop("next_replay")
+
+                if "ingest_rows_per_s" in rows[phase]:
+                    print(f"\t\t{rows[phase]['ingest_rows_per_s']} rows/s")
+                for kind in queries.QUERY_KINDS:
+                    if f"{kind}_p99_ms" in rows[phase]:
+                        print(f"\t\t{kind}: p99 {rows[phase][f'{kind}_p99_ms']} ms")
+
+            comparison = compare(rows)
+            print(f"\t{comparison}")
+
+            for phase in PHASES:
+                data.setdefault(workers, []).append(
+                    {
+                        "phase": phase,
+                        "n_tags": case.n_tags,
+                        "seconds_interval": case.seconds_interval,
+                        "query_clients": QUERY_CLIENTS,
+                        "duration_s": DURATION_S,
+                        **rows[phase],
+                        **(comparison if phase == "mixed" else {}),
+                    }
+                )
+
+        for workers, rows in data.items():
+            df_stats = pd.DataFrame(rows)
+            file_name = f"data_stats/contention/{name}_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+            df_stats.to_csv(file_name, index=False)
+
+
+if __name__ == "__main__":
+    main()
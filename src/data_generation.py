@@ -1,106 +1,208 @@
-import string
-
-import numpy as np
-import pandas as pd
+# numpy and pandas are imported where they're used, so listing cases (see
+# cli.py) doesn't pay for them.
 
-from config import config
+from __future__ import annotations
 
-
-def generate_case_name(*, minutes: int, n_tags: int, seconds_interval: int) -> str:
-    return f"{minutes}_minutes_of_{n_tags}_tags_at_{seconds_interval}_second_intervals"
+import string
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import config
+
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+
+
+# Realism options for generate_dataframe. "ideal" is perfectly aligned data at
+# one rate for every tag, which flatters compression and merges.
+REALISM: dict[str, dict] = {
+    "ideal": {},
+    "telemetry": {
+        "jitter_ms": 250,
+        "out_of_order_fraction": 0.01,
+        "out_of_order_max_s": 30,
+        "gap_fraction": 0.02,
+        "gap_length": 10,
+        "zipf_a": 0.5,
+        "shuffle_types": True,
+        "random_walk": True,
+        "str_cardinality": 16,
+        "long_tail_tag_ids": True,
+    },
+}
+
+
+def generate_case_name(
+    *, minutes: int, n_tags: int, seconds_interval: int, realism: str = "ideal"
+) -> str:
+    case_name = (
+        f"{minutes}_minutes_of_{n_tags}_tags_at_{seconds_interval}_second_intervals"
+    )
+    return case_name if realism == "ideal" else f"{case_name}_{realism}"
 
 
 def generate_random_strings(*, n: int, length: int = 10) -> np.ndarray:
+    import numpy as np
+
     characters = np.array(list(string.ascii_letters + string.digits))
     indices = np.random.randint(0, characters.size, size=(n, length))
     return np.array(["".join(row) for row in characters[indices]])
 
 
+def generate_tag_ids(*, n_tags: int, long_tail: bool = False) -> np.ndarray:
+    import numpy as np
+
+    if not long_tail:
+        return np.arange(n_tags)
+
+    # Sparse IDs with heavy-tailed gaps, like IDs handed out over years of
+    # adding and retiring devices (capped so they fit a signed 32-bit INT)
+    gaps = np.minimum(np.random.zipf(1.5, size=n_tags), 100_000)
+    return np.cumsum(gaps) - 1
+
+
 def generate_dataframe(
-    *, minutes: int, n_tags: int, seconds_interval: int
+    *,
+    minutes: int,
+    n_tags: int,
+    seconds_interval: int,
+    jitter_ms: int = 0,
+    out_of_order_fraction: float = 0.0,
+    out_of_order_max_s: int = 0,
+    gap_fraction: float = 0.0,
+    gap_length: int = 1,
+    zipf_a: float = 0.0,
+    shuffle_types: bool = False,
+    random_walk: bool = False,
+    str_cardinality: int | None = None,
+    long_tail_tag_ids: bool = False,
 ) -> pd.DataFrame:
+    """
+    Generate `minutes` of data for `n_tags` tags sampled every `seconds_interval`.
+
+    The defaults give perfectly aligned timestamps at the same rate for every tag.
+    Optionally:
+    - jitter_ms: delay each timestamp by up to this many milliseconds
+    - out_of_order_fraction/out_of_order_max_s: rows that arrive up to this late
+    - gap_fraction/gap_length: drop this fraction of runs of `gap_length` samples
+    - zipf_a: Zipf-skewed rates, the tag of rank r is sampled every r^a intervals
+    - shuffle_types: assign value types to random tags instead of tag_id bands
+    - random_walk: floats follow a per-tag random walk instead of uniform noise
+    - str_cardinality: strings come from an enum of this many values
+    - long_tail_tag_ids: sparse tag IDs with heavy-tailed gaps
+    """
+    import numpy as np
+    import pandas as pd
+
     total_seconds = minutes * 60
+    start = np.datetime64("2025-01-01T00:00:00", "ns")
+
+    # Interval of each tag as a multiple of the base interval
+    ranks = np.random.permutation(n_tags) + 1 if zipf_a else np.ones(n_tags)
+    intervals = np.ceil(ranks**zipf_a).astype(np.int64) * seconds_interval
+    intervals = np.minimum(intervals, total_seconds)
+
+    # Calculate how many data points we need for each tag
+    num_points = np.maximum(total_seconds // intervals, 1)
+    n = int(num_points.sum())
+
+    # One row per (tag, point), tags in contiguous runs
+    tag_index = np.repeat(np.arange(n_tags), num_points)
+    tag_starts = np.cumsum(num_points) - num_points
+    point = np.arange(n) - np.repeat(tag_starts, num_points)
+
+    time = start + (point * intervals[tag_index]).astype("timedelta64[s]")
+    if jitter_ms:
+        time = time + np.random.randint(0, jitter_ms, size=n).astype("timedelta64[ms]")
+
+    # Missing intervals: drop whole runs of gap_length samples
+    keep = np.ones(n, dtype=bool)
+    if gap_fraction:
+        run = (
+            tag_index * (int(num_points.max()) // gap_length + 1) + point // gap_length
+        )
+        runs, run_index = np.unique(run, return_inverse=True)
+        keep = np.random.random(runs.size)[run_index] >= gap_fraction
 
-    # Calculate how many data points we need based on the interval
-    num_points = total_seconds // seconds_interval
-
-    # Create time points once
-    time_points = [
-        pd.Timestamp("2025-01-01 00:00:00")
-        + pd.Timedelta(seconds=point * seconds_interval)
-        for point in range(num_points)
-    ]
-
-    data: dict[str, list] = {
-        "time": [],
-        "tag_id": [],
-        "value_int": [],
-        "value_float": [],
-        "value_str": [],
-        "value_bool": [],
-    }
+    # 35% ints, 35% floats, 15% strings, 15% booleans
+    type_rank = np.random.permutation(n_tags) if shuffle_types else np.arange(n_tags)
+    tag_type = np.select(
+        [
+            type_rank < n_tags * 0.35,
+            type_rank < n_tags * 0.7,
+            type_rank < n_tags * 0.85,
+        ],
+        [0, 1, 2],
+        default=3,
+    )
+    row_type = tag_type[tag_index]
 
     # Generate random data
-    # 35% ints, 35% floats, 15% strings, 15% booleans
-    for tag_id in range(n_tags):
-        data["time"].extend(time_points)
-        data["tag_id"].extend([tag_id] * num_points)
-
-        if tag_id < n_tags * 0.35:
-            data["value_int"].extend(
-                np.random.randint(0, 101, size=num_points).tolist()  # type: ignore
-            )
-            data["value_float"].extend([None] * num_points)
-            data["value_str"].extend([None] * num_points)
-            data["value_bool"].extend([None] * num_points)
-        elif tag_id < n_tags * 0.7:
-            data["value_int"].extend([None] * num_points)
-            data["value_float"].extend(np.random.rand(num_points).tolist())  # type: ignore
-            data["value_str"].extend([None] * num_points)
-            data["value_bool"].extend([None] * num_points)
-        elif tag_id < n_tags * 0.85:
-            data["value_int"].extend([None] * num_points)
-            data["value_float"].extend([None] * num_points)
-            data["value_str"].extend(generate_random_strings(n=num_points).tolist())
-            data["value_bool"].extend([None] * num_points)
-        else:
-            data["value_int"].extend([None] * num_points)
-            data["value_float"].extend([None] * num_points)
-            data["value_str"].extend([None] * num_points)
-            data["value_bool"].extend(
-                (np.random.random(num_points) > 0.5).tolist()  # type: ignore
-            )
-
-    # Create DataFrame directly from the data dictionary
-    df = pd.DataFrame(data)
-
-    # Sort the data
-    df = df.sort_values(by=["time", "tag_id"]).reset_index(drop=True)
-
-    df = df.astype(
+    value_int = np.random.randint(0, 101, size=n)
+    if random_walk:
+        steps = np.random.normal(0, 0.01, size=n)
+        walk = np.cumsum(steps)
+        # Restart the walk at each tag from a random level
+        walk -= np.repeat(walk[tag_starts] - steps[tag_starts], num_points)
+        value_float = np.random.rand(n_tags)[tag_index] + walk
+    else:
+        value_float = np.random.rand(n)
+    value_bool = np.random.random(n) > 0.5
+    if str_cardinality:
+        pool = generate_random_strings(n=str_cardinality)
+        value_str = pool[np.random.randint(0, str_cardinality, size=n)]
+    else:
+        value_str = np.full(n, None, dtype=object)
+        value_str[row_type == 2] = generate_random_strings(n=int((row_type == 2).sum()))
+
+    df = pd.DataFrame(
         {
-            "value_int": "Int64",
-            "value_float": "Float64",
-            "value_str": "string",
-            "value_bool": "boolean",
+            "time": time,
+            "tag_id": generate_tag_ids(n_tags=n_tags, long_tail=long_tail_tag_ids)[
+                tag_index
+            ],
+            "value_int": pd.arrays.IntegerArray(value_int, row_type != 0),
+            "value_float": pd.arrays.FloatingArray(value_float, row_type != 1),
+            "value_str": pd.array(
+                np.where(row_type == 2, value_str, None), dtype="string"
+            ),
+            "value_bool": pd.arrays.BooleanArray(value_bool, row_type != 3),
         }
+    )[keep]
+
+    # Sort the data in arrival order, late rows arrive after their timestamp
+    arrival = df["time"]
+    if out_of_order_fraction:
+        late = np.random.random(len(df)) < out_of_order_fraction
+        delay = np.random.randint(0, out_of_order_max_s + 1, size=len(df)) * late
+        arrival = arrival + pd.to_timedelta(delay, unit="s").to_numpy()
+    df = (
+        df.assign(arrival=arrival)
+        .sort_values(by=["arrival", "tag_id"])
+        .drop(columns="arrival")
+        .reset_index(drop=True)
     )
+
     return df
 
 
 def main():
-    for minutes in config["minutes"]:
-        for n_tags in config["tags"]:
-            for seconds_interval in config["seconds_interval"]:
-                case_name = generate_case_name(
-                    minutes=minutes, n_tags=n_tags, seconds_interval=seconds_interval
-                )
-                print(case_name)
-
-                df = generate_dataframe(
-                    minutes=minutes, n_tags=n_tags, seconds_interval=seconds_interval
-                )
-                df.to_parquet(f"data/{case_name}.parquet")
+    # Every dataset once, however many cases share it
+    for case in config.get_datasets(config.get_cases()):
+        print(case.name)
+        if Path(f"data/{case.name}.parquet").exists():
+            print("\talready generated")
+            continue
+
+        df = generate_dataframe(
+            minutes=case.minutes,
+            n_tags=case.n_tags,
+            seconds_interval=case.seconds_interval,
+            **REALISM[case.realism],
+        )
+        # Bounded row groups so readers can stream the file
+        df.to_parquet(f"data/{case.name}.parquet", row_group_size=1_000_000)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,350 @@
+# Coordinated load generation from several processes or hosts.
+#
+# One process on one host can be the bottleneck instead of the database. The
+# coordinator hands every load generator a disjoint partition of each case (by
+# tag or by time), starts them together at an agreed wall-clock instant and
+# merges their per-second progress into one result row.
+#
+# With LOCAL the coordinator spawns PROCESSES load generators itself. Otherwise
+# it listens on all interfaces and every host runs
+#   DISTRIBUTED_AUTHKEY=<secret> DISTRIBUTED_COORDINATOR=10.0.0.1:6000 python distributed.py
+# with the coordinator started under the same DISTRIBUTED_AUTHKEY.
+#
+# NOTE: Hosts need synchronized clocks (NTP) for the shared start and the
+# per-second buckets to line up.
+
+import multiprocessing
+import os
+import secrets
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from dotenv import load_dotenv
+
+import config
+import ingest
+import queries
+import utils
+
+BACKEND = "clickhouse"
+PROCESSES = 4
+LOCAL = True
+# "tag" (tag_id % PROCESSES) or "time" (equal spans of the case)
+PARTITION = "tag"
+PORT = 6000
+# Listeners on these only take local connections
+LOOPBACK_HOSTS = {"127.0.0.1", "::1", "localhost"}
+# Time between the last worker being ready and the start
+START_DELAY_S = 2.0
+PROGRESS_INTERVAL_S = 1.0
+
+
+def get_authkey() -> bytes:
+    """
+    Get the shared secret of the coordinator and the load generators.
+
+    Connections unpickle what they receive, so the key is what keeps anyone
+    who can reach the port from running code on either side.
+    """
+    authkey = os.getenv("DISTRIBUTED_AUTHKEY")
+    if not authkey:
+        raise ValueError(
+            "DISTRIBUTED_AUTHKEY must be set to a secret shared by all hosts"
+        )
+    return authkey.encode()
+
+
+def filter_partition(
+    batch: pa.RecordBatch, *, partition: str, index: int, count: int, bounds: tuple
+) -> pa.RecordBatch:
+    """
+    Keep the rows of partition `index` out of `count`.
+    """
+    if partition == "tag":
+        mask = batch.column("tag_id").to_numpy() % count == index
+    else:
+        times = pc.cast(
+            pc.cast(batch.column("time"), pa.timestamp("ns")), pa.int64()
+        ).to_numpy()
+        t_min, t_max = bounds
+        mask = (times - t_min) * count // (t_max - t_min + 1) == index
+    return batch.filter(pa.array(mask))
+
+
+def prepare_generator(task: dict) -> dict:
+    """
+    Open the case and connect, everything a load generator does before the
+    shared start.
+    """
+    # peak_rss_B is the peak of this case only
+    utils.reset_peak_rss()
+    backend = queries.get_backend(task["backend"])
+    return {
+        "backend": backend,
+        # One per writer thread, connected now
+        "clients": [backend.get_client() for _ in range(task["workers"])],
+        "parquet_file": ingest.open_case(task["case_name"]),
+    }
+
+
+def run_generator(conn: Connection, task: dict, prepared: dict) -> dict:
+    """
+    Ingest one partition of a case from the shared start, reporting the
+    cumulative rows the backend acknowledged every second.
+    """
+    backend, clients = prepared["backend"], prepared["clients"]
+    parquet_file = prepared["parquet_file"]
+    offset = pd.Timedelta(seconds=task["offset_s"]).to_pytimedelta()
+
+    stats = {"rows": 0}
+    lock = threading.Lock()
+    local = threading.local()
+
+    def write(batch: pa.RecordBatch) -> None:
+        # Clients aren't shared between threads, and every batch is written on
+        # its own so only acknowledged rows are counted
+        if not hasattr(local, "client"):
+            with lock:
+                local.client = clients.pop()
+        backend.write_batches(local.client, task["table_name"], [batch], 1)
+        with lock:
+            stats["rows"] += batch.num_rows
+
+    def batches():
+        for batch in ingest.iter_batches(
+            parquet_file, batch_size=task["batch_size"], stats={}
+        ):
+            batch = filter_partition(
+                batch,
+                partition=task["partition"],
+                index=task["index"],
+                count=task["count"],
+                bounds=task["bounds"],
+            )
+            if batch.num_rows:
+                yield ingest.shift_time(batch, offset)
+
+    done = threading.Event()
+
+    def report() -> None:
+        while not done.wait(PROGRESS_INTERVAL_S):
+            conn.send({"type": "progress", "t": time.time(), "rows": stats["rows"]})
+
+    time.sleep(max(0.0, task["start_at"] - time.time()))
+
+    reporter = threading.Thread(target=report)
+    reporter.start()
+    t_start = time.time()
+    try:
+        ingest.map_bounded(write, batches(), workers=task["workers"])
+        t_end = time.time()
+    finally:
+        done.set()
+        reporter.join()
+
+    return {
+        "type": "done",
+        "t_start": t_start,
+        "t": t_end,
+        "rows": stats["rows"],
+        "insert_time_s": round(t_end - t_start, 3),
+        "peak_rss_B": utils.get_peak_rss(),
+        "host": socket.gethostname(),
+    }
+
+
+def run_worker(address: tuple[str, int], authkey: bytes | None = None) -> None:
+    load_dotenv(override=True)
+
+    with Client(address, authkey=authkey or get_authkey()) as conn:
+        conn.send({"type": "hello", "host": socket.gethostname(), "pid": os.getpid()})
+        while True:
+            message = conn.recv()
+            if message["type"] == "stop":
+                return
+
+            # Set up before reporting ready, so the start time the coordinator
+            # answers with only has the ingest left
+            prepared = prepare_generator(message)
+            conn.send({"type": "ready"})
+            task = {**message, **conn.recv()}
+            conn.send(run_generator(conn, task, prepared))
+
+
+def merge_progress(messages: list[list[dict]], start_at: float) -> pd.Series:
+    """
+    Total rows per second since the start, summed over the load generators.
+    """
+    per_second = []
+    for worker_messages in messages:
+        df = pd.DataFrame(worker_messages)
+        df["second"] = ((df["t"] - start_at) // 1).astype(int)
+        cumulative = df.groupby("second")["rows"].max()
+        per_second.append(cumulative.diff().fillna(cumulative))
+    return pd.concat(per_second, axis=1).fillna(0).sum(axis=1).sort_index()
+
+
+def run_coordinator(
+    *,
+    host: str,
+    port: int,
+    processes: int,
+    backend_name: str,
+    partition: str,
+    local: bool,
+) -> None:
+    load_dotenv(override=True)
+
+    if not config.is_enabled(backend_name):
+        print(f"{backend_name} is disabled in the config")
+        return
+
+    Path("data_stats/distributed").mkdir(exist_ok=True)
+    backend = queries.get_backend(backend_name)
+
+    if os.getenv("DISTRIBUTED_AUTHKEY") or host not in LOOPBACK_HOSTS:
+        authkey = get_authkey()
+    else:
+        # Only this host can connect, and the spawned generators get the key
+        authkey = secrets.token_bytes(32)
+
+    with Listener((host, port), authkey=authkey) as listener:
+        if local:
+            for _ in range(processes):
+                multiprocessing.Process(
+                    target=run_worker, args=(listener.address, authkey), daemon=True
+                ).start()
+
+        conns = []
+        for _ in range(processes):
+            conn = listener.accept()
+            hello = conn.recv()
+            print(f"load generator {len(conns)}: {hello['host']} ({hello['pid']})")
+            conns.append(conn)
+
+        data = []
+
+        for case in config.get_cases(backend_name):
+            case_name, workers = case.name, case.workers
+            print(f"{case_name} ({workers} workers per process)")
+
+            table_name = f"_{case_name}_distributed"
+            backend.reset_table(backend.get_client(), table_name)
+
+            parquet_file = ingest.open_case(case_name)
+            n_rows = parquet_file.metadata.num_rows
+            t_min, t_max = ingest.get_time_range(parquet_file)
+            # Timescale and InfluxDB expect recent data
+            offset = pd.Timestamp.now("UTC").floor("min").tz_localize(
+                None
+            ) - pd.Timestamp(t_min)
+
+            for index, conn in enumerate(conns):
+                conn.send(
+                    {
+                        "type": "task",
+                        "backend": backend_name,
+                        "case_name": case_name,
+                        # InfluxDB resets to a fresh measurement, which the
+                        # load generators don't know about
+                        "table_name": getattr(
+                            backend, "get_measurement", lambda name: name
+                        )(table_name),
+                        "workers": workers,
+                        "batch_size": case.batch_size,
+                        "partition": partition,
+                        "index": index,
+                        "count": processes,
+                        "bounds": (
+                            pd.Timestamp(t_min).value,
+                            pd.Timestamp(t_max).value,
+                        ),
+                        "offset_s": offset.total_seconds(),
+                    }
+                )
+
+            # Barrier: every load generator has opened the case and connected,
+            # the measured window starts at start_at for all of them
+            for conn in conns:
+                assert conn.recv()["type"] == "ready"
+            start_at = time.time() + START_DELAY_S
+            for conn in conns:
+                conn.send({"start_at": start_at})
+
+            progress: list[list[dict]] = [[] for _ in conns]
+            results: list[dict | None] = [None for _ in conns]
+            while any(result is None for result in results):
+                for index in [i for i, r in enumerate(results) if r is None]:
+                    while conns[index].poll():
+                        message = conns[index].recv()
+                        if message["type"] == "progress":
+                            progress[index].append(message)
+                        else:
+                            results[index] = message
+                            progress[index].append(message)
+                            break
+                time.sleep(0.05)
+
+            # From the first write to the last one finishing, which is start_at
+            # unless a start message arrived late
+            t_first = min(r["t_start"] for r in results)  # type: ignore
+            wall_time = max(r["t"] for r in results) - t_first  # type: ignore
+            rows = sum(r["rows"] for r in results)  # type: ignore
+            per_second = merge_progress(progress, start_at)
+            print(
+                f"\t{rows} rows in {round(wall_time, 3)} s, {int(rows / wall_time)} rows/s"
+            )
+
+            data.append(
+                {
+                    "processes": processes,
+                    "partition": partition,
+                    "workers_per_process": workers,
+                    "n_tags": case.n_tags,
+                    "seconds_interval": case.seconds_interval,
+                    "data_points": n_rows,
+                    "delivered_rows": rows,
+                    "wall_time_s": round(wall_time, 3),
+                    "rows_per_s": int(rows / wall_time),
+                    "p50_rows_per_s": int(per_second.median()),
+                    "min_rows_per_s": int(per_second.min()),
+                    "max_rows_per_s": int(per_second.max()),
+                    "slowest_process_s": max(r["insert_time_s"] for r in results),  # type: ignore
+                    "max_peak_rss_B": max(r["peak_rss_B"] for r in results),  # type: ignore
+                    "hosts": len({r["host"] for r in results}),  # type: ignore
+                }
+            )
+
+        for conn in conns:
+            conn.send({"type": "stop"})
+            conn.close()
+
+    df_stats = pd.DataFrame(data)
+    file_name = f"data_stats/distributed/{backend_name}_{processes}_processes_{'remote' if utils.get_remote() else 'local'}.csv"
+    df_stats.to_csv(file_name, index=False)
+
+
+def main():
+    coordinator = os.getenv("DISTRIBUTED_COORDINATOR")
+    if coordinator:
+        host, port = coordinator.rsplit(":", 1)
+        run_worker((host, int(port)))
+    else:
+        run_coordinator(
+            host="127.0.0.1" if LOCAL else "0.0.0.0",
+            port=PORT,
+            processes=PROCESSES,
+            backend_name=BACKEND,
+            partition=PARTITION,
+            local=LOCAL,
+        )
+
+
+if __name__ == "__main__":
+    main()
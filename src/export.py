@@ -0,0 +1,173 @@
+# Bulk export of a table or time range to Parquet.
+#
+# The range is cut into time slices that are read in parallel, each with its
+# own connection, through every backend's fastest bulk path (see export_slice
+# in the backend modules). Batches are streamed into one Parquet file per slice,
+# so memory stays at a few batches per reader regardless of the table size.
+
+import itertools
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+import config
+import ingest
+import queries
+import utils
+
+# Every backend's rows are normalized to this schema
+EXPORT_SCHEMA = pa.schema(
+    [
+        ("time", pa.timestamp("us")),
+        ("tag_id", pa.int32()),
+        ("value_int", pa.int32()),
+        ("value_float", pa.float64()),
+        ("value_str", pa.string()),
+        ("value_bool", pa.bool_()),
+    ]
+)
+
+SLICES_PER_WORKER = 4
+
+
+def normalize_batch(batch: pa.RecordBatch) -> pa.RecordBatch:
+    """
+    Cast a batch to EXPORT_SCHEMA, e.g. QuestDB's SYMBOL tag_id and INT value_bool.
+    """
+    columns = []
+    for field in EXPORT_SCHEMA:
+        column = batch.column(field.name)
+        if pa.types.is_timestamp(column.type) and column.type.tz is not None:
+            # Timestamps are UTC, keep the instant and drop the zone
+            column = pc.cast(column, pa.timestamp(column.type.unit))
+        columns.append(pc.cast(column, field.type, safe=False))
+    return pa.RecordBatch.from_arrays(columns, schema=EXPORT_SCHEMA)
+
+
+def get_slices(start: pd.Timestamp, end: pd.Timestamp, n: int) -> list[tuple[str, str]]:
+    bounds = pd.date_range(start, end, periods=n + 1)
+    return [(a.isoformat(), b.isoformat()) for a, b in itertools.pairwise(bounds)]
+
+
+def export_table(
+    backend,
+    table_name: str,
+    *,
+    start: pd.Timestamp,
+    end: pd.Timestamp,
+    out_dir: str | Path,
+    workers: int,
+    slices: int | None = None,
+) -> dict:
+    """
+    Export the rows in [start, end) to `out_dir/part-XXXXX.parquet`, one file
+    per time slice.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    def export(item: tuple[int, tuple[str, str]]) -> int:
+        index, (slice_start, slice_end) = item
+        rows = 0
+        with pq.ParquetWriter(
+            out_dir / f"part-{index:05d}.parquet", EXPORT_SCHEMA
+        ) as writer:
+            for batch in backend.export_slice(
+                table_name, start=slice_start, end=slice_end
+            ):
+                writer.write_batch(normalize_batch(batch))
+                rows += batch.num_rows
+        return rows
+
+    t_start = time.time()
+    rows = ingest.map_bounded(
+        export,
+        enumerate(get_slices(start, end, slices or SLICES_PER_WORKER * workers)),
+        workers=workers,
+    )
+    export_time = time.time() - t_start
+
+    return {
+        "exported_rows": sum(rows),
+        "parquet_B": sum(path.stat().st_size for path in out_dir.glob("*.parquet")),
+        "export_time_s": round(export_time, 3),
+        "rows_per_s": int(sum(rows) / export_time),
+    }
+
+
+def main():
+    load_dotenv(override=True)
+
+    Path("data_stats/export").mkdir(exist_ok=True)
+
+    for name in queries.BACKENDS:
+        if not config.is_enabled(name):
+            continue
+        backend = queries.get_backend(name)
+        client = backend.get_client()
+        data: dict[int, list[dict]] = {}
+
+        loaded_case = None
+        for case in config.get_cases(name):
+            case_name, workers = case.name, case.workers
+            print(f"{name} {case_name} ({workers} workers)")
+
+            table_name = f"_{case_name}_export"
+            # Cases of a dataset only differ in the export workers, load it once
+            if case_name != loaded_case:
+                parquet_file = ingest.open_case(case_name)
+                n_rows = parquet_file.metadata.num_rows
+                t_min, t_max = ingest.get_time_range(parquet_file)
+                # Timescale and InfluxDB expect recent data
+                now = pd.Timestamp.now("UTC").floor("min").tz_localize(None)
+                offset = now - pd.Timestamp(t_min)
+
+                queries.load_case(
+                    backend,
+                    client,
+                    table_name,
+                    parquet_file,
+                    offset=offset.to_pytimedelta(),
+                    workers=workers,
+                    batch_size=case.batch_size,
+                )
+                loaded_case = case_name
+
+            # peak_rss_B is the peak of this export only, without the load
+            utils.reset_peak_rss()
+            with tempfile.TemporaryDirectory() as out_dir:
+                stats = export_table(
+                    backend,
+                    table_name,
+                    start=pd.Timestamp(t_min) + offset,
+                    end=pd.Timestamp(t_max) + offset + pd.Timedelta(seconds=1),
+                    out_dir=out_dir,
+                    workers=workers,
+                )
+            print(f"\t{stats['rows_per_s']} rows/s")
+
+            data.setdefault(workers, []).append(
+                {
+                    "n_tags": case.n_tags,
+                    "seconds_interval": case.seconds_interval,
+                    "data_points": n_rows,
+                    **stats,
+                    "complete": stats["exported_rows"] == n_rows,
+                    "peak_rss_B": utils.get_peak_rss(),
+                }
+            )
+
+        for workers, rows in data.items():
+            df_stats = pd.DataFrame(rows)
+            file_name = f"data_stats/export/{name}_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+            df_stats.to_csv(file_name, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+# Fault injection harness for long ingest runs.
+#
+# A local proxy sits between the writer and a backend stand-in and adds latency,
+# drops connections and answers with 429/5xx, including after the write went
+# through (a lost acknowledgement). Chunks are posted as gzipped line protocol
+# with an idempotency key, so the stand-in can tell delivered rows from
+# duplicates. Each fault profile runs uninterrupted and as a crash halfway
+# followed by a resume from the checkpoint.
+
+import gzip
+import itertools
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import requests
+
+import config
+import ingest
+import line_protocol
+
+# Probabilities per request, latency is uniform up to latency_ms
+FAULT_PROFILES: dict[str, dict] = {
+    "none": {},
+    "flaky": {
+        "latency_ms": 50,
+        "drop": 0.02,
+        "error_5xx": 0.03,
+        "throttle_429": 0.03,
+        "lost_ack": 0.02,
+    },
+    "hostile": {
+        "latency_ms": 250,
+        "drop": 0.1,
+        "error_5xx": 0.1,
+        "throttle_429": 0.1,
+        "lost_ack": 0.05,
+    },
+}
+
+TIMEOUT_S = 10
+RETRIES = 8
+
+
+class StandIn:
+    """
+    Backend stand-in that keeps the row count of every idempotency key.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.chunks: dict[str, int] = {}
+            self.received_rows = 0
+
+    def get_handler(self) -> type[BaseHTTPRequestHandler]:
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                rows = body.count(b"\n")
+
+                with stand_in.lock:
+                    stand_in.chunks[self.headers["Idempotency-Key"]] = rows
+                    stand_in.received_rows += rows
+
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
+
+
+def get_proxy_handler(
+    *, upstream: str, profile: dict, stats: dict
+) -> type[BaseHTTPRequestHandler]:
+    lock = threading.Lock()
+
+    def count(key: str) -> None:
+        with lock:
+            stats[key] = stats.get(key, 0) + 1
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            time.sleep(random.uniform(0, profile.get("latency_ms", 0)) / 1000)
+
+            roll = random.random()
+            for fault, status in [
+                ("drop", None),
+                ("error_5xx", 503),
+                ("throttle_429", 429),
+            ]:
+                if roll < profile.get(fault, 0):
+                    count(fault)
+                    if status is None:
+                        # Hang up without an answer
+                        self.close_connection = True
+                    else:
+                        self.send_response(status)
+                        self.end_headers()
+                    return
+                roll -= profile.get(fault, 0)
+
+            response = requests.post(
+                upstream,
+                data=body,
+                headers={
+                    k: v
+                    for k, v in self.headers.items()
+                    if k in ("Content-Encoding", "Content-Type", "Idempotency-Key")
+                },
+                timeout=TIMEOUT_S,
+            )
+
+            status = response.status_code
+            if roll < profile.get("lost_ack", 0):
+                count("lost_ack")
+                status = 503
+            self.send_response(status)
+            self.end_headers()
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    return Handler
+
+
+def serve(handler: type[BaseHTTPRequestHandler]) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_ingest(
+    *,
+    url: str,
+    case_name: str,
+    workers: int,
+    batch_size: int,
+    checkpoint: ingest.Checkpoint,
+    max_chunks: int | None = None,
+) -> dict:
+    local = threading.local()
+
+    def post_chunk(index: int, batch: pa.RecordBatch) -> None:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        payload = line_protocol.encode_batch(
+            batch, measurement=case_name, tag_columns=["tag_id"]
+        )
+        response = local.session.post(
+            url,
+            data=gzip.compress(payload, compresslevel=1),
+            headers={
+                "Content-Encoding": "gzip",
+                "Content-Type": "text/plain; charset=utf-8",
+                "Idempotency-Key": str(index),
+            },
+            timeout=TIMEOUT_S,
+        )
+        response.raise_for_status()
+
+    batches = ingest.iter_batches(
+        ingest.open_case(case_name), batch_size=batch_size, stats={}
+    )
+    stats: dict = {"error": None}
+    t_start = time.time()
+    try:
+        ingest.write_chunks(
+            post_chunk,
+            itertools.islice(batches, max_chunks),
+            workers=workers,
+            checkpoint=checkpoint,
+            retries=RETRIES,
+            stats=stats,
+        )
+    except (requests.RequestException, OSError) as e:
+        # A chunk ran out of retries, which shows up as missing rows
+        stats["error"] = repr(e)
+    stats["insert_time_s"] = time.time() - t_start
+    return stats
+
+
+def main():
+    Path("data_stats/fault_injection").mkdir(exist_ok=True)
+
+    stand_in = StandIn()
+    upstream = serve(stand_in.get_handler())
+
+    data: dict[int, list[dict]] = {}
+
+    # A stand-in plays the backend, so the cases aren't any backend's
+    for case in config.get_cases():
+        case_name, workers = case.name, case.workers
+        print(f"{case_name} ({workers} workers)")
+
+        n_rows = ingest.open_case(case_name).metadata.num_rows
+        n_chunks = -(-n_rows // case.batch_size)
+        baseline_rows_per_s = None
+
+        for (name, profile), crash in itertools.product(
+            FAULT_PROFILES.items(), [False, True]
+        ):
+            stand_in.reset()
+            proxy_stats: dict = {}
+            proxy = serve(
+                get_proxy_handler(
+                    upstream=f"http://127.0.0.1:{upstream.server_address[1]}/write",
+                    profile=profile,
+                    stats=proxy_stats,
+                )
+            )
+            url = f"http://127.0.0.1:{proxy.server_address[1]}/write"
+
+            with tempfile.TemporaryDirectory() as checkpoint_dir:
+                checkpoint = ingest.Checkpoint(
+                    Path(checkpoint_dir) / f"{case_name}.chk"
+                )
+                runs = []
+                if crash:
+                    # Stop after half of the chunks, as if the process died
+                    runs.append(
+                        run_ingest(
+                            url=url,
+                            case_name=case_name,
+                            workers=workers,
+                            batch_size=case.batch_size,
+                            checkpoint=checkpoint,
+                            max_chunks=n_chunks // 2,
+                        )
+                    )
+                runs.append(
+                    run_ingest(
+                        url=url,
+                        case_name=case_name,
+                        workers=workers,
+                        batch_size=case.batch_size,
+                        checkpoint=checkpoint,
+                    )
+                )
+                checkpoint.close()
+
+            proxy.shutdown()
+            proxy.server_close()
+
+            insert_time = sum(run["insert_time_s"] for run in runs)
+            delivered_rows = sum(stand_in.chunks.values())
+            rows_per_s = int(delivered_rows / insert_time)
+            if baseline_rows_per_s is None:
+                baseline_rows_per_s = rows_per_s
+
+            scenario = f"{name}{'_crash_resume' if crash else ''}"
+            print(f"\t{scenario}: {delivered_rows}/{n_rows} rows, {rows_per_s} rows/s")
+
+            data.setdefault(workers, []).append(
+                {
+                    "scenario": scenario,
+                    "n_tags": case.n_tags,
+                    "seconds_interval": case.seconds_interval,
+                    "data_points": n_rows,
+                    "delivered_rows": delivered_rows,
+                    "duplicate_rows": stand_in.received_rows - delivered_rows,
+                    "completeness": round(delivered_rows / n_rows, 4),
+                    "chunks": sum(run["chunks"] for run in runs),
+                    "skipped_chunks": sum(run["skipped"] for run in runs),
+                    "retries": sum(run["retries"] for run in runs),
+                    "error": next((run["error"] for run in runs if run["error"]), None),
+                    **{f"injected_{k}": v for k, v in proxy_stats.items()},
+                    "insert_time_s": round(insert_time, 3),
+                    "rows_per_s": rows_per_s,
+                    "throughput_cost": round(1 - rows_per_s / baseline_rows_per_s, 3),
+                }
+            )
+
+    upstream.shutdown()
+
+    for workers, rows in data.items():
+        df_stats = pd.DataFrame(rows)
+        df_stats.to_csv(
+            f"data_stats/fault_injection/{workers}_workers.csv", index=False
+        )
+
+
+if __name__ == "__main__":
+    main()
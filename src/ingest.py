@@ -0,0 +1,273 @@
+# Streaming ingest pipeline shared by the backends.
+#
+# Cases are read lazily from memory-mapped Parquet as Arrow record batches and
+# handed straight to the backend writers, with a bounded number of batches in
+# flight. Peak memory is then set by batch size x in-flight batches instead of
+# by the size of the dataset.
+
+import concurrent.futures
+import random
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import requests
+
+# Same dtypes pd.read_parquet restores for the generated cases
+PANDAS_TYPES = {
+    pa.int64(): pd.Int64Dtype(),
+    pa.int32(): pd.Int32Dtype(),
+    pa.float64(): pd.Float64Dtype(),
+    pa.string(): pd.StringDtype(),
+    pa.large_string(): pd.StringDtype(),
+    pa.bool_(): pd.BooleanDtype(),
+}
+
+
+# Every row populates exactly one of these, depending on its tag's type
+VALUE_COLUMNS = ["value_int", "value_float", "value_str", "value_bool"]
+
+
+def open_case(case_name: str) -> pq.ParquetFile:
+    return pq.ParquetFile(f"data/{case_name}.parquet", memory_map=True)
+
+
+def iter_batches(
+    parquet_file: pq.ParquetFile, *, batch_size: int, stats: dict
+) -> Iterator[pa.RecordBatch]:
+    """
+    Lazily read record batches, adding the time spent reading to
+    `stats["load_time_s"]`.
+    """
+    stats.setdefault("load_time_s", 0.0)
+    batches = parquet_file.iter_batches(batch_size=batch_size)
+    while True:
+        t_start = time.perf_counter()
+        batch = next(batches, None)
+        stats["load_time_s"] += time.perf_counter() - t_start
+        if batch is None:
+            return
+        yield batch
+
+
+def from_dataframe(df: pd.DataFrame, *, chunksize: int) -> list[pa.RecordBatch]:
+    return pa.Table.from_pandas(df, preserve_index=False).to_batches(
+        max_chunksize=chunksize
+    )
+
+
+def to_pandas(batch: pa.RecordBatch) -> pd.DataFrame:
+    return batch.to_pandas(types_mapper=PANDAS_TYPES.get)
+
+
+def get_time_range(parquet_file: pq.ParquetFile, column: str = "time"):
+    """
+    Get the (min, max) timestamps from the row group statistics.
+    """
+    index = parquet_file.schema_arrow.get_field_index(column)
+    metadata = parquet_file.metadata
+    stats = [
+        metadata.row_group(i).column(index).statistics
+        for i in range(metadata.num_row_groups)
+    ]
+    return min(s.min for s in stats), max(s.max for s in stats)
+
+
+def get_month_offset(t: datetime, *, month: int) -> timedelta:
+    """
+    Offset that moves `t` into `month` of the same year.
+
+    Equivalent to `x.replace(month=month)` per row as long as the data sits
+    inside one calendar month, which holds for every generated case.
+    """
+    return t.replace(month=month) - t
+
+
+def shift_time(
+    batch: pa.RecordBatch, offset: timedelta, *, column: str = "time"
+) -> pa.RecordBatch:
+    times = pc.cast(batch.column(column), pa.timestamp("ns"))
+    shifted = pc.add(times, pa.scalar(offset, type=pa.duration("ns")))
+    return batch.set_column(batch.schema.get_field_index(column), column, shifted)
+
+
+def split_by_type(
+    batch: pa.RecordBatch, *, value_types: np.ndarray | None = None
+) -> list[pa.RecordBatch]:
+    """
+    Split a batch into one narrow batch per value type, with only the populated
+    value column next to the key columns.
+
+    With `value_types` (per row, indices into VALUE_COLUMNS, e.g. from
+    `TagRegistry.get_types`) rows are grouped by their tag's type instead of by
+    scanning the value columns for nulls.
+    """
+    keys = [name for name in batch.schema.names if name not in VALUE_COLUMNS]
+
+    narrow = []
+    for value_type, name in enumerate(VALUE_COLUMNS):
+        if name not in batch.schema.names:
+            continue
+        if value_types is None:
+            populated = pc.is_valid(batch.column(name))
+            n_populated = pc.sum(populated).as_py() or 0
+        else:
+            populated = pa.array(value_types == value_type)
+            n_populated = int(np.count_nonzero(value_types == value_type))
+        # The cases are in arrival order, so a batch spans many tags and nearly
+        # always mixes all four types. Only a batch of a single type (e.g.
+        # from a narrow source) skips the filter
+        if n_populated == batch.num_rows:
+            narrow.append(batch.select([*keys, name]))
+        elif n_populated:
+            narrow.append(batch.select([*keys, name]).filter(populated))
+    return narrow
+
+
+def route_by_type(batches: Iterable[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+    for batch in batches:
+        yield from split_by_type(batch)
+
+
+def map_bounded(
+    fn: Callable,
+    items: Iterable,
+    *,
+    workers: int,
+    max_in_flight: int | None = None,
+) -> list:
+    """
+    Like `executor.map`, but only pulls `max_in_flight` items ahead of the
+    workers and re-raises the first failure.
+    """
+    max_in_flight = max_in_flight or 2 * workers
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending: set[concurrent.futures.Future] = set()
+        for item in items:
+            if len(pending) >= max_in_flight:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                results.extend(f.result() for f in done)
+            pending.add(executor.submit(fn, item))
+
+        results.extend(f.result() for f in concurrent.futures.as_completed(pending))
+
+    return results
+
+
+class Checkpoint:
+    """
+    Indices of the chunks already written, appended to a file as they complete
+    so an interrupted run can resume where it stopped.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.done: set[int] = set()
+        if self.path.exists():
+            for line in self.path.read_text().splitlines():
+                # The last line may be torn by a crash
+                if line.isdigit():
+                    self.done.add(int(line))
+
+        self._lock = threading.Lock()
+        self._file = self.path.open("a", buffering=1)
+
+    def __contains__(self, index: int) -> bool:
+        return index in self.done
+
+    def mark(self, index: int) -> None:
+        with self._lock:
+            self._file.write(f"{index}\n")
+            self.done.add(index)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def is_retryable(exc: Exception) -> bool:
+    """
+    Whether `exc` is transient: a dropped or timed out connection, throttling,
+    a server error or a driver's OperationalError. Anything else, e.g. a
+    rejected schema or a bug, fails the same way on every retry.
+    """
+    if isinstance(exc, requests.HTTPError):
+        if exc.response is None:
+            return False
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    if isinstance(
+        exc,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            ConnectionError,
+            TimeoutError,
+        ),
+    ):
+        return True
+    # DB-API drivers raise OperationalError for lost connections and the like,
+    # matched by name so no driver has to be imported here
+    return any(cls.__name__ == "OperationalError" for cls in type(exc).__mro__)
+
+
+def write_chunks(
+    fn: Callable[[int, pa.RecordBatch], None],
+    batches: Iterable[pa.RecordBatch],
+    *,
+    workers: int,
+    checkpoint: Checkpoint | None = None,
+    retries: int = 5,
+    backoff_s: float = 0.2,
+    stats: dict | None = None,
+) -> dict:
+    """
+    Write numbered chunks through `fn(index, batch)` with `map_bounded`.
+
+    Failed chunks are retried with exponential backoff, so `fn` must be
+    idempotent. Chunks in the checkpoint are skipped and completed ones are
+    added to it. Counts of written, skipped and retried chunks go into `stats`.
+    """
+    stats = stats if stats is not None else {}
+    for key in ["chunks", "skipped", "retries"]:
+        stats.setdefault(key, 0)
+    lock = threading.Lock()
+
+    def write(item: tuple[int, pa.RecordBatch]) -> None:
+        index, batch = item
+        for attempt in range(retries + 1):
+            try:
+                fn(index, batch)
+                break
+            except Exception as e:
+                if attempt == retries or not is_retryable(e):
+                    raise
+                with lock:
+                    stats["retries"] += 1
+                time.sleep(backoff_s * 2**attempt * random.uniform(0.5, 1.5))
+
+        if checkpoint is not None:
+            checkpoint.mark(index)
+        with lock:
+            stats["chunks"] += 1
+
+    def pending() -> Iterator[tuple[int, pa.RecordBatch]]:
+        for index, batch in enumerate(batches):
+            if checkpoint is not None and index in checkpoint:
+                stats["skipped"] += 1
+                continue
+            yield index, batch
+
+    map_bounded(write, pending(), workers=workers)
+    return stats
@@ -0,0 +1,254 @@
+# Latest value of every tag, from a snapshot kept up to date on ingest.
+#
+# "Current value of every tag" is the most common read, and answered from the
+# raw table it's a scan or group by over all of it. The backends with a
+# snapshot expose
+#   create_latest_table(client, table_name)            -> set up the snapshot
+#   write_latest(client, table_name, batches, workers) -> insert time (s)
+#   build_latest_query(table_name, *, snapshot)        -> SQL
+# ClickHouse keeps it in a ReplacingMergeTree fed by a materialized view,
+# Timescale upserts it from the COPY pipeline and QuestDB has LATEST ON.
+# LatestMap is the client-side fallback for the others.
+#
+# Read latency is compared with the raw query, and the freshness lag is the time
+# from a write being acknowledged until a snapshot read returns it for every
+# tag (the write itself is reported as the marker insert time).
+
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from dotenv import load_dotenv
+
+import config
+import ingest
+import queries
+import utils
+
+SNAPSHOT_BACKENDS = ["clickhouse", "questdb", "timescale"]
+# Cases with at least this many tags
+N_TAGS = 100_000
+REPEATS = 20
+FRESHNESS_TIMEOUT_S = 60
+
+
+class LatestMap:
+    """
+    In-memory latest row of every tag, updated from the batches as they're
+    written.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.df: pd.DataFrame | None = None
+
+    def update(self, batch: pa.RecordBatch) -> None:
+        df = ingest.to_pandas(batch)
+        # The newest row of every tag in the batch
+        df = df.sort_values("time").drop_duplicates("tag_id", keep="last")
+        df = df.set_index("tag_id")
+
+        with self.lock:
+            if self.df is not None:
+                df = pd.concat([self.df, df]).sort_values("time", kind="stable")
+                df = df[~df.index.duplicated(keep="last")]
+            self.df = df
+
+    def snapshot(self) -> pa.Table:
+        with self.lock:
+            df = self.df
+        if df is None:
+            return pa.table({"tag_id": pa.array([], pa.int32())})
+        return pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+
+
+def get_marker_batch(
+    schema: pa.Schema, *, tag_ids: pa.Array, t: pd.Timestamp
+) -> pa.RecordBatch:
+    """
+    One row per tag at `t`, newer than anything loaded.
+    """
+    columns = {
+        "time": pa.array([t.to_datetime64()] * len(tag_ids), schema.field("time").type),
+        "tag_id": pc.cast(tag_ids, schema.field("tag_id").type),
+        "value_int": pa.array([1] * len(tag_ids), schema.field("value_int").type),
+    }
+    return pa.RecordBatch.from_arrays(
+        [
+            columns.get(field.name, pa.nulls(len(tag_ids), field.type))
+            for field in schema
+        ],
+        schema=schema,
+    )
+
+
+def count_fresh(table: pa.Table, t: pd.Timestamp) -> int:
+    # Timestamps come back in UTC with or without a zone, compare the instants
+    times = table.column("time")
+    if times.type.tz is not None:
+        times = pc.cast(times, pa.timestamp(times.type.unit))
+    times = pc.cast(times, pa.timestamp("us"))
+    fresh = pc.greater_equal(times, pa.scalar(t.to_datetime64(), pa.timestamp("us")))
+    return pc.sum(fresh).as_py() or 0
+
+
+def measure_freshness(
+    backend, client, table_name: str, batch: pa.RecordBatch, *, t: pd.Timestamp
+) -> dict:
+    """
+    Time to write `batch` and from the write returning until the snapshot
+    shows all of it.
+    """
+    t_start = time.time()
+    backend.write_latest(client, table_name, [batch], 1)
+    t_ack = time.time()
+
+    sql = backend.build_latest_query(table_name, snapshot=True)
+    while count_fresh(backend.run_query(client, sql), t) < batch.num_rows:
+        if time.time() - t_ack > FRESHNESS_TIMEOUT_S:
+            raise TimeoutError(
+                f"{table_name} snapshot stale after {FRESHNESS_TIMEOUT_S} s"
+            )
+        time.sleep(0.01)
+
+    return {
+        "marker_insert_time_s": round(t_ack - t_start, 3),
+        "freshness_lag_s": round(time.time() - t_ack, 3),
+    }
+
+
+def measure_reads(read) -> dict:
+    latencies = []
+    for _ in range(REPEATS):
+        t_start = time.time()
+        read()
+        latencies.append(time.time() - t_start)
+    return queries.summarize_latencies(latencies)
+
+
+def main():
+    load_dotenv(override=True)
+
+    Path("data_stats/latest").mkdir(exist_ok=True)
+
+    for name in ["client_map", *SNAPSHOT_BACKENDS]:
+        if name != "client_map" and not config.is_enabled(name):
+            continue
+        data = []
+
+        cases = [
+            case
+            for case in config.get_cases(None if name == "client_map" else name)
+            if case.n_tags >= N_TAGS
+        ]
+        for case in cases:
+            case_name, workers = case.name, case.workers
+            print(f"{name} {case_name}")
+            # peak_rss_B is the peak of this case only
+            utils.reset_peak_rss()
+
+            parquet_file = ingest.open_case(case_name)
+            n_rows = parquet_file.metadata.num_rows
+            tag_ids = pc.unique(parquet_file.read(columns=["tag_id"]).column("tag_id"))
+            t_min, t_max = ingest.get_time_range(parquet_file)
+            # Timescale and InfluxDB expect recent data
+            offset = pd.Timestamp.now("UTC").floor("min").tz_localize(
+                None
+            ) - pd.Timestamp(t_min)
+            t_marker = pd.Timestamp(t_max) + offset + pd.Timedelta(minutes=1)
+            schema = parquet_file.schema_arrow.remove_metadata()
+
+            batches = (
+                ingest.shift_time(batch, offset.to_pytimedelta())
+                for batch in ingest.iter_batches(
+                    parquet_file, batch_size=case.batch_size, stats={}
+                )
+            )
+
+            if name == "client_map":
+                # Only the cost of keeping the map, on top of any writer
+                latest = LatestMap()
+                t_start = time.time()
+                for batch in batches:
+                    latest.update(batch)
+                insert_time = time.time() - t_start
+                # Updated before a batch is handed to the writer
+                freshness = {"marker_insert_time_s": 0.0, "freshness_lag_s": 0.0}
+
+                raw = {}
+                snapshot = measure_reads(latest.snapshot)
+            else:
+                backend = queries.get_backend(name)
+                client = backend.get_client()
+                table_name = f"_{case_name}_latest"
+
+                backend.reset_table(client, table_name)
+                backend.create_latest_table(client, table_name)
+                insert_time = backend.write_latest(client, table_name, batches, workers)
+
+                # A first marker waits out whatever of the load is still being
+                # applied (e.g. QuestDB's WAL), the second one is measured
+                measure_freshness(
+                    backend,
+                    client,
+                    table_name,
+                    get_marker_batch(schema, tag_ids=tag_ids, t=t_marker),
+                    t=t_marker,
+                )
+                t_marker += pd.Timedelta(minutes=1)
+                freshness = measure_freshness(
+                    backend,
+                    client,
+                    table_name,
+                    get_marker_batch(schema, tag_ids=tag_ids, t=t_marker),
+                    t=t_marker,
+                )
+
+                raw = measure_reads(
+                    lambda: backend.run_query(
+                        client, backend.build_latest_query(table_name, snapshot=False)
+                    )
+                )
+                snapshot = measure_reads(
+                    lambda: backend.run_query(
+                        client, backend.build_latest_query(table_name, snapshot=True)
+                    )
+                )
+
+            print(
+                f"\tsnapshot p50 {snapshot['p50_ms']} ms, raw p50 {raw.get('p50_ms')} ms"
+            )
+            print(f"\tfreshness lag {freshness['freshness_lag_s']} s")
+
+            data.append(
+                {
+                    "n_tags": case.n_tags,
+                    "seconds_interval": case.seconds_interval,
+                    "realism": case.realism,
+                    "workers": workers,
+                    "data_points": n_rows,
+                    "insert_time_s": round(insert_time, 3),
+                    **freshness,
+                    **{f"snapshot_{k}": v for k, v in snapshot.items()},
+                    **{f"raw_{k}": v for k, v in raw.items()},
+                    "speedup_p50": (
+                        round(raw["p50_ms"] / snapshot["p50_ms"], 2) if raw else None
+                    ),
+                    "peak_rss_B": utils.get_peak_rss(),
+                }
+            )
+
+        if not data:
+            print(f"{name}: no case with {N_TAGS} or more tags")
+            continue
+
+        df_stats = pd.DataFrame(data)
+        file_name = f"data_stats/latest/{name}_{'remote' if utils.get_remote() else 'local'}.csv"
+        df_stats.to_csv(file_name, index=False)
+
+
+if __name__ == "__main__":
+    main()
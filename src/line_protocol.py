@@ -0,0 +1,110 @@
+# https://docs.influxdata.com/influxdb/cloud-serverless/reference/syntax/line-protocol/
+
+# Vectorized line protocol encoding. Every row is built with Arrow compute
+# kernels, so the resulting string array's data buffer *is* the payload:
+#
+#   <measurement>,<tag>=<value> <field>=<value>,... <timestamp>\n
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+def escape_key(key: str) -> str:
+    # Measurement names, tag keys and field keys escape commas, spaces and "="
+    return key.replace(",", r"\,").replace(" ", r"\ ").replace("=", r"\=")
+
+
+def encode_tag(*, key: str, values: pa.Array) -> pa.Array:
+    values = pc.cast(values, pa.string())
+    values = pc.replace_substring_regex(values, pattern=r"([ ,=])", replacement=r"\\\1")
+    return pc.binary_join_element_wise(f"{escape_key(key)}=", values, "")
+
+
+def encode_field(*, key: str, values: pa.Array) -> pa.Array:
+    """
+    Encode a column as `key=value` strings. Nulls stay null so they are skipped.
+    """
+    prefix = f"{escape_key(key)}="
+
+    if pa.types.is_boolean(values.type):
+        return pc.binary_join_element_wise(
+            prefix, pc.if_else(values, "true", "false"), ""
+        )
+
+    if pa.types.is_integer(values.type):
+        return pc.binary_join_element_wise(
+            prefix, pc.cast(values, pa.string()), "i", ""
+        )
+
+    if pa.types.is_floating(values.type):
+        # NaN and +/-inf can't be represented in line protocol
+        values = pc.if_else(pc.is_finite(values), values, pa.scalar(None, values.type))
+        return pc.binary_join_element_wise(prefix, pc.cast(values, pa.string()), "")
+
+    if pa.types.is_string(values.type) or pa.types.is_large_string(values.type):
+        values = pc.replace_substring_regex(
+            values, pattern=r'(["\\])', replacement=r"\\\1"
+        )
+        return pc.binary_join_element_wise(prefix, '"', values, '"', "")
+
+    raise TypeError(f"Unsupported field type {values.type} for {key}")
+
+
+def encode_batch(
+    batch: pa.RecordBatch,
+    *,
+    measurement: str,
+    tag_columns: list[str],
+    timestamp_column: str = "time",
+) -> pa.Buffer:
+    """
+    Encode a record batch as a line protocol payload (nanosecond precision).
+
+    Null fields are left out of their line; rows without any field are dropped.
+    """
+    field_columns = [
+        name
+        for name in batch.schema.names
+        if name not in tag_columns and name != timestamp_column
+    ]
+
+    fields = pc.binary_join_element_wise(
+        *[encode_field(key=name, values=batch.column(name)) for name in field_columns],
+        ",",
+        null_handling="skip",
+    )
+    has_fields = pc.not_equal(fields, "")
+
+    head = pc.binary_join_element_wise(
+        escape_key(measurement),
+        *[encode_tag(key=name, values=batch.column(name)) for name in tag_columns],
+        ",",
+        null_handling="skip",
+    )
+
+    timestamps = pc.cast(
+        pc.cast(batch.column(timestamp_column), pa.timestamp("ns")), pa.int64()
+    )
+    tail = pc.binary_join_element_wise(pc.cast(timestamps, pa.string()), "\n", "")
+
+    lines = pc.binary_join_element_wise(head, fields, tail, " ")
+    lines = pc.filter(lines, has_fields)
+
+    return to_buffer(lines)
+
+
+def to_buffer(lines: pa.Array) -> pa.Buffer:
+    """
+    Get the concatenated values of a string array without copying.
+    """
+    if len(lines) == 0 or lines.null_count == len(lines):
+        return pa.py_buffer(b"")
+
+    offsets = np.frombuffer(
+        lines.buffers()[1],
+        dtype=np.int32,
+        count=len(lines) + 1,
+        offset=lines.offset * 4,
+    )
+    return lines.buffers()[2].slice(int(offsets[0]), int(offsets[-1] - offsets[0]))
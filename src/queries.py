@@ -0,0 +1,82 @@
+# Query helpers shared by the read benchmarks.
+#
+# Every backend module exposes the same small interface for them:
+#   get_client()                                   -> client/connection
+#   reset_table(client, table_name)                -> drop and create the table
+#   write_batches(client, table_name, batches, workers) -> insert time (s)
+#   build_query(kind, *, table_name, tag_ids, start, end) -> SQL
+#   run_query(client, sql)                         -> pa.Table
+
+import importlib
+import statistics
+from datetime import timedelta
+from types import ModuleType
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import ingest
+
+BACKENDS = ["clickhouse", "cratedb", "influxdb", "questdb", "tdengine", "timescale"]
+
+# point: raw rows of one tag, downsample: 1 minute buckets of a few tags,
+# last_value: the latest row of many tags
+QUERY_KINDS = {
+    "point": 1,
+    "downsample": 10,
+    "last_value": 100,
+}
+
+
+def get_backend(name: str) -> ModuleType:
+    return importlib.import_module(f"_{name}")
+
+
+def load_case(
+    backend: ModuleType,
+    client,
+    table_name: str,
+    parquet_file: pq.ParquetFile,
+    *,
+    offset: timedelta,
+    workers: int,
+    batch_size: int = 100_000,
+) -> float:
+    """
+    Recreate the table and load a case into it, shifted by `offset`.
+    """
+    backend.reset_table(client, table_name)
+    return backend.write_batches(
+        client,
+        table_name,
+        (
+            ingest.shift_time(batch, offset)
+            for batch in ingest.iter_batches(
+                parquet_file, batch_size=batch_size, stats={}
+            )
+        ),
+        workers,
+    )
+
+
+def rows_to_table(names: list[str], rows: list) -> pa.Table:
+    columns = list(zip(*rows)) if rows else [[] for _ in names]
+    return pa.table({name: pa.array(column) for name, column in zip(names, columns)})
+
+
+def summarize_latencies(latencies: list[float]) -> dict:
+    """
+    Get count and p50/p95/p99 latencies (in milliseconds).
+    """
+    if len(latencies) < 2:
+        p50 = p95 = p99 = latencies[0] if latencies else float("nan")
+    else:
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        p50, p95, p99 = quantiles[49], quantiles[94], quantiles[98]
+
+    return {
+        "queries": len(latencies),
+        "p50_ms": round(p50 * 1000, 2),
+        "p95_ms": round(p95 * 1000, 2),
+        "p99_ms": round(p99 * 1000, 2),
+    }
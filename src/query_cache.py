@@ -0,0 +1,322 @@
+# Read-through cache for downsampled queries.
+#
+# Results are cached per (table, tag set, resolution, aligned time chunk).
+# Chunks that ended more than `grace` ago are closed: their buckets can't change
+# anymore, so they're served from an in-process LRU (bounded in bytes) or an
+# optional on-disk Arrow IPC store. Only the open tail goes to the database on
+# every query.
+#
+# NOTE: Rows arriving later than `grace` won't show up in already cached chunks.
+
+import hashlib
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from dotenv import load_dotenv
+
+import config
+import ingest
+import queries
+import utils
+
+# Matches the 1 minute buckets of the "downsample" queries
+RESOLUTION = "1min"
+
+# Dashboard-style workload: every refresh re-queries the same panels
+PANELS = 8
+REFRESHES = 20
+
+
+def epoch_ns(column) -> pa.Array:
+    return pc.cast(pc.cast(column, pa.timestamp("ns", tz=column.type.tz)), pa.int64())
+
+
+def filter_time(table: pa.Table, start: pd.Timestamp, end: pd.Timestamp) -> pa.Table:
+    times = epoch_ns(table.column("time"))
+    return table.filter(
+        pc.and_(pc.greater_equal(times, start.value), pc.less(times, end.value))
+    )
+
+
+class QueryCache:
+    """
+    LRU of closed chunks of downsampled query results, with an optional
+    on-disk Arrow IPC store behind it.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_bytes: int = 256 * 1024 * 1024,
+        chunk: pd.Timedelta = pd.Timedelta(hours=1),
+        grace: pd.Timedelta = pd.Timedelta(minutes=1),
+        disk_dir: str | Path | None = None,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.chunk = chunk
+        self.grace = grace
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+        self._memory: OrderedDict[tuple, pa.Table] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "fetches": 0,
+            "evictions": 0,
+        }
+
+    def _path(self, key: tuple) -> Path:
+        return self.disk_dir / f"{hashlib.sha1(repr(key).encode()).hexdigest()}.arrow"  # type: ignore
+
+    def _put(self, key: tuple, table: pa.Table, *, to_disk: bool = True) -> None:
+        with self._lock:
+            if key not in self._memory:
+                self._memory[key] = table
+                self._bytes += table.nbytes
+            while self._bytes > self.max_bytes and self._memory:
+                _, evicted = self._memory.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.stats["evictions"] += 1
+
+        if to_disk and self.disk_dir:
+            # Written next to the target and renamed, so readers never see
+            # a partial file
+            path = self._path(key)
+            path_temp = path.with_suffix(f".{threading.get_ident()}.tmp")
+            with pa.OSFile(str(path_temp), "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(path_temp, path)
+
+    def _lookup(self, key: tuple) -> pa.Table | None:
+        with self._lock:
+            table = self._memory.get(key)
+            if table is not None:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                return table
+
+        if self.disk_dir and self._path(key).exists():
+            with pa.memory_map(str(self._path(key))) as source:
+                table = pa.ipc.open_file(source).read_all()
+            self._put(key, table, to_disk=False)
+            self.stats["disk_hits"] += 1
+            return table
+
+        self.stats["misses"] += 1
+        return None
+
+    def get_hit_ratio(self) -> float:
+        hits = self.stats["hits"] + self.stats["disk_hits"]
+        total = hits + self.stats["misses"]
+        return round(hits / total, 3) if total else float("nan")
+
+    def get(
+        self,
+        *,
+        table_name: str,
+        tag_ids: list[int],
+        resolution: str,
+        start: pd.Timestamp,
+        end: pd.Timestamp,
+        fetch: Callable[[pd.Timestamp, pd.Timestamp], pa.Table],
+    ) -> pa.Table:
+        """
+        Get the result for [start, end), widened to whole `resolution` buckets.
+
+        `fetch(start, end)` runs the query against the database. Contiguous
+        missing chunks are fetched together and then split for caching.
+        """
+        start = pd.Timestamp(start).floor(resolution)
+        end = pd.Timestamp(end).ceil(resolution)
+        closed_before = pd.Timestamp.now("UTC").tz_localize(None) - self.grace
+        tags = tuple(sorted(tag_ids))
+
+        chunk_starts = []
+        t = start.floor(self.chunk)
+        while t < end and t + self.chunk <= closed_before:
+            chunk_starts.append(t)
+            t += self.chunk
+        tail_start = t
+
+        tables: dict[pd.Timestamp, pa.Table] = {}
+        missing = []
+        for chunk_start in chunk_starts:
+            table = self._lookup((table_name, tags, resolution, chunk_start))
+            if table is None:
+                missing.append(chunk_start)
+            else:
+                tables[chunk_start] = table
+
+        # Runs of consecutive missing chunks take one round trip each
+        for _, run in itertools.groupby(
+            enumerate(missing), key=lambda x: x[1] - x[0] * self.chunk
+        ):
+            run_starts = [chunk_start for _, chunk_start in run]
+            fetched = fetch(run_starts[0], run_starts[-1] + self.chunk)
+            self.stats["fetches"] += 1
+            for chunk_start in run_starts:
+                table = filter_time(fetched, chunk_start, chunk_start + self.chunk)
+                self._put((table_name, tags, resolution, chunk_start), table)
+                tables[chunk_start] = table
+
+        pieces = [tables[chunk_start] for chunk_start in chunk_starts]
+        if tail_start < end or not pieces:
+            pieces.append(fetch(max(tail_start, start), end))
+            self.stats["fetches"] += 1
+
+        result = pa.concat_tables(pieces, promote_options="permissive")
+        return filter_time(result, start, end)
+
+
+def run_dashboard(
+    backend,
+    client,
+    *,
+    table_name: str,
+    panels: list[list[int]],
+    start: pd.Timestamp,
+    cache: QueryCache | None,
+) -> list[float]:
+    """
+    Refresh every panel REFRESHES times, from `start` up to now.
+    """
+
+    def fetch(tag_ids: list[int], start: pd.Timestamp, end: pd.Timestamp) -> pa.Table:
+        return backend.run_query(
+            client,
+            backend.build_query(
+                "downsample",
+                table_name=table_name,
+                tag_ids=tag_ids,
+                start=start.isoformat(),
+                end=end.isoformat(),
+            ),
+        )
+
+    latencies = []
+    for _ in range(REFRESHES):
+        for tag_ids in panels:
+            end = pd.Timestamp.now("UTC").tz_localize(None)
+            t_start = time.time()
+            if cache is None:
+                fetch(tag_ids, start.floor(RESOLUTION), end.ceil(RESOLUTION))
+            else:
+                cache.get(
+                    table_name=table_name,
+                    tag_ids=tag_ids,
+                    resolution=RESOLUTION,
+                    start=start,
+                    end=end,
+                    fetch=lambda s, e: fetch(tag_ids, s, e),
+                )
+            latencies.append(time.time() - t_start)
+    return latencies
+
+
+def main():
+    load_dotenv(override=True)
+
+    Path("data_stats/query_cache").mkdir(exist_ok=True)
+
+    for name in queries.BACKENDS:
+        if not config.is_enabled(name):
+            continue
+        backend = queries.get_backend(name)
+        client = backend.get_client()
+        data: dict[int, list[dict]] = {}
+
+        for case in config.get_cases(name):
+            case_name, workers = case.name, case.workers
+            print(f"{name} {case_name} ({workers} workers)")
+
+            table_name = f"_{case_name}_cache"
+
+            # Move the case so its last minute is the current, still open, minute
+            parquet_file = ingest.open_case(case_name)
+            t_min, t_max = ingest.get_time_range(parquet_file)
+            now = pd.Timestamp.now("UTC").tz_localize(None)
+            offset = now.floor(RESOLUTION) - pd.Timestamp(t_max).floor(RESOLUTION)
+
+            # Reloaded for every case, the last minute has to be the current one
+            queries.load_case(
+                backend,
+                client,
+                table_name,
+                parquet_file,
+                offset=offset.to_pytimedelta(),
+                workers=workers,
+                batch_size=case.batch_size,
+            )
+
+            rng = random.Random(0)
+            panels = [
+                rng.sample(
+                    range(case.n_tags),
+                    min(queries.QUERY_KINDS["downsample"], case.n_tags),
+                )
+                for _ in range(PANELS)
+            ]
+            start = pd.Timestamp(t_min) + offset
+
+            with tempfile.TemporaryDirectory() as disk_dir:
+                # The cases only span minutes, so chunks are a minute long too
+                chunk = pd.Timedelta(RESOLUTION)
+                modes: dict[str, QueryCache | None] = {
+                    "uncached": None,
+                    "memory": QueryCache(chunk=chunk),
+                    # Nothing is kept in memory, so every hit is read from disk
+                    "disk": QueryCache(chunk=chunk, max_bytes=0, disk_dir=disk_dir),
+                }
+
+                for mode, cache in modes.items():
+                    latencies = run_dashboard(
+                        backend,
+                        client,
+                        table_name=table_name,
+                        panels=panels,
+                        start=start,
+                        cache=cache,
+                    )
+                    summary = queries.summarize_latencies(latencies)
+                    if cache is None:
+                        p50_uncached = summary["p50_ms"]
+                    print(f"\t{mode}: p50 {summary['p50_ms']} ms")
+
+                    data.setdefault(workers, []).append(
+                        {
+                            "mode": mode,
+                            "n_tags": case.n_tags,
+                            "seconds_interval": case.seconds_interval,
+                            "panels": PANELS,
+                            "refreshes": REFRESHES,
+                            **summary,
+                            "p50_speedup": round(p50_uncached / summary["p50_ms"], 2),
+                            "hit_ratio": cache.get_hit_ratio() if cache else 0.0,
+                            **(cache.stats if cache else {}),
+                        }
+                    )
+
+        for workers, rows in data.items():
+            df_stats = pd.DataFrame(rows)
+            file_name = f"data_stats/query_cache/{name}_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+            df_stats.to_csv(file_name, index=False)
+
+
+if __name__ == "__main__":
+    main()
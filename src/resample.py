@@ -0,0 +1,291 @@
+# Resampling to evenly spaced series with the gaps filled.
+#
+# Downsampling takes the first value of every bucket, so buckets without a row
+# are simply missing. resample() returns the dense grid instead, every tag at
+# every step, with the gaps filled by carrying the last value forward (locf) or
+# interpolating linearly (linear). The fill is pushed down where the backend has
+# it (see RESAMPLE_FILLS and build_resample_query in the backend modules):
+#   timescale:  time_bucket_gapfill with locf() and interpolate()
+#   questdb:    SAMPLE BY ... FILL(PREV)
+#   clickhouse: ORDER BY ... WITH FILL INTERPOLATE
+# and otherwise done on the client, vectorized over the whole grid. CrateDB and
+# InfluxDB only bucket on the server and always fill on the client.
+#
+# Buckets before the first value of a tag in the range (and for linear, after
+# the last) stay NaN, wherever the fill happens. A server-side fill is returned
+# as is, so gaps the server doesn't fill (e.g. QuestDB's buckets without a row
+# for any tag) stay NaN too.
+
+import itertools
+import math
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from dotenv import load_dotenv
+
+import config
+import ingest
+import queries
+import utils
+
+RESAMPLE_BACKENDS = ["clickhouse", "cratedb", "influxdb", "questdb", "timescale"]
+RESAMPLE_TAGS = [1_000, 10_000, 100_000]
+STEP_S = 10
+REPEATS = 5
+
+
+def fill_locf(grid: np.ndarray) -> np.ndarray:
+    """
+    Carry the last value of every row of `grid` forward over NaNs.
+    """
+    steps = np.arange(grid.shape[1])
+    prev = np.maximum.accumulate(np.where(np.isnan(grid), -1, steps), axis=1)
+    filled = np.take_along_axis(grid, np.maximum(prev, 0), axis=1)
+    filled[prev < 0] = np.nan
+    return filled
+
+
+def fill_linear(grid: np.ndarray) -> np.ndarray:
+    """
+    Interpolate linearly over the NaNs of every row of `grid` between the
+    values around them.
+    """
+    n_steps = grid.shape[1]
+    steps = np.arange(n_steps)
+    valid = ~np.isnan(grid)
+    prev = np.maximum.accumulate(np.where(valid, steps, -1), axis=1)
+    next_ = np.minimum.accumulate(np.where(valid, steps, n_steps)[:, ::-1], axis=1)[
+        :, ::-1
+    ]
+
+    v_prev = np.take_along_axis(grid, np.maximum(prev, 0), axis=1)
+    v_next = np.take_along_axis(grid, np.minimum(next_, n_steps - 1), axis=1)
+    # Zero for the valid cells, where prev and next are the cell itself
+    span = next_ - prev
+    weight = (steps - prev) / np.where(span == 0, 1, span)
+
+    inside = (prev >= 0) & (next_ < n_steps)
+    return np.where(inside, v_prev + (v_next - v_prev) * weight, np.nan)
+
+
+FILLS = {"locf": fill_locf, "linear": fill_linear}
+
+
+def to_grid(
+    table: pa.Table, *, tag_ids: np.ndarray, start_us: int, step_us: int, n_steps: int
+) -> np.ndarray:
+    """
+    Scatter (time, tag_id, value) rows into a (tag, step) grid, NaN where
+    there's no row. `tag_ids` must be sorted.
+    """
+    grid = np.full((len(tag_ids), n_steps), np.nan)
+    if not table.num_rows:
+        return grid
+
+    times = table.column("time")
+    if times.type.tz is not None:
+        # Timestamps are UTC, keep the instant and drop the zone
+        times = pc.cast(times, pa.timestamp(times.type.unit))
+    times = pc.cast(pc.cast(times, pa.timestamp("us")), pa.int64()).to_numpy()
+    # QuestDB's tag_id is a SYMBOL
+    row_tags = pc.cast(table.column("tag_id"), pa.int64()).to_numpy()
+    values = pc.cast(table.column("value"), pa.float64()).to_numpy(zero_copy_only=False)
+
+    rows = np.searchsorted(tag_ids, row_tags)
+    columns = (times - start_us) // step_us
+    keep = (
+        (rows < len(tag_ids))
+        & (tag_ids[np.minimum(rows, len(tag_ids) - 1)] == row_tags)
+        & (columns >= 0)
+        & (columns < n_steps)
+    )
+    grid[rows[keep], columns[keep]] = values[keep]
+    return grid
+
+
+def grid_to_table(
+    grid: np.ndarray, *, tag_ids: np.ndarray, start_us: int, step_us: int
+) -> pa.Table:
+    """
+    Long (tag_id, time) sorted table of a grid, the value column reshapes back
+    to it without copying.
+    """
+    n_tags, n_steps = grid.shape
+    times = start_us + np.arange(n_steps, dtype=np.int64) * step_us
+    return pa.table(
+        {
+            "time": pa.array(np.tile(times, n_tags).astype("datetime64[us]")),
+            "tag_id": pa.array(np.repeat(tag_ids, n_steps)),
+            "value": pa.array(grid.ravel()),
+        }
+    )
+
+
+def resample(
+    backend,
+    client,
+    table_name: str,
+    *,
+    tag_ids: list[int],
+    start: str,
+    end: str,
+    step_s: int,
+    method: str = "locf",
+    push_down: bool = True,
+) -> pa.Table:
+    """
+    Get the first value of every `step_s` bucket in [start, end) for every tag,
+    with the gaps filled by `method`.
+    """
+    if method not in FILLS:
+        raise ValueError(f"Unknown method {method}, expected one of {list(FILLS)}")
+    if 86_400 % step_s:
+        raise ValueError(f"step_s must divide a day, got {step_s}")
+
+    # Buckets are aligned to the step, like time_bucket and toStartOfInterval
+    start_ts = pd.Timestamp(start).floor(f"{step_s}s")
+    end_ts = pd.Timestamp(end)
+    step_us = step_s * 1_000_000
+    start_us = start_ts.value // 1_000
+    n_steps = math.ceil((end_ts - start_ts) / pd.Timedelta(seconds=step_s))
+    sorted_tag_ids = np.unique(tag_ids)
+
+    fill = method if push_down and method in backend.RESAMPLE_FILLS else None
+    table = backend.run_query(
+        client,
+        backend.build_resample_query(
+            table_name=table_name,
+            tag_ids=sorted_tag_ids.tolist(),
+            start=start_ts.isoformat(),
+            end=end_ts.isoformat(),
+            step_s=step_s,
+            fill=fill,
+        ),
+    )
+
+    grid = to_grid(
+        table,
+        tag_ids=sorted_tag_ids,
+        start_us=start_us,
+        step_us=step_us,
+        n_steps=n_steps,
+    )
+    if not fill:
+        grid = FILLS[method](grid)
+    return grid_to_table(
+        grid, tag_ids=sorted_tag_ids, start_us=start_us, step_us=step_us
+    )
+
+
+def main():
+    load_dotenv(override=True)
+
+    Path("data_stats/resample").mkdir(exist_ok=True)
+
+    for name in RESAMPLE_BACKENDS:
+        if not config.is_enabled(name):
+            continue
+        backend = queries.get_backend(name)
+        client = backend.get_client()
+        data = []
+
+        for case in config.get_cases(name):
+            case_name, workers = case.name, case.workers
+            print(f"{name} {case_name}")
+
+            table_name = f"_{case_name}_resample"
+            parquet_file = ingest.open_case(case_name)
+            all_tag_ids = np.sort(
+                pc.unique(
+                    parquet_file.read(columns=["tag_id"]).column("tag_id")
+                ).to_numpy()
+            )
+            t_min, t_max = ingest.get_time_range(parquet_file)
+            # Timescale and InfluxDB expect recent data
+            offset = pd.Timestamp.now("UTC").floor("min").tz_localize(
+                None
+            ) - pd.Timestamp(t_min)
+
+            queries.load_case(
+                backend,
+                client,
+                table_name,
+                parquet_file,
+                offset=offset.to_pytimedelta(),
+                workers=workers,
+                batch_size=case.batch_size,
+            )
+
+            start = (pd.Timestamp(t_min) + offset).isoformat()
+            end = (pd.Timestamp(t_max) + offset + pd.Timedelta(seconds=1)).isoformat()
+
+            for n, method in itertools.product(RESAMPLE_TAGS, FILLS):
+                if n > len(all_tag_ids):
+                    continue
+                tag_ids = all_tag_ids[:n].tolist()
+
+                grids = {}
+                for push_down in [True, False]:
+                    if push_down and method not in backend.RESAMPLE_FILLS:
+                        continue
+
+                    latencies = []
+                    for _ in range(REPEATS):
+                        t_start = time.time()
+                        table = resample(
+                            backend,
+                            client,
+                            table_name,
+                            tag_ids=tag_ids,
+                            start=start,
+                            end=end,
+                            step_s=STEP_S,
+                            method=method,
+                            push_down=push_down,
+                        )
+                        latencies.append(time.time() - t_start)
+                    grids[push_down] = table.column("value").to_numpy()
+
+                    fill_at = "server" if push_down else "client"
+                    stats = queries.summarize_latencies(latencies)
+                    n_nan = pc.sum(pc.is_nan(table.column("value"))).as_py()
+                    print(
+                        f"\t{n} tags {method} on the {fill_at}: p50 {stats['p50_ms']} ms"
+                    )
+
+                    data.append(
+                        {
+                            "n_tags": case.n_tags,
+                            "seconds_interval": case.seconds_interval,
+                            "realism": case.realism,
+                            "workers": workers,
+                            "resampled_tags": n,
+                            "step_s": STEP_S,
+                            "method": method,
+                            "fill_at": fill_at,
+                            "grid_cells": table.num_rows,
+                            "filled_fraction": round(1 - n_nan / table.num_rows, 4),
+                            **stats,
+                        }
+                    )
+
+                if len(grids) == 2:
+                    # Only equal if the server filled every gap the client does
+                    data[-2]["matches_client"] = bool(
+                        np.allclose(grids[True], grids[False], equal_nan=True)
+                    )
+
+        if not data:
+            continue
+
+        df_stats = pd.DataFrame(data)
+        file_name = f"data_stats/resample/{name}_{'remote' if utils.get_remote() else 'local'}.csv"
+        df_stats.to_csv(file_name, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+# Write-ahead spool in front of the backend writers.
+#
+# Producers append batches as Arrow IPC segments on local disk and are
+# acknowledged as soon as the segment is durable. A drainer thread writes the
+# segments to the backend with a pool of workers and only deletes a segment once
+# its write went through, so an outage just grows the spool and a crash replays
+# whatever is left on the next start. Segments may be written more than once,
+# which the writers already tolerate since they retry idempotently.
+#
+# Writes that fail with a transient error (see ingest.is_retryable) are retried
+# with backoff until the backend recovers or the spool is closed, however long
+# the outage. Segments that can never be written, because the error isn't
+# transient or the segment is unreadable, are moved to failed/ so they neither
+# block the drain nor get replayed, and are left there for inspection.
+#
+# Any writer taking a batch fits, e.g. for ClickHouse:
+#   Spool(path, lambda key, batch: _clickhouse.insert_batches(client, table_name, [batch], 1))
+
+import os
+import random
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import requests
+
+import config
+import fault_injection
+import ingest
+import line_protocol
+import queries
+import utils
+
+
+class Spool:
+    """
+    Disk-backed FIFO of record batches drained to a writer in the background.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        write: Callable[[str, pa.RecordBatch], None],
+        *,
+        max_bytes: int = 10 * 1024**3,
+        workers: int = 4,
+        fsync: bool = True,
+        backoff_s: float = 0.5,
+        max_backoff_s: float = 10.0,
+    ) -> None:
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.write = write
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.fsync = fsync
+        self.backoff_s = backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.failed_path = self.path / "failed"
+
+        # Partial segments of a crashed append were never acknowledged
+        for path_temp in self.path.glob("*.tmp"):
+            path_temp.unlink()
+        segments = self.get_segments()
+
+        self.stats = {
+            "replayed": len(segments),
+            "appended": 0,
+            "drained": 0,
+            "drained_rows": 0,
+            "write_failures": 0,
+            "failed": 0,
+            "max_pending_B": 0,
+        }
+        self._bytes = sum(segment.stat().st_size for segment in segments)
+        self._next = int(segments[-1].stem) + 1 if segments else 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._drainer = threading.Thread(target=self._drain, daemon=True)
+
+    def get_segments(self) -> list[Path]:
+        return sorted(self.path.glob("*.arrow"))
+
+    def get_pending_bytes(self) -> int:
+        with self._cond:
+            return self._bytes
+
+    def start(self) -> "Spool":
+        self._drainer.start()
+        return self
+
+    def append(self, batch: pa.RecordBatch, *, timeout_s: float | None = None) -> None:
+        """
+        Durably add a batch, blocking while the spool is over `max_bytes`.
+        """
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, batch.schema) as writer:
+            writer.write_batch(batch)
+        payload = sink.getvalue()
+
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self._bytes + payload.size <= self.max_bytes or not self._bytes,
+                timeout=timeout_s,
+            ):
+                raise TimeoutError(f"Spool at {self.path} is full")
+            segment = self.path / f"{self._next:012d}.arrow"
+            self._next += 1
+            self._bytes += payload.size
+            self.stats["max_pending_B"] = max(self.stats["max_pending_B"], self._bytes)
+
+        # Written next to the segment and renamed, so the drainer and a replay
+        # never see a partial one
+        path_temp = segment.with_suffix(".tmp")
+        with open(path_temp, "wb") as f:
+            f.write(payload)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path_temp, segment)
+        if self.fsync:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        with self._cond:
+            self.stats["appended"] += 1
+            self._cond.notify_all()
+
+    def _drain_segment(self, segment: Path) -> None:
+        try:
+            with pa.memory_map(str(segment)) as source:
+                batch = pa.ipc.open_stream(source).read_next_batch()
+        except pa.ArrowInvalid:
+            # Only a corrupted disk leaves an unreadable segment behind
+            self._set_aside(segment)
+            return
+
+        attempt = 0
+        while not self._stop.is_set():
+            try:
+                self.write(segment.stem, batch)
+                break
+            except Exception as e:
+                with self._cond:
+                    self.stats["write_failures"] += 1
+                if not ingest.is_retryable(e):
+                    self._set_aside(segment)
+                    return
+                delay = min(self.backoff_s * 2**attempt, self.max_backoff_s)
+                self._stop.wait(delay * random.uniform(0.5, 1.5))
+                # Bounded, the delay is capped long before and 2**attempt would
+                # overflow a float after hours of outage
+                attempt = min(attempt + 1, 32)
+        else:
+            return
+
+        size = segment.stat().st_size
+        segment.unlink()
+        with self._cond:
+            self._bytes -= size
+            self.stats["drained"] += 1
+            self.stats["drained_rows"] += batch.num_rows
+            self._cond.notify_all()
+
+    def _set_aside(self, segment: Path) -> None:
+        """
+        Move a segment that can't be written to failed/.
+        """
+        size = segment.stat().st_size
+        self.failed_path.mkdir(exist_ok=True)
+        os.replace(segment, self.failed_path / segment.name)
+        with self._cond:
+            self._bytes -= size
+            self.stats["failed"] += 1
+            self._cond.notify_all()
+
+    def _drain(self) -> None:
+        while not self._stop.is_set():
+            segments = self.get_segments()
+            if not segments:
+                with self._cond:
+                    self._cond.wait(timeout=0.1)
+                continue
+            ingest.map_bounded(self._drain_segment, segments, workers=self.workers)
+
+    def wait_drained(self, timeout_s: float | None = None) -> bool:
+        """
+        Wait until every segment is written or set aside, False on timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._bytes, timeout=timeout_s)
+
+    def close(self) -> None:
+        """
+        Stop draining, leaving undrained segments for the next start.
+        """
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._drainer.is_alive():
+            self._drainer.join()
+
+
+OUTAGE_S = 30
+# Stop waiting for the drain after this long past the outage
+DRAIN_TIMEOUT_S = 600
+MAX_BYTES = 1024**3
+
+
+def main():
+    Path("data_stats/spool").mkdir(exist_ok=True)
+
+    # The fault injection stand-in and proxy play the backend, the outage is a
+    # proxy answering 503 to everything
+    stand_in = fault_injection.StandIn()
+    upstream = fault_injection.serve(stand_in.get_handler())
+    profile: dict = {}
+    proxy = fault_injection.serve(
+        fault_injection.get_proxy_handler(
+            upstream=f"http://127.0.0.1:{upstream.server_address[1]}/write",
+            profile=profile,
+            stats={},
+        )
+    )
+    url = f"http://127.0.0.1:{proxy.server_address[1]}/write"
+
+    data: dict[int, list[dict]] = {}
+
+    # A stand-in plays the backend, so the cases aren't any backend's
+    for case in config.get_cases():
+        case_name, workers = case.name, case.workers
+        print(f"{case_name} ({workers} workers)")
+
+        stand_in.reset()
+        # peak_rss_B is the peak of this case only
+        utils.reset_peak_rss()
+        local = threading.local()
+
+        def post_segment(key: str, batch: pa.RecordBatch) -> None:
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            response = local.session.post(
+                url,
+                data=line_protocol.encode_batch(
+                    batch, measurement=case_name, tag_columns=["tag_id"]
+                ),
+                headers={"Idempotency-Key": key},
+                timeout=fault_injection.TIMEOUT_S,
+            )
+            response.raise_for_status()
+
+        with tempfile.TemporaryDirectory() as spool_dir:
+            profile["error_5xx"] = 1.0
+            t_outage = time.time()
+
+            spool = Spool(
+                spool_dir, post_segment, max_bytes=MAX_BYTES, workers=workers
+            ).start()
+
+            # Producers keep appending while the backend is down
+            latencies = []
+            n_rows = 0
+            for batch in ingest.iter_batches(
+                ingest.open_case(case_name), batch_size=case.batch_size, stats={}
+            ):
+                t_start = time.time()
+                spool.append(batch)
+                latencies.append(time.time() - t_start)
+                n_rows += batch.num_rows
+            produce_time = time.time() - t_outage
+
+            # Crash during the outage and start over from what's on disk
+            spool.close()
+            spool = Spool(
+                spool_dir, post_segment, max_bytes=MAX_BYTES, workers=workers
+            ).start()
+            replayed = spool.stats["replayed"]
+
+            time.sleep(max(0.0, OUTAGE_S - (time.time() - t_outage)))
+            pending_bytes = spool.get_pending_bytes()
+
+            profile.clear()
+            t_recovered = time.time()
+            if not spool.wait_drained(timeout_s=DRAIN_TIMEOUT_S):
+                print(f"\tnot drained after {DRAIN_TIMEOUT_S} s")
+            drain_time = time.time() - t_recovered
+            failed = spool.stats["failed"]
+            spool.close()
+
+        delivered_rows = sum(stand_in.chunks.values())
+        print(f"\t{int(n_rows / produce_time)} rows/s appended during the outage")
+        print(f"\t{int(delivered_rows / drain_time)} rows/s drained after it")
+
+        data.setdefault(workers, []).append(
+            {
+                "n_tags": case.n_tags,
+                "seconds_interval": case.seconds_interval,
+                "data_points": n_rows,
+                "outage_s": OUTAGE_S,
+                "produce_time_s": round(produce_time, 3),
+                "produce_rows_per_s": int(n_rows / produce_time),
+                **{
+                    f"append_{k}": v
+                    for k, v in queries.summarize_latencies(latencies).items()
+                },
+                "replayed_segments": replayed,
+                "failed_segments": failed,
+                "pending_B": pending_bytes,
+                "drain_time_s": round(drain_time, 3),
+                "drain_rows_per_s": int(delivered_rows / drain_time),
+                "delivered_rows": delivered_rows,
+                "completeness": round(delivered_rows / n_rows, 4),
+                "peak_rss_B": utils.get_peak_rss(),
+            }
+        )
+
+    proxy.shutdown()
+    upstream.shutdown()
+
+    for workers, rows in data.items():
+        df_stats = pd.DataFrame(rows)
+        df_stats.to_csv(f"data_stats/spool/{workers}_workers.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
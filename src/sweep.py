@@ -0,0 +1,332 @@
+# Partitioning and sharding sweep for CrateDB and Timescale.
+#
+# Every layout ingests the same case. We then measure ingest rate, downsample
+# query latency and storage, and project the layout to the production volume
+# from the README (10,000,000 rows/min kept for ~20 years).
+
+import itertools
+import math
+import os
+import statistics
+import time
+from pathlib import Path
+
+import pandas as pd
+import psycopg2
+from dotenv import load_dotenv
+
+import _cratedb
+import _timescale
+import config
+import ingest
+import utils
+
+ROWS_PER_MINUTE = 10_000_000
+RETENTION_YEARS = 20
+MINUTES_PER_YEAR = 365.25 * 24 * 60
+
+# CrateDB: shards should be ~3-70 GB with fewer than 1,000 shards per node
+CRATEDB_NODES = 3
+SHARD_SIZE_GB = (3, 70)
+MAX_SHARDS_PER_NODE = 1_000
+
+# Timescale: a chunk (including its indexes) should fit in ~25% of memory
+TIMESCALE_MEMORY_GB = 32
+
+PARTITION_MINUTES = {
+    "day": 24 * 60,
+    "week": 7 * 24 * 60,
+    "month": MINUTES_PER_YEAR / 12,
+    "year": MINUTES_PER_YEAR,
+}
+
+CRATEDB_SWEEP = {
+    "partition": ["day", "week", "month"],
+    "shards": [1, 4, 8],
+    "replicas": [0, 1],
+}
+
+TIMESCALE_SWEEP = {
+    "chunk_time_interval": {
+        "5 minutes": 5,
+        "1 hour": 60,
+        "1 day": 24 * 60,
+        "7 days": 7 * 24 * 60,
+    },
+    "space_partitions": [None, 4],
+}
+
+QUERY_TAGS = 100
+QUERY_REPEATS = 5
+
+
+def time_query(fn) -> float:
+    """
+    Median latency of a query (in seconds).
+    """
+    latencies = []
+    for _ in range(QUERY_REPEATS):
+        t_start = time.time()
+        fn()
+        latencies.append(time.time() - t_start)
+    return round(statistics.median(latencies), 4)
+
+
+def get_query_range(df: pd.DataFrame) -> tuple[str, str]:
+    return (
+        df["time"].min().isoformat(),
+        (df["time"].max() + pd.Timedelta(seconds=1)).isoformat(),
+    )
+
+
+def project_cratedb(
+    *, bytes_per_row: float, partition: str, shards: int, replicas: int
+) -> dict:
+    partition_minutes = PARTITION_MINUTES[partition]
+    shard_gb = ROWS_PER_MINUTE * partition_minutes * bytes_per_row / shards / 1024**3
+    n_partitions = math.ceil(RETENTION_YEARS * MINUTES_PER_YEAR / partition_minutes)
+    n_shards = n_partitions * shards * (1 + replicas)
+    shards_per_node = n_shards / CRATEDB_NODES
+
+    return {
+        "projected_shard_GB": round(shard_gb, 2),
+        "projected_shards": n_shards,
+        "projected_shards_per_node": round(shards_per_node),
+        "nodes_required": max(CRATEDB_NODES, math.ceil(n_shards / MAX_SHARDS_PER_NODE)),
+        "within_guidance": SHARD_SIZE_GB[0] <= shard_gb <= SHARD_SIZE_GB[1]
+        and shards_per_node < MAX_SHARDS_PER_NODE,
+    }
+
+
+def project_timescale(
+    *, bytes_per_row: float, interval_minutes: int, space_partitions: int | None
+) -> dict:
+    partitions = space_partitions or 1
+    chunk_gb = ROWS_PER_MINUTE * interval_minutes * bytes_per_row / partitions / 1024**3
+    n_chunks = (
+        math.ceil(RETENTION_YEARS * MINUTES_PER_YEAR / interval_minutes) * partitions
+    )
+
+    return {
+        "projected_chunk_GB": round(chunk_gb, 2),
+        "projected_chunks": n_chunks,
+        "within_guidance": chunk_gb <= 0.25 * TIMESCALE_MEMORY_GB,
+    }
+
+
+def sweep_cratedb(
+    *, case_name: str, df: pd.DataFrame, workers: int, batch_size: int
+) -> list[dict]:
+    table_name = f"_{case_name}_sweep"
+    start, end = get_query_range(df)
+
+    data = []
+    for partition, shards, replicas in itertools.product(*CRATEDB_SWEEP.values()):
+        print(f"\tcratedb partition={partition} shards={shards} replicas={replicas}")
+
+        _cratedb.delete_table(conn=_cratedb.get_conn(), table_name=table_name)
+        _cratedb.create_table(
+            conn=_cratedb.get_conn(),
+            table_name=table_name,
+            partition=partition,
+            shards=shards,
+            replicas=replicas,
+        )
+
+        insert_time = _cratedb.insert_bulk_args(
+            table_name=table_name,
+            batches=ingest.from_dataframe(df, chunksize=batch_size),
+            workers=workers,
+        )
+        _cratedb.refresh_table(conn=_cratedb.get_conn(), table_name=table_name)
+
+        query_time = time_query(
+            lambda: _cratedb.query_downsample(
+                conn=_cratedb.get_conn(),
+                table_name=table_name,
+                tag_ids=list(range(QUERY_TAGS)),
+                start=start,
+                end=end,
+            )
+        )
+        table_size = _cratedb.get_table_size(
+            conn=_cratedb.get_conn(), table_name=table_name, primary_only=True
+        )
+
+        data.append(
+            {
+                "partition": partition,
+                "shards": shards,
+                "replicas": replicas,
+                "data_points": len(df),
+                "table_size_B": table_size,
+                "insert_time_s": round(insert_time, 3),
+                "rows_per_s": int(len(df) / insert_time),
+                "query_time_s": query_time,
+                **project_cratedb(
+                    bytes_per_row=table_size / len(df),
+                    partition=partition,
+                    shards=shards,
+                    replicas=replicas,
+                ),
+            }
+        )
+
+    _cratedb.delete_table(conn=_cratedb.get_conn(), table_name=table_name)
+    return data
+
+
+def sweep_timescale(
+    *, case_name: str, df: pd.DataFrame, workers: int, batch_size: int
+) -> list[dict]:
+    table_name = f"_{case_name}_sweep"
+
+    data = []
+    for (chunk_time_interval, interval_minutes), space_partitions in itertools.product(
+        TIMESCALE_SWEEP["chunk_time_interval"].items(),
+        TIMESCALE_SWEEP["space_partitions"],
+    ):
+        print(
+            f"\ttimescale chunk_time_interval={chunk_time_interval} space_partitions={space_partitions}"
+        )
+
+        df_case = df.assign(
+            time=df["time"] + _timescale.get_time_offset(df["time"].min())
+        )
+
+        with psycopg2.connect(os.getenv("TIMESCALE_CONNECTION_STRING")) as conn:
+            # The table must be visible to the insert workers' connections
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                _timescale.delete_table(cursor=cursor, table_name=table_name)
+                _timescale.create_table(
+                    cursor=cursor,
+                    table_name=table_name,
+                    chunk_time_interval=chunk_time_interval,
+                    space_partitions=space_partitions,
+                )
+
+                insert_time = _timescale.insert_batches(
+                    table_name=table_name,
+                    batches=ingest.from_dataframe(df_case, chunksize=batch_size),
+                    workers=workers,
+                )
+
+                start, end = get_query_range(df_case)
+                query_time = time_query(
+                    lambda: _timescale.query_downsample(
+                        cursor=cursor,
+                        table_name=table_name,
+                        tag_ids=list(range(QUERY_TAGS)),
+                        start=start,
+                        end=end,
+                    )
+                )
+                table_size = _timescale.get_table_size(
+                    cursor=cursor, table_name=table_name
+                )
+                _timescale.delete_table(cursor=cursor, table_name=table_name)
+
+        data.append(
+            {
+                "chunk_time_interval": chunk_time_interval,
+                "space_partitions": space_partitions,
+                "data_points": len(df),
+                "table_size_B": table_size,
+                "insert_time_s": insert_time,
+                "rows_per_s": int(len(df) / insert_time),
+                "query_time_s": query_time,
+                **project_timescale(
+                    bytes_per_row=table_size / len(df),
+                    interval_minutes=interval_minutes,
+                    space_partitions=space_partitions,
+                ),
+            }
+        )
+
+    return data
+
+
+def recommend(df_stats: pd.DataFrame, *, sort_by: list[str], ascending: list[bool]):
+    """
+    Pick the best layout inside the guidance, or the closest one if none fits.
+    """
+    candidates = df_stats[df_stats["within_guidance"]]
+    if candidates.empty:
+        candidates = df_stats
+    return candidates.sort_values(by=sort_by, ascending=ascending).iloc[0]
+
+
+def main():
+    load_dotenv(override=True)
+
+    Path("data_stats/sweep").mkdir(exist_ok=True)
+
+    location = "remote" if utils.get_remote() else "local"
+
+    df_case = None
+    for name in ["cratedb", "timescale"]:
+        if not config.is_enabled(name):
+            continue
+
+        for case in config.get_cases(name):
+            case_name, workers = case.name, case.workers
+            print(f"{name} {case_name} ({workers} workers)")
+
+            # Cases of a dataset run back to back, read it once
+            if case_name != df_case:
+                df = pd.read_parquet(f"data/{case_name}.parquet")
+                df_case = case_name
+
+            if name == "cratedb":
+                df_cratedb = pd.DataFrame(
+                    sweep_cratedb(
+                        case_name=case_name,
+                        df=df,
+                        workers=workers,
+                        batch_size=case.batch_size,
+                    )
+                )
+                df_cratedb.to_csv(
+                    f"data_stats/sweep/cratedb_{case_name}_{workers}_workers_{location}.csv",
+                    index=False,
+                )
+                # Fewest nodes first, then the fastest ingest
+                best = recommend(
+                    df_cratedb,
+                    sort_by=["nodes_required", "rows_per_s"],
+                    ascending=[True, False],
+                )
+                print(
+                    f"\tcratedb: PARTITIONED BY {best['partition']}, CLUSTERED INTO {best['shards']} SHARDS, "
+                    f"{best['replicas']} replicas (~{best['projected_shard_GB']} GB/shard, "
+                    f"{best['nodes_required']} nodes)"
+                )
+            else:
+                df_timescale = pd.DataFrame(
+                    sweep_timescale(
+                        case_name=case_name,
+                        df=df,
+                        workers=workers,
+                        batch_size=case.batch_size,
+                    )
+                )
+                df_timescale.to_csv(
+                    f"data_stats/sweep/timescale_{case_name}_{workers}_workers_{location}.csv",
+                    index=False,
+                )
+                # Fewest chunks that still fit in memory, then the fastest ingest
+                best = recommend(
+                    df_timescale,
+                    sort_by=["projected_chunks", "rows_per_s"],
+                    ascending=[True, False],
+                )
+                print(
+                    f"\ttimescale: chunk_time_interval {best['chunk_time_interval']}, "
+                    f"{best['space_partitions']} space partitions "
+                    f"(~{best['projected_chunk_GB']} GB/chunk, {best['projected_chunks']} chunks)"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+# Registry of string-named tags.
+#
+# Production tags are hierarchical names like "site/device/point" with one value
+# type each. The databases only ever see compact integer IDs, handed out here in
+# order of first registration, and route_batch uses the stored type to split
+# batches by value column without scanning them for nulls. Patterns like
+# "site_01/*/temp_*" or "site_01/**" are resolved to ID sets through a trie of
+# the name segments.
+
+import fnmatch
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import ingest
+import queries
+
+SEPARATOR = "/"
+
+
+class TagRegistry:
+    """
+    Bidirectional tag name <-> ID map with value types and a segment trie.
+    """
+
+    def __init__(self) -> None:
+        self._names: list[str] = []
+        self._types = np.empty(0, dtype=np.int8)
+        # Rebuilt lazily after registrations, get_indexer is vectorized
+        self._index: pd.Index | None = pd.Index([], dtype=object)
+        # Nodes are (children by segment, IDs of the names ending here by last segment)
+        self._trie: tuple[dict, dict] = ({}, {})
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def get_index(self) -> pd.Index:
+        if self._index is None:
+            self._index = pd.Index(self._names, dtype=object)
+        return self._index
+
+    def register(self, names, value_types) -> np.ndarray:
+        """
+        Get IDs for `names`, registering the new ones with their `value_types`
+        (indices into ingest.VALUE_COLUMNS).
+        """
+        names = pd.Index(names, dtype=object)
+        value_types = np.asarray(value_types, dtype=np.int8)
+
+        ids = self.get_index().get_indexer(names)
+        new = ids == -1
+        if new.any():
+            new_names = pd.Series(np.asarray(names[new]))
+            first = ~new_names.duplicated().to_numpy()
+            new_names = new_names[first].to_numpy()
+            new_ids = np.arange(len(self._names), len(self._names) + len(new_names))
+
+            self._names.extend(new_names)
+            self._types = np.concatenate([self._types, value_types[new][first]])
+            self._index = None
+            for name, tag_id in zip(new_names, new_ids):
+                *parents, last = name.split(SEPARATOR)
+                node = self._trie
+                for segment in parents:
+                    node = node[0].setdefault(segment, ({}, {}))
+                node[1][last] = int(tag_id)
+
+            ids = self.get_index().get_indexer(names)
+
+        return ids
+
+    def get_ids(self, names) -> np.ndarray:
+        """
+        Convert names to IDs in one vectorized lookup.
+        """
+        ids = self.get_index().get_indexer(pd.Index(names, dtype=object))
+        if (ids == -1).any():
+            unknown = np.asarray(names, dtype=object)[ids == -1]
+            raise KeyError(f"{len(unknown)} unknown tags, e.g. {unknown[0]!r}")
+        return ids
+
+    def get_names(self, ids) -> np.ndarray:
+        return self.get_index()[np.asarray(ids)].to_numpy()
+
+    def get_types(self, ids) -> np.ndarray:
+        return self._types[np.asarray(ids)]
+
+    def route_batch(self, batch: pa.RecordBatch) -> list[pa.RecordBatch]:
+        """
+        Split an encoded batch into one narrow batch per value type (see
+        ingest.split_by_type) by the registered types of its tags.
+        """
+        tag_ids = batch.column("tag_id").to_numpy(zero_copy_only=False)
+        return ingest.split_by_type(batch, value_types=self.get_types(tag_ids))
+
+    def resolve(self, pattern: str) -> np.ndarray:
+        """
+        Get the sorted IDs of all names matching a pattern.
+
+        Segments may contain fnmatch wildcards (`*`, `?`, `[...]`) matching
+        within one segment, and a last segment of `**` matches everything below.
+        """
+        ids: list[int] = []
+
+        def collect(node: tuple[dict, dict]) -> None:
+            ids.extend(node[1].values())
+            for child in node[0].values():
+                collect(child)
+
+        def match(keys, segment: str) -> list[str]:
+            if any(c in segment for c in "*?["):
+                return fnmatch.filter(keys, segment)
+            return [segment] if segment in keys else []
+
+        def walk(node: tuple[dict, dict], segments: list[str]) -> None:
+            segment, rest = segments[0], segments[1:]
+            if segment == "**" and not rest:
+                collect(node)
+            elif rest:
+                for key in match(node[0], segment):
+                    walk(node[0][key], rest)
+            else:
+                ids.extend(node[1][key] for key in match(node[1], segment))
+
+        walk(self._trie, pattern.split(SEPARATOR))
+        return np.sort(np.asarray(ids, dtype=np.int64))
+
+    def encode_batch(
+        self, batch: pa.RecordBatch, *, column: str = "tag_name"
+    ) -> pa.RecordBatch:
+        """
+        Replace a column of tag names by the `tag_id` column.
+        """
+        names = batch.column(column)
+        # Dictionary-encode first, so every distinct name is only looked up once
+        encoded = pc.dictionary_encode(names)
+        ids = self.get_ids(encoded.dictionary.to_numpy(zero_copy_only=False))
+        tag_ids = pa.array(ids.astype(np.int32)).take(encoded.indices)
+
+        index = batch.schema.get_field_index(column)
+        return batch.set_column(index, "tag_id", tag_ids)
+
+    def save(self, path: str | Path) -> None:
+        pq.write_table(
+            pa.table(
+                {
+                    "tag_id": np.arange(len(self._names), dtype=np.int32),
+                    "tag_name": pa.array(self._names, type=pa.string()),
+                    "value_type": self._types,
+                }
+            ),
+            path,
+        )
+
+    @classmethod
+    def load(cls, path: str | Path) -> "TagRegistry":
+        table = pq.read_table(path).sort_by("tag_id")
+        registry = cls()
+        registry.register(
+            table.column("tag_name").to_numpy(), table.column("value_type").to_numpy()
+        )
+        return registry
+
+
+def generate_tag_names(*, sites: int, devices: int, points: int) -> np.ndarray:
+    """
+    Names like "site_0001/device_042/point_007" for every combination.
+    """
+    site, device, point = np.meshgrid(
+        np.char.add("site_", np.char.zfill(np.arange(sites).astype(str), 4)),
+        np.char.add("device_", np.char.zfill(np.arange(devices).astype(str), 3)),
+        np.char.add("point_", np.char.zfill(np.arange(points).astype(str), 3)),
+        indexing="ij",
+    )
+    return np.char.add(
+        np.char.add(np.char.add(site.ravel(), SEPARATOR), device.ravel()),
+        np.char.add(SEPARATOR, point.ravel()),
+    ).astype(object)
+
+
+# 100 sites x 100 devices x 100 points = 1,000,000 tags
+SITES = 100
+DEVICES = 100
+POINTS = 100
+
+LOOKUPS = 10_000
+BATCH_SIZE = 100_000
+BATCHES = 20
+
+PATTERNS = [
+    "site_0042/device_007/point_003",
+    "site_0042/device_007/*",
+    "site_0042/**",
+    "site_004?/*/point_00[0-4]",
+    "*/*/point_042",
+]
+
+
+def timed(fn, *args) -> tuple:
+    t_start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - t_start
+
+
+def main():
+    Path("data_stats/tag_registry").mkdir(exist_ok=True)
+
+    rng = np.random.default_rng(0)
+    names = generate_tag_names(sites=SITES, devices=DEVICES, points=POINTS)
+    value_types = rng.integers(0, len(ingest.VALUE_COLUMNS), size=len(names))
+
+    registry = TagRegistry()
+    _, register_time = timed(registry.register, names, value_types)
+    print(f"{len(registry)} tags registered in {round(register_time, 3)} s")
+
+    data = [
+        {
+            "operation": "register",
+            "n_tags": len(registry),
+            "items": len(names),
+            "time_s": round(register_time, 4),
+        }
+    ]
+
+    # Single lookups, as when resolving one tag of a query
+    latencies = []
+    for name in rng.choice(names, size=LOOKUPS):
+        _, latency = timed(registry.get_ids, [name])
+        latencies.append(latency)
+    data.append(
+        {
+            "operation": "get_ids",
+            "n_tags": len(registry),
+            "items": LOOKUPS,
+            "time_s": round(sum(latencies), 4),
+            **queries.summarize_latencies(latencies),
+        }
+    )
+
+    for pattern in PATTERNS:
+        ids, latency = timed(registry.resolve, pattern)
+        print(f"\t{pattern}: {len(ids)} tags in {round(latency * 1000, 2)} ms")
+        data.append(
+            {
+                "operation": f"resolve {pattern}",
+                "n_tags": len(registry),
+                "items": len(ids),
+                "time_s": round(latency, 4),
+            }
+        )
+
+    # Ingest overhead: batches with tag names instead of IDs, routed by the
+    # registered types of their tags
+    encode_time = route_time = 0.0
+    for _ in range(BATCHES):
+        rows = rng.integers(0, len(names), size=BATCH_SIZE)
+        values = rng.random(BATCH_SIZE)
+        batch = pa.record_batch(
+            {
+                "time": pa.array(np.arange(BATCH_SIZE), type=pa.timestamp("ns")),
+                "tag_name": pa.array(names[rows], type=pa.string()),
+                # Only the column of each tag's type is populated
+                "value_int": pa.array(
+                    (values * 1000).astype(np.int64), mask=value_types[rows] != 0
+                ),
+                "value_float": pa.array(values, mask=value_types[rows] != 1),
+                "value_str": pa.array(values.astype(str), mask=value_types[rows] != 2),
+                "value_bool": pa.array(values > 0.5, mask=value_types[rows] != 3),
+            }
+        )
+        batch, latency = timed(registry.encode_batch, batch)
+        encode_time += latency
+        _, latency = timed(registry.route_batch, batch)
+        route_time += latency
+    print(f"\t{int(BATCHES * BATCH_SIZE / encode_time)} rows/s converted to IDs")
+    print(f"\t{int(BATCHES * BATCH_SIZE / route_time)} rows/s routed by type")
+    data.append(
+        {
+            "operation": "encode_batch",
+            "n_tags": len(registry),
+            "items": BATCHES * BATCH_SIZE,
+            "time_s": round(encode_time, 4),
+            "rows_per_s": int(BATCHES * BATCH_SIZE / encode_time),
+        }
+    )
+    data.append(
+        {
+            "operation": "route_batch",
+            "n_tags": len(registry),
+            "items": BATCHES * BATCH_SIZE,
+            "time_s": round(route_time, 4),
+            "rows_per_s": int(BATCHES * BATCH_SIZE / route_time),
+        }
+    )
+
+    pd.DataFrame(data).to_csv(
+        f"data_stats/tag_registry/{len(registry)}_tags.csv", index=False
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+# Type-routed ingest versus the sparse rows of the generated cases.
+#
+# Every row populates one of the four value columns, but the sparse path sends
+# all four (three of them null). Routed batches only carry the populated column
+# (see ingest.route_by_type), so less goes over the wire per row at the cost of
+# more, smaller requests when a batch mixes types.
+
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from dotenv import load_dotenv
+
+import config
+import ingest
+import line_protocol
+import queries
+import utils
+
+MODES = {
+    "sparse": lambda batches: batches,
+    "routed": ingest.route_by_type,
+}
+
+
+def get_payload_sizes(batches) -> dict:
+    """
+    Size of the batches in memory and as the CSV (Timescale) and line protocol
+    (InfluxDB) payloads built from them.
+    """
+    sizes = {"batches": 0, "arrow_B": 0, "csv_B": 0, "line_protocol_B": 0}
+    for batch in batches:
+        sink = pa.BufferOutputStream()
+        pa_csv.write_csv(
+            batch, sink, write_options=pa_csv.WriteOptions(include_header=False)
+        )
+        sizes["batches"] += 1
+        sizes["arrow_B"] += batch.nbytes
+        sizes["csv_B"] += sink.getvalue().size
+        sizes["line_protocol_B"] += line_protocol.encode_batch(
+            batch, measurement="m", tag_columns=["tag_id"]
+        ).size
+    return sizes
+
+
+def count_batches(batches, stats: dict):
+    stats.setdefault("rows", 0)
+    for batch in batches:
+        stats["rows"] += batch.num_rows
+        yield batch
+
+
+def main():
+    load_dotenv(override=True)
+
+    Path("data_stats/type_routing").mkdir(exist_ok=True)
+
+    # The payloads only depend on the dataset and batch size, shared by the
+    # backends
+    payloads = {}
+
+    for name in queries.BACKENDS:
+        if not config.is_enabled(name):
+            continue
+        backend = queries.get_backend(name)
+        client = backend.get_client()
+        data: dict[int, list[dict]] = {}
+
+        for case in config.get_cases(name):
+            case_name, workers = case.name, case.workers
+            print(f"{name} {case_name} ({workers} workers)")
+
+            table_name = f"_{case_name}_routing"
+            parquet_file = ingest.open_case(case_name)
+            t_min, _ = ingest.get_time_range(parquet_file)
+            # Timescale and InfluxDB expect recent data
+            offset = (
+                pd.Timestamp.now("UTC").floor("min").tz_localize(None)
+                - pd.Timestamp(t_min)
+            ).to_pytimedelta()
+
+            for mode, route in MODES.items():
+                key = (case_name, mode, case.batch_size)
+                if key not in payloads:
+                    payloads[key] = get_payload_sizes(
+                        route(
+                            ingest.iter_batches(
+                                parquet_file, batch_size=case.batch_size, stats={}
+                            )
+                        )
+                    )
+                    print(f"\t{mode} payload: {payloads[key]}")
+
+                backend.reset_table(client, table_name)
+
+                stats: dict = {}
+                insert_time = backend.write_batches(
+                    client,
+                    table_name,
+                    count_batches(
+                        route(
+                            ingest.shift_time(batch, offset)
+                            for batch in ingest.iter_batches(
+                                parquet_file, batch_size=case.batch_size, stats=stats
+                            )
+                        ),
+                        stats,
+                    ),
+                    workers,
+                )
+                print(f"\t{mode}: {int(stats['rows'] / insert_time)} rows/s")
+
+                data.setdefault(workers, []).append(
+                    {
+                        "mode": mode,
+                        "n_tags": case.n_tags,
+                        "seconds_interval": case.seconds_interval,
+                        "data_points": stats["rows"],
+                        "insert_time_s": round(insert_time, 3),
+                        "rows_per_s": int(stats["rows"] / insert_time),
+                        "load_time_s": round(stats["load_time_s"], 3),
+                        **payloads[key],
+                    }
+                )
+
+        for workers, rows in data.items():
+            df_stats = pd.DataFrame(rows)
+            file_name = f"data_stats/type_routing/{name}_{workers}_workers_{'remote' if utils.get_remote() else 'local'}.csv"
+            df_stats.to_csv(file_name, index=False)
+
+
+if __name__ == "__main__":
+    main()
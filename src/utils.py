@@ -1,5 +1,40 @@
 import os
+import resource
+import sys
 
 
 def get_remote() -> bool:
     return "marcusmarosvari" not in os.getcwd()
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak resident set size to the current one, so the next
+    get_peak_rss() only covers what ran since. Only Linux allows it, elsewhere
+    the peak stays the one of the whole process and this returns False.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_rss() -> int:
+    """
+    Get the peak resident set size of this process (in bytes), since the last
+    reset_peak_rss() where supported.
+    """
+    try:
+        # VmHWM is the peak ru_maxrss reports, but honours a reset
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if sys.platform == "darwin" else peak * 1024
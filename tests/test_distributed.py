@@ -0,0 +1,116 @@
+# LOCAL mode end to end, with a stub backend standing in for the database.
+#
+#   python -m unittest discover tests
+
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import config  # noqa: E402
+import distributed  # noqa: E402
+
+STUB_BACKEND = """
+from pathlib import Path
+
+
+def get_client():
+    return None
+
+
+def reset_table(client, table_name):
+    for path in Path("acked").glob("*"):
+        path.unlink()
+
+
+def write_batches(client, table_name, batches, workers):
+    Path("acked").mkdir(exist_ok=True)
+    for batch in batches:
+        with open(f"acked/{table_name}", "a") as f:
+            f.write(f"{batch.num_rows}\\n")
+    return 0.0
+"""
+
+CONFIG = """
+[matrix]
+minutes = [1]
+workers = [2]
+tags = [10]
+seconds_interval = [1]
+batch_size = 50
+"""
+
+
+class TestDistributed(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cwd = os.getcwd()
+        self.dir = tempfile.TemporaryDirectory()
+        os.chdir(self.dir.name)
+
+        Path("_stub.py").write_text(STUB_BACKEND)
+        sys.path.insert(0, self.dir.name)
+        Path("config.toml").write_text(CONFIG)
+        self.settings = config.settings
+        config.settings = config.load_settings("config.toml")
+
+        # One minute of 10 tags every second
+        times = pd.date_range("2025-01-01", periods=60, freq="1s")
+        Path("data").mkdir()
+        Path("data_stats").mkdir()
+        pq.write_table(
+            pa.table(
+                {
+                    "time": pa.array(times.repeat(10).to_numpy()),
+                    "tag_id": pa.array(list(range(10)) * 60, pa.int32()),
+                    "value_int": pa.array(range(600), pa.int32()),
+                }
+            ),
+            "data/1_minutes_of_10_tags_at_1_second_intervals.parquet",
+        )
+
+    def tearDown(self) -> None:
+        os.chdir(self.cwd)
+        sys.path.remove(self.dir.name)
+        config.settings = self.settings
+        self.dir.cleanup()
+
+    def test_local_generators_deliver_every_row_once(self) -> None:
+        distributed.run_coordinator(
+            host="127.0.0.1",
+            port=0,
+            processes=2,
+            backend_name="stub",
+            partition="tag",
+            local=True,
+        )
+
+        acked = Path("acked/_1_minutes_of_10_tags_at_1_second_intervals_distributed")
+        self.assertEqual(sum(map(int, acked.read_text().split())), 600)
+
+        (file_name,) = Path("data_stats/distributed").glob("stub_2_processes_*.csv")
+        row = pd.read_csv(file_name).iloc[0]
+        self.assertEqual(row["delivered_rows"], 600)
+        self.assertEqual(row["data_points"], 600)
+
+    def test_remote_listener_requires_authkey(self) -> None:
+        os.environ.pop("DISTRIBUTED_AUTHKEY", None)
+        with self.assertRaises(ValueError):
+            distributed.run_coordinator(
+                host="0.0.0.0",
+                port=0,
+                processes=1,
+                backend_name="stub",
+                partition="tag",
+                local=False,
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+# InfluxDBAdmin against a local http.server standing in for the management API.
+#
+#   python -m unittest discover tests
+
+import json
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "src"))
+
+import _influxdb  # noqa: E402
+
+BUCKETS = [{"id": f"id_{i}", "name": f"bucket_{i}"} for i in range(5)]
+ORGS = {"Project Data": "org_1"}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Paths of the requests received, by every server
+    requests: list[str] = []
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        Handler.requests.append(url.path)
+
+        if url.path == "/api/v2/buckets":
+            offset, limit = int(params["offset"]), int(params["limit"])
+            self.send_json(200, {"buckets": BUCKETS[offset : offset + limit]})
+        elif url.path == "/api/v2/orgs":
+            org = params["org"]
+            if org in ORGS:
+                self.send_json(200, {"orgs": [{"id": ORGS[org], "name": org}]})
+            elif org == "Gone":
+                # Unknown names are a 404 on some versions
+                self.send_json(404, {"code": "not found"})
+            else:
+                self.send_json(200, {"orgs": []})
+        else:
+            self.send_json(404, {"code": "not found"})
+
+    def send_json(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class TestInfluxDBAdmin(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        Handler.requests.clear()
+
+        # get_org_id prefers the ID from the environment
+        self.env = mock.patch.dict(os.environ)
+        self.env.start()
+        os.environ.pop("INFLUXDB_ORG_ID", None)
+
+    def tearDown(self) -> None:
+        self.env.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_admin(self, **kwargs) -> _influxdb.InfluxDBAdmin:
+        host, port = self.server.server_address[:2]
+        admin = _influxdb.InfluxDBAdmin(
+            host=f"http://{host}:{port}/", token="token", page_size=2, **kwargs
+        )
+        self.addCleanup(admin.close)
+        return admin
+
+    def test_list_buckets_follows_pagination(self) -> None:
+        admin = self.get_admin()
+        buckets = admin.list_buckets()
+        self.assertEqual(list(buckets), [b["name"] for b in BUCKETS])
+        # Two full pages and a short one
+        self.assertEqual(Handler.requests.count("/api/v2/buckets"), 3)
+        self.assertEqual(admin.get_bucket_id(bucket_name="bucket_3"), "id_3")
+        self.assertIsNone(admin.get_bucket_id(bucket_name="missing"))
+
+    def test_buckets_are_cached_until_the_ttl(self) -> None:
+        admin = self.get_admin(cache_ttl_s=60)
+        admin.list_buckets()
+        admin.list_buckets()
+        admin.get_bucket_id(bucket_name="bucket_0")
+        self.assertEqual(Handler.requests.count("/api/v2/buckets"), 3)
+
+        admin.list_buckets(refresh=True)
+        self.assertEqual(Handler.requests.count("/api/v2/buckets"), 6)
+
+        with mock.patch.object(
+            _influxdb.time, "monotonic", return_value=_influxdb.time.monotonic() + 61
+        ):
+            admin.list_buckets()
+        self.assertEqual(Handler.requests.count("/api/v2/buckets"), 9)
+
+    def test_get_org_id(self) -> None:
+        admin = self.get_admin()
+        self.assertEqual(admin.get_org_id(org="Project Data"), "org_1")
+        self.assertEqual(admin.get_org_id(org="Project Data"), "org_1")
+        self.assertEqual(Handler.requests.count("/api/v2/orgs"), 1)
+
+    def test_missing_org_is_named(self) -> None:
+        admin = self.get_admin()
+        for org in ["Unknown", "Gone"]:
+            with self.subTest(org=org):
+                with self.assertRaisesRegex(ValueError, f"'{org}' not found"):
+                    admin.get_org_id(org=org)
+
+
+if __name__ == "__main__":
+    unittest.main()